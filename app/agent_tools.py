@@ -180,7 +180,7 @@ def find_product(search_query: Annotated[str,"The product search query"]) -> Ann
                                 MOQ and Price:
                                 Seller Contact:
                                 Seller Location:
-                                """) + '\n\n\n'
+                                """,site='scraping_summarizer',temperature=0) + '\n\n\n'
 
         with open('app/Data/Seller_Details_2.txt', 'w', encoding="utf-8") as file:
             file.write(information)
@@ -8,10 +8,14 @@ from typing_extensions import Annotated,Optional,List,Dict,Union
 from typing import Any
 import inspect
 import os
+from contextlib import nullcontext
 
 #Tool imports
 from tools import recognize_speech,speak_text,use_llm,use_llm_naked
 import agent_tools
+from routing import SpeakerRouter
+from history import HistoryCompactor
+from streaming import SpeakingStream,reply_timings
 
 env_path = "D:/ABRAR/1_PERSONAL/Wolf_Tech/Mazduur_AI/app/.env"
 load_dotenv(env_path)
@@ -22,8 +26,13 @@ config_list = [{"model": "llama3-70b-8192",
                 "base_url": "https://api.groq.com/openai/v1",
                 "max_retries": 10}]
 
+#The agents sample at 0.75 over the whole conversation, so their replies are left out of caching,
+#the tool calls in tools.py go through the response cache in llm_cache.py instead
 llm_config = {"config_list":config_list,"temperature":0.75,"cache_seed":None}
 
+#The agents that speak stream their replies so the first sentence is spoken while the rest is generated
+speaking_llm_config = {**llm_config,"stream":os.environ.get("STREAM_REPLIES","1") == "1"}
+
 
 class ListeningUser(ConversableAgent):
     def get_human_input(self, prompt: str) -> str:
@@ -100,6 +109,12 @@ class SpeakingAssistant(ConversableAgent):
         # Message modifications do not affect the incoming messages or self._oai_messages.
         messages = self.process_all_messages_before_reply(messages)
 
+        # A streamed completion is printed chunk by chunk through the default IOStream,
+        # the speaking stream speaks each finished sentence while the rest is generated
+        reply_stream = None
+        if self.llm_config and self.llm_config.get("stream"):
+            reply_stream = SpeakingStream(IOStream.get_default(),speak_text,on_reply=reply_timings.record)
+
         for reply_func_tuple in self._reply_func_list:
             reply_func = reply_func_tuple["reply_func"]
             if "exclude" in kwargs and reply_func in kwargs["exclude"]:
@@ -107,8 +122,9 @@ class SpeakingAssistant(ConversableAgent):
             if inspect.iscoroutinefunction(reply_func):
                 continue
             if self._match_trigger(reply_func_tuple["trigger"], sender):
-                final, reply = reply_func(
-                    self, messages=messages, sender=sender, config=reply_func_tuple["config"])
+                with IOStream.set_default(reply_stream) if reply_stream else nullcontext():
+                    final, reply = reply_func(
+                        self, messages=messages, sender=sender, config=reply_func_tuple["config"])
                 if logging_enabled():
                     log_event(
                         self,
@@ -119,6 +135,9 @@ class SpeakingAssistant(ConversableAgent):
                         reply=reply,
                     )
                 if final:
+                    if reply_stream is not None and reply_stream.finish()['sentences']:
+                        # The reply was spoken as it was streamed
+                        return reply
                     if reply is None:
                         speak_text("Thank you signing off")
                         return reply
@@ -175,6 +194,26 @@ product_expert = ConversableAgent(
     description="An agent to assist the user in finding a product on the internet. It gathers all the information for the product before making the tool call"
 )
 
+#Function to fold older messages into the running summary of a history compactor
+def summarize_history(summary: str,messages_text: str) -> str:
+    return use_llm(f"""
+    Update the summary of a conversation with the new messages below
+    Keep every requirement of the user, every product, seller, price and quantity mentioned and every tool result that was stored
+    Reply with only the updated summary
+
+    Summary so far
+    {summary or "None"}
+
+    New messages
+    {messages_text}
+    """,site='history_summary',temperature=0)
+
+#Every agent that calls the LLM keeps its prompt under the token budget
+history_compactors = [
+    HistoryCompactor.from_env(agent.name,summarize=summarize_history).attach(agent)
+    for agent in [product_expert,tool_suggestor,tool_executor]
+]
+
 #Registering assistant tools
 register_function(
     f=agent_tools.insert_item_to_db,
@@ -237,7 +276,7 @@ assistant = SpeakingAssistant(
     system_message="""You are a handy assistant that only replies to query from your knowledge. You do not write any code
     You will receieve a message from the Commander-Agent, from that extract the answer that the user requires
     Call the Commander-Agent when a task needs to be done by the user""",
-    llm_config=llm_config,
+    llm_config=speaking_llm_config,
     description="An assistant agent that can help answer queries",
     is_termination_msg=lambda x: x.get("content", "").find("terminate") >= 0
 )
@@ -249,16 +288,14 @@ allowed_transitions = {
     tool_executor:[product_expert,tool_suggestor,user_proxy]
 }
 
-def speaker_selection(last_agent: Agent,groupchat: GroupChat):
-    messages = groupchat.messages
-
-
-    if "tool_calls" in messages[-1]:
-        return tool_executor
-    
-    elif last_agent is product_expert:
-        return user_proxy
+#The words in a message that show which agent should take it up
+speaker_intents = {
+    product_expert:["find","source","sourcing","search","supplier","suppliers","manufacturer","vendor","moq","buy","import"],
+    tool_suggestor:["insert","update","view","change","edit","units","stock","inventory","price","cost","database","existing"]
+}
 
+#Function to ask the LLM who speaks next, for the turns the routing rules cannot decide
+def ask_speaker_llm(last_agent: Agent,messages: List[Dict],candidates: List[Agent],retry: bool) -> str:
     system_message = """You are a manager for an E Commerce Company with four people. These are the [User,Product-Expert,Tool-Suggestor,Tool-Executor]
     The responsibilities of these are
     User: The actual user and owner of the company that can help guide the conversation and other details
@@ -283,27 +320,26 @@ def speaker_selection(last_agent: Agent,groupchat: GroupChat):
     {last_agent.name}
 
     Speaker Choices:
-    User,Product-Expert,Tool-Suggestor,Tool-Executor
+    {",".join(agent.name for agent in candidates)}
     Stick to these names as is do not change them
 
     Next Speaker:
     <Your response>
     """
-    response = use_llm_naked(system_message,user_message).lower()
-    
-    while (response==last_agent.name.lower()):
-        response = use_llm_naked(system_message,user_message)
-    
-    if "user" in response:
-        return user_proxy
-    elif "product-expert" in response:
-        return product_expert
-    elif "tool-suggestor" in response:
-        return tool_suggestor
-    elif "tool-executor" in response:
-        return tool_executor
-    else:
-        return "auto"
+    #A retry follows a rejected answer, which is the one the response cache holds, so it is sampled afresh
+    return use_llm_naked(system_message,user_message,site='speaker_selection',cache=not retry,temperature=None if retry else 0)
+
+speaker_router = SpeakerRouter(
+    transitions=allowed_transitions,
+    executor=tool_executor,
+    admin=user_proxy,
+    ask_llm=ask_speaker_llm,
+    intents=speaker_intents,
+    max_llm_calls=int(os.environ.get('SPEAKER_LLM_CALLS','3'))
+)
+
+def speaker_selection(last_agent: Agent,groupchat: GroupChat):
+    return speaker_router.select(last_agent,groupchat)
 
 
 # setting up main conversation loop
@@ -363,4 +399,13 @@ main_chat_manager = GroupChatManager(
 )
 
 def main(start_command: Annotated[str, "The starter message"]) -> None:
+    speaker_router.reset()
+    for compactor in history_compactors:
+        compactor.reset()
+    reply_timings.reset()
     user_proxy.initiate_chat(main_chat_manager, message=start_command)
+    print(speaker_router.report())
+    for compactor in history_compactors:
+        print(compactor.report())
+    if reply_timings.replies:
+        print(reply_timings.report())
@@ -1,5 +1,6 @@
 from tools import recognize_speech
 from agents import main
+from llm_cache import get_cache
 
 if __name__=="__main__":
     choice = input("Choose your input type\n1.Type\n2.Speak\n")
@@ -9,5 +10,8 @@ if __name__=="__main__":
         command = recognize_speech()
     if command:
         main(command)
+        llm_cache = get_cache()
+        if llm_cache is not None:
+            print(llm_cache.report())
     else:
         print("We ran into some error")
\ No newline at end of file
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The LLM gateway is one module, server/llm_gateway.py, shared by the server and the app. The server
+# imports it like any of its own modules, so it runs and is packaged on its own. The app finds it
+# through the server directory next to it, or LLM_GATEWAY_DIR when the server code is somewhere else
+GATEWAY_DIR = os.environ.get('LLM_GATEWAY_DIR',os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'server'))
+if GATEWAY_DIR not in sys.path:
+    #appended, so a module of the app is never shadowed by one of the server
+    sys.path.append(GATEWAY_DIR)
+
+from llm_gateway import get_gateway,estimate_tokens,DEFAULT_SYSTEM_MESSAGE
@@ -0,0 +1,201 @@
+import os
+import copy
+import hashlib
+from typing_extensions import Annotated,Dict,List,Optional,Callable
+from typing import Any
+
+from gateway import estimate_tokens
+
+# Keeps the history an agent sends with every completion under a token budget. Registered as a
+# process_all_messages_before_reply hook, so only the prompt is compacted and the chat history of
+# the agent is left as it is. When the history is over the budget:
+#   1. the last keep_recent messages are kept verbatim
+#   2. older tool outputs, like the seller pages of find_product, are cut down to a reference
+#   3. if it is still over, the oldest messages are folded into a running summary a chunk at a time,
+#      the summary is kept between turns so each turn only summarizes the messages that are new to it
+# Configuration (environment):
+#   HISTORY_TOKEN_BUDGET   the prompt tokens an agent may send, 0 turns compaction off, default 6000
+#   HISTORY_KEEP_RECENT    the recent messages kept verbatim, default 6
+#   HISTORY_LOG            1 to print the prompt tokens of every turn before and after compaction
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def _is_tool_output(message : Dict[str,Any]) -> bool:
+    return message.get('role') == 'tool' or bool(message.get('tool_responses'))
+
+
+def _fingerprint(message : Dict[str,Any]) -> str:
+    return hashlib.sha256(repr((message.get('name'),message.get('role'),message.get('content'))).encode('utf-8')).hexdigest()
+
+
+class HistoryCompactor:
+    """
+    Compacts the prompt history of one agent to a token budget, with a running summary of the
+    turns that no longer fit and the prompt tokens of every turn before and after compaction
+    """
+
+    def __init__(self,name : Annotated[str,"The name of the agent, for the report"],
+                 summarize : Annotated[Optional[Callable[[str,str],str]],"Folds messages into the summary"] = None,
+                 token_budget : Annotated[int,"The prompt tokens the agent may send, 0 for no limit"] = 6000,
+                 keep_recent : Annotated[int,"The recent messages kept verbatim"] = 6,
+                 tool_output_chars : Annotated[int,"The characters of an old tool output that are kept"] = 300,
+                 summary_chunk : Annotated[int,"The messages folded into the summary at a time"] = 4,
+                 log : Annotated[bool,"Print the prompt tokens of every turn"] = False):
+        """
+        Args:
+            name: The name of the agent, for the report
+            summarize: Called with (summary,messages_text) and returns the new summary. Without it the
+                folded messages are replaced by a note of how many were left out
+            token_budget: The prompt tokens the agent may send, 0 for no limit
+            keep_recent: The recent messages kept verbatim
+            tool_output_chars: The characters of an old tool output that are kept
+            summary_chunk: The messages folded into the summary at a time
+            log: Print the prompt tokens of every turn
+        """
+        self.name = name
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.tool_output_chars = tool_output_chars
+        self.summary_chunk = summary_chunk
+        self.log = log
+        self.reset()
+
+    @classmethod
+    def from_env(cls,name : str,summarize : Optional[Callable[[str,str],str]] = None) -> 'HistoryCompactor':
+        return cls(
+            name,
+            summarize=summarize,
+            token_budget=int(os.environ.get('HISTORY_TOKEN_BUDGET','6000')),
+            keep_recent=int(os.environ.get('HISTORY_KEEP_RECENT','6')),
+            log=os.environ.get('HISTORY_LOG','1') == '1'
+        )
+
+    def reset(self) -> None:
+        """Drops the running summary and the turns, called when a new conversation starts"""
+        self.turns = []
+        self._drop_summary()
+
+    def _drop_summary(self) -> None:
+        self._summary = ''
+        self._summarized = 0
+        self._last_summarized = None
+
+    def attach(self,agent : Annotated[Any,"The ConversableAgent"]) -> 'HistoryCompactor':
+        """Registers the compactor as a hook of the agent"""
+        agent.register_hook('process_all_messages_before_reply',self)
+        return self
+
+    #==========================================COMPACTION==========================================
+    def _trim_tool_output(self,message : Dict[str,Any]) -> Dict[str,Any]:
+        # A copy of the message with every tool output cut down to its start and a note of its size
+        def trim(content):
+            if not isinstance(content,str) or len(content) <= self.tool_output_chars:
+                return content
+            return content[:self.tool_output_chars] + f"\n[... {len(content) // 4} tokens of tool output left out]"
+
+        message = copy.deepcopy(message)
+        message['content'] = trim(message.get('content'))
+        for response in message.get('tool_responses') or []:
+            response['content'] = trim(response.get('content'))
+        return message
+
+    def _boundary(self,messages : List[Dict[str,Any]],index : int) -> int:
+        # Moves a split point back so a tool output is never split from the tool call it answers
+        while 0 < index < len(messages) and _is_tool_output(messages[index]):
+            index -= 1
+        return index
+
+    def _fold(self,messages : List[Dict[str,Any]],end : int) -> None:
+        # Folds messages[_summarized:end] into the running summary
+        chunk = messages[self._summarized:end]
+        text = '\n'.join(f"{message.get('name') or message.get('role')}: {message.get('content') or ''}" for message in chunk)
+        summary = None
+        if self.summarize is not None:
+            try:
+                summary = self.summarize(self._summary,text)
+            except Exception as e:
+                print(f"Summarizing the history of {self.name} failed due to {e}")
+        if summary is None:
+            summary = (self._summary + '\n' if self._summary else '') + f"[{len(chunk)} earlier messages left out]"
+        self._summary = summary
+        self._summarized = end
+        self._last_summarized = _fingerprint(messages[end - 1])
+
+    def compact(self,messages : Annotated[List[Dict[str,Any]],"The messages the agent is about to send"]
+                ) -> Annotated[List[Dict[str,Any]],"The messages within the budget"]:
+        """
+        Returns the messages cut down to the token budget, the messages passed in are not changed
+        """
+        before = estimate_tokens(messages)
+        #The history is only ever appended to, unless it was cleared, then the summary is stale
+        if self._summarized and (len(messages) < self._summarized or
+                                 _fingerprint(messages[self._summarized - 1]) != self._last_summarized):
+            self._drop_summary()
+
+        if not self.token_budget or before <= self.token_budget and not self._summarized:
+            self._record(before,before,0,0)
+            return messages
+
+        recent_start = max(self._boundary(messages,max(len(messages) - self.keep_recent,0)),self._summarized)
+        trimmed = 0
+        older = []
+        for message in messages[self._summarized:recent_start]:
+            if _is_tool_output(message):
+                compacted = self._trim_tool_output(message)
+                trimmed += compacted != message
+                older.append(compacted)
+            else:
+                older.append(message)
+
+        def build():
+            summary = [{'role':'user','name':'Summary','content':SUMMARY_PREFIX + self._summary}] if self._summary else []
+            return summary + older[self._summarized - start:] + messages[recent_start:]
+
+        start = self._summarized
+        compacted = build()
+        folded = 0
+        while estimate_tokens(compacted) > self.token_budget and self._summarized < recent_start:
+            end = self._boundary(messages,min(self._summarized + self.summary_chunk,recent_start))
+            if end <= self._summarized:
+                #The chunk is all tool outputs of one call, fold it with its call
+                end = min(self._summarized + self.summary_chunk,recent_start)
+                while end < recent_start and _is_tool_output(messages[end]):
+                    end += 1
+            folded += end - self._summarized
+            self._fold(messages,end)
+            compacted = build()
+
+        after = estimate_tokens(compacted)
+        self._record(before,after,trimmed,folded)
+        return compacted
+
+    __call__ = compact
+
+    #==========================================REPORT==============================================
+    def _record(self,before : int,after : int,trimmed : int,folded : int) -> None:
+        self.turns.append({'before':before,'after':after,'trimmed':trimmed,'folded':folded})
+        if self.log:
+            print(f"History of {self.name}: turn {len(self.turns)} prompt {before} -> {after} tokens"
+                  + (f", {trimmed} tool outputs trimmed" if trimmed else '')
+                  + (f", {folded} messages summarized" if folded else ''))
+
+    def stats(self) -> Annotated[Dict[str,Any],"The prompt tokens of every turn"]:
+        """
+        Returns the prompt tokens of every turn before and after compaction, and their totals
+        """
+        return {
+            'agent': self.name,
+            'token_budget': self.token_budget,
+            'turns': list(self.turns),
+            'tokens_before': sum(turn['before'] for turn in self.turns),
+            'tokens_after': sum(turn['after'] for turn in self.turns),
+            'summarized_messages': self._summarized
+        }
+
+    def report(self) -> Annotated[str,"The token totals as text"]:
+        """Returns the prompt token totals of the agent as a line of text"""
+        stats = self.stats()
+        return (f"History of {self.name}: {len(stats['turns'])} turns, {stats['tokens_before']} prompt tokens "
+                f"cut to {stats['tokens_after']} (budget {stats['token_budget']} a turn)")
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing_extensions import Annotated,Dict,Optional
+from typing import Any
+
+# A disk backed cache of LLM responses for the app tools, so the same seller page or the same
+# routing prompt is not billed and waited on twice. Entries are kept in a SQLite file, expire after
+# a TTL and the least recently used ones are evicted once the responses take up more than max_bytes
+# Configuration (environment):
+#   LLM_CACHE              1 to use the cache (default), 0 to turn it off
+#   LLM_CACHE_PATH         the SQLite file, app/Data/llm_cache.sqlite by default
+#   LLM_CACHE_TTL          seconds a response is kept, default 7 days
+#   LLM_CACHE_MAX_BYTES    the max bytes of responses kept, default 64MB
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),'Data','llm_cache.sqlite')
+
+
+def cache_key(model : Annotated[str,"The model"],
+              system_message : Annotated[str,"The system message"],
+              message : Annotated[str,"The user message"],
+              temperature : Annotated[Optional[float],"The sampling temperature, None for the provider default"] = None
+              ) -> Annotated[str,"The key of the call"]:
+    """
+    Hashes everything that decides the response of a call into the key it is cached under
+    """
+    return hashlib.sha256(json.dumps([model,system_message,message,temperature]).encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    A SQLite key value store of LLM responses with a TTL and size based LRU eviction,
+    counting hits and misses per call site
+    """
+
+    def __init__(self,
+                 path : Annotated[str,"The SQLite file"] = DEFAULT_PATH,
+                 ttl : Annotated[float,"The seconds a response is kept"] = 7 * 24 * 3600,
+                 max_bytes : Annotated[int,"The max bytes of responses kept"] = 64 << 20):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sites = {}
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self._connection = sqlite3.connect(path,check_same_thread=False,isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY,site TEXT,response TEXT NOT NULL,'
+            'size INTEGER NOT NULL,created REAL NOT NULL,accessed REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)')
+        self._bytes = self._connection.execute('SELECT COALESCE(SUM(size),0) FROM llm_cache').fetchone()[0]
+
+    @classmethod
+    def from_env(cls) -> 'LLMResponseCache':
+        return cls(
+            path=os.environ.get('LLM_CACHE_PATH',DEFAULT_PATH),
+            ttl=float(os.environ.get('LLM_CACHE_TTL',str(7 * 24 * 3600))),
+            max_bytes=int(os.environ.get('LLM_CACHE_MAX_BYTES',str(64 << 20)))
+        )
+
+    def _count(self,site : str,field : str) -> None:
+        # Called with the lock held
+        counters = self._sites.setdefault(site,{'hits':0,'misses':0,'bypassed':0})
+        counters[field] += 1
+
+    def get(self,key : Annotated[str,"The key from cache_key"],
+            site : Annotated[str,"The name of the caller"] = 'default') -> Annotated[Optional[str],"The response or None"]:
+        """
+        Returns the cached response of a call, or None if there is none or it has expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT response,size,created FROM llm_cache WHERE key = ?',(key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl:
+                self._connection.execute('DELETE FROM llm_cache WHERE key = ?',(key,))
+                self._bytes -= row[1]
+                row = None
+            if row is None:
+                self._count(site,'misses')
+                return None
+            self._connection.execute('UPDATE llm_cache SET accessed = ? WHERE key = ?',(now,key))
+            self._count(site,'hits')
+            return row[0]
+
+    def put(self,key : Annotated[str,"The key from cache_key"],
+            response : Annotated[str,"The response"],
+            site : Annotated[str,"The name of the caller"] = 'default') -> None:
+        """
+        Saves a response and evicts the least recently used ones while the cache is over max_bytes
+        """
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            old = self._connection.execute('SELECT size FROM llm_cache WHERE key = ?',(key,)).fetchone()
+            self._connection.execute('INSERT OR REPLACE INTO llm_cache VALUES (?,?,?,?,?,?)',(key,site,response,size,now,now))
+            self._bytes += size - (old[0] if old else 0)
+            while self._bytes > self.max_bytes:
+                rows = self._connection.execute(
+                    'SELECT key,size FROM llm_cache WHERE key != ? ORDER BY accessed LIMIT 64',(key,)).fetchall()
+                if not rows:
+                    break
+                for old_key,old_size in rows:
+                    self._connection.execute('DELETE FROM llm_cache WHERE key = ?',(old_key,))
+                    self._bytes -= old_size
+                    self.evictions += 1
+                    if self._bytes <= self.max_bytes:
+                        break
+
+    def bypassed(self,site : Annotated[str,"The name of the caller"] = 'default') -> None:
+        """Counts a call that skipped the cache"""
+        with self._lock:
+            self._count(site,'bypassed')
+
+    def stats(self) -> Annotated[Dict[str,Any],"The cache counters"]:
+        """
+        Returns the size of the cache and the hits, misses and hit rate of every call site
+        """
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+            sites = {}
+            for site,counters in sorted(self._sites.items()):
+                lookups = counters['hits'] + counters['misses']
+                sites[site] = {**counters,'hit_rate':counters['hits'] / lookups if lookups else 0.0}
+            return {
+                'path': self.path,
+                'entries': entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'evictions': self.evictions,
+                'sites': sites
+            }
+
+    def report(self) -> Annotated[str,"The hit rate of every call site"]:
+        """Returns the per site hit rates as lines of text"""
+        stats = self.stats()
+        lines = [f"LLM cache: {stats['entries']} entries, {stats['bytes']} bytes, {stats['evictions']} evicted"]
+        for site,counters in stats['sites'].items():
+            lines.append(f"  {site}: {counters['hits']} hits, {counters['misses']} misses, "
+                         f"{counters['bypassed']} bypassed, {counters['hit_rate']:.0%} hit rate")
+        return '\n'.join(lines)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Annotated[Optional[LLMResponseCache],"The shared cache, None when LLM_CACHE=0"]:
+    """
+    Returns the cache of this process, opened from the environment the first time it is asked for
+    """
+    global _cache
+    if os.environ.get('LLM_CACHE','1') != '1':
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMResponseCache.from_env()
+        return _cache
@@ -0,0 +1,147 @@
+import re
+from typing_extensions import Annotated,Dict,List,Optional,Callable,Union
+from typing import Any
+
+# Picks the next speaker of the group chat from what is already known about the conversation, so the
+# LLM is only asked on the turns the rules cannot settle. In order:
+#   1. a message with tool_calls goes to the executor
+#   2. a tool result from the executor goes back to the agent that made the call
+#   3. the allowed transitions of the last speaker, without the executor when no tool call is pending,
+#      decide it when only one agent is left
+#   4. the intent keywords of the last message decide it when they point at exactly one agent
+#   5. otherwise the LLM is asked, at most max_llm_calls times, and the admin is picked if it never
+#      names an allowed agent
+
+
+class SpeakerRouter:
+    """
+    Rule based speaker selection for a GroupChat with an LLM fallback for ambiguous turns,
+    counting how many rounds each rule settled and how many LLM calls were made
+    """
+
+    def __init__(self,transitions : Annotated[Dict[Any,List[Any]],"The agents each agent may hand over to"],
+                 executor : Annotated[Any,"The agent that runs the tool calls"],
+                 admin : Annotated[Any,"The agent picked when nothing else decides it, the user"],
+                 ask_llm : Annotated[Callable[[Any,List[Dict],List[Any],bool],str],"Asks the LLM for the next speaker"],
+                 intents : Annotated[Optional[Dict[Any,List[str]]],"The keywords that point at each agent"] = None,
+                 max_llm_calls : Annotated[int,"The max LLM calls of a single round"] = 3):
+        """
+        Args:
+            transitions: The agents each agent may hand over to, like allowed_transitions
+            executor: The agent that runs the tool calls
+            admin: The agent picked when the LLM never names an allowed agent
+            ask_llm: Called with (last_agent,messages,candidates,retry) and returns the LLM's answer,
+                retry is True when the previous answer was rejected and must not be served from a cache
+            intents: The keywords, matched as whole words, that point at each agent
+            max_llm_calls: The max LLM calls of a single round
+        """
+        self.transitions = transitions
+        self.executor = executor
+        self.admin = admin
+        self.ask_llm = ask_llm
+        self.intents = {
+            agent:re.compile(r'\b(' + '|'.join(re.escape(word) for word in words) + r')\b',re.IGNORECASE)
+            for agent,words in (intents or {}).items()
+        }
+        self.max_llm_calls = max_llm_calls
+        self.reset()
+
+    def reset(self) -> None:
+        """Clears the counters, called when a new conversation starts"""
+        self.rounds = 0
+        self.by_rule = {}
+        self.llm_rounds = 0
+        self.llm_calls = 0
+        self.llm_failed = 0
+
+    #==========================================RULES===============================================
+    def _tool_caller(self,messages : List[Dict],agents : List[Any]) -> Optional[Any]:
+        # The agent of the latest message with tool_calls, the one waiting for the tool result
+        by_name = {agent.name:agent for agent in agents}
+        for message in reversed(messages[:-1]):
+            if message.get('tool_calls'):
+                return by_name.get(message.get('name'))
+        return None
+
+    def _by_rules(self,last_agent : Any,messages : List[Dict],agents : List[Any]) -> Optional[tuple]:
+        last = messages[-1] if messages else {}
+        if last.get('tool_calls'):
+            return 'tool_call',self.executor
+        if last_agent is self.executor and (last.get('tool_responses') or last.get('role') == 'tool'):
+            caller = self._tool_caller(messages,agents)
+            if caller is not None:
+                return 'tool_result',caller
+
+        candidates = self.candidates(last_agent,agents)
+        if len(candidates) == 1:
+            return 'transition',candidates[0]
+
+        content = last.get('content')
+        if isinstance(content,str) and content:
+            matched = [agent for agent in candidates if agent in self.intents and self.intents[agent].search(content)]
+            if len(matched) == 1:
+                return 'intent',matched[0]
+        return None
+
+    def candidates(self,last_agent : Annotated[Any,"The last speaker"],
+                   agents : Annotated[List[Any],"The agents of the group chat"]) -> Annotated[List[Any],"The agents that may speak next"]:
+        """
+        Returns the agents the last speaker may hand over to, the executor is left out since
+        it only follows a tool call
+        """
+        allowed = self.transitions.get(last_agent,agents)
+        return [agent for agent in allowed if agent is not last_agent and agent is not self.executor]
+
+    #==========================================SELECTION===========================================
+    def _by_llm(self,last_agent : Any,messages : List[Dict],candidates : List[Any]) -> Any:
+        by_name = {agent.name.lower():agent for agent in candidates}
+        for call in range(self.max_llm_calls):
+            self.llm_calls += 1
+            response = self.ask_llm(last_agent,messages,candidates,call > 0).strip().lower()
+            #The longest name first so Tool-Suggestor is not read as a mention of another agent
+            for name in sorted(by_name,key=len,reverse=True):
+                if name in response:
+                    return by_name[name]
+        self.llm_failed += 1
+        return self.admin if self.admin in candidates else candidates[0]
+
+    def select(self,last_agent : Annotated[Any,"The last speaker"],
+               groupchat : Annotated[Any,"The GroupChat"]) -> Annotated[Union[Any,str],"The next speaker"]:
+        """
+        Picks the next speaker, by the rules when they decide it and by the LLM otherwise.
+        Has the signature of a GroupChat speaker_selection_method
+        """
+        self.rounds += 1
+        messages = groupchat.messages
+        ruled = self._by_rules(last_agent,messages,groupchat.agents)
+        if ruled is not None:
+            rule,agent = ruled
+            self.by_rule[rule] = self.by_rule.get(rule,0) + 1
+            return agent
+
+        candidates = self.candidates(last_agent,groupchat.agents)
+        if not candidates:
+            return 'auto'
+        self.llm_rounds += 1
+        return self._by_llm(last_agent,messages,candidates)
+
+    def stats(self) -> Annotated[Dict[str,Any],"The routing counters"]:
+        """
+        Returns the rounds settled by each rule and by the LLM, and the LLM calls saved compared
+        to asking the LLM on every round
+        """
+        return {
+            'rounds': self.rounds,
+            'by_rule': dict(self.by_rule),
+            'llm_rounds': self.llm_rounds,
+            'llm_calls': self.llm_calls,
+            'llm_failed': self.llm_failed,
+            'llm_calls_saved': self.rounds - self.llm_rounds
+        }
+
+    def report(self) -> Annotated[str,"The routing counters as text"]:
+        """Returns the routing counters of the conversation as a line of text"""
+        stats = self.stats()
+        rules = ', '.join(f'{rule} {count}' for rule,count in sorted(stats['by_rule'].items())) or 'none'
+        return (f"Speaker routing: {stats['rounds']} rounds, {stats['rounds'] - stats['llm_rounds']} by rules ({rules}), "
+                f"{stats['llm_rounds']} by the LLM in {stats['llm_calls']} calls, {stats['llm_calls_saved']} LLM calls saved")
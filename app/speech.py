@@ -0,0 +1,246 @@
+import os
+import time
+import queue
+import atexit
+import itertools
+import threading
+from typing_extensions import Annotated,Optional
+
+# Text to speech on a long lived worker thread. The thread owns the one engine of the process and
+# speaks a queue of utterances in priority order, so speak_text returns at once and the engine is
+# only started once. The engine is opened on the worker thread, as pyttsx3 wants the thread that
+# created it to drive it.
+# Configuration (environment):
+#   TTS_BACKEND      pyttsx3 (default) or null, the null backend speaks nothing, for headless runs
+#   TTS_RATE         the words a minute, default 175
+#   TTS_VOICE        the index of the voice, 0 for male and 1 for female on most systems
+#   TTS_EXIT_WAIT    the seconds to let queued speech finish when the app exits, default 30
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+
+
+class Utterance:
+    """
+    A queued piece of speech, wait on it to block until it has been spoken or dropped
+    """
+
+    def __init__(self,text : Annotated[str,"The text to speak"],priority : Annotated[int,"Lower is spoken first"]):
+        self.text = text
+        self.priority = priority
+        self.spoken = False
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def finish(self,spoken : bool) -> None:
+        self.spoken = spoken
+        self.cancelled = not spoken
+        self._done.set()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self,timeout : Annotated[Optional[float],"The max seconds to wait"] = None) -> Annotated[bool,"If it was spoken"]:
+        """Blocks until the utterance has been spoken or dropped and returns if it was spoken"""
+        self._done.wait(timeout)
+        return self.spoken
+
+
+#==========================================BACKENDS================================================
+class SpeechBackend:
+    """
+    The engine the worker speaks with. open is called on the worker thread before the first
+    utterance, speak blocks until the text has been said and stop cuts the current one short
+    """
+
+    def open(self) -> None:
+        pass
+
+    def speak(self,text : str) -> None:
+        raise NotImplementedError
+
+    def stop(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class Pyttsx3Backend(SpeechBackend):
+    """Speaks through one pyttsx3 engine"""
+
+    def __init__(self,rate : Annotated[int,"The words a minute"] = 175,
+                 voice : Annotated[int,"The index of the voice"] = 0):
+        self.rate = rate
+        self.voice = voice
+        self.engine = None
+
+    def open(self) -> None:
+        import pyttsx3
+        self.engine = pyttsx3.init()
+        voices = self.engine.getProperty('voices')
+        if voices:
+            self.engine.setProperty('voice',voices[min(self.voice,len(voices) - 1)].id)
+        self.engine.setProperty('rate',self.rate)
+
+    def speak(self,text : str) -> None:
+        self.engine.say(text)
+        self.engine.runAndWait()
+
+    def stop(self) -> None:
+        if self.engine is not None:
+            self.engine.stop()
+
+
+class NullBackend(SpeechBackend):
+    """
+    Speaks nothing and keeps what it was asked to say, optionally taking some time per
+    character to stand in for a real engine
+    """
+
+    def __init__(self,seconds_per_char : Annotated[float,"The seconds each character takes"] = 0.0):
+        self.seconds_per_char = seconds_per_char
+        self.spoken = []
+        self._stopped = threading.Event()
+
+    def speak(self,text : str) -> None:
+        self._stopped.clear()
+        if self.seconds_per_char and self._stopped.wait(len(text) * self.seconds_per_char):
+            return
+        self.spoken.append(text)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def backend_from_env() -> SpeechBackend:
+    name = os.environ.get('TTS_BACKEND','pyttsx3')
+    if name == 'null':
+        return NullBackend()
+    if name == 'pyttsx3':
+        return Pyttsx3Backend(rate=int(os.environ.get('TTS_RATE','175')),voice=int(os.environ.get('TTS_VOICE','0')))
+    raise ValueError(f"Unknown TTS_BACKEND {name}")
+
+
+#==========================================WORKER==================================================
+class SpeechWorker:
+    """
+    A thread that owns a speech backend and speaks queued utterances, highest priority first
+    and in the order they were queued within a priority
+    """
+
+    def __init__(self,backend : Annotated[SpeechBackend,"The engine to speak with"]):
+        self.backend = backend
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._current = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._thread = threading.Thread(target=self._work,name='speech-worker',daemon=True)
+        self._thread.start()
+
+    def _work(self) -> None:
+        try:
+            self.backend.open()
+        except Exception as e:
+            print(f"Starting the speech engine failed due to {e}")
+            self.backend = NullBackend()
+        while True:
+            _,_,utterance = self._queue.get()
+            if utterance is None:
+                break
+            with self._lock:
+                self._current = utterance
+            spoken = False
+            try:
+                self.backend.speak(utterance.text)
+                spoken = True
+            except Exception as e:
+                print(f"Speaking failed due to {e}")
+            finally:
+                with self._lock:
+                    self._current = None
+                    #An interrupted utterance was already finished as cancelled
+                    if not utterance.done():
+                        utterance.finish(spoken)
+                    self._pending -= 1
+                    self._idle.notify_all()
+        self.backend.close()
+
+    def speak(self,text : Annotated[str,"The text to speak"],
+              priority : Annotated[int,"Lower is spoken first, PRIORITY_HIGH jumps the queue"] = PRIORITY_NORMAL
+              ) -> Annotated[Utterance,"The handle to wait on"]:
+        """Queues text to be spoken and returns at once"""
+        utterance = Utterance(text,priority)
+        with self._lock:
+            self._pending += 1
+        self._queue.put((priority,next(self._order),utterance))
+        return utterance
+
+    def flush(self) -> Annotated[int,"The utterances dropped"]:
+        """Drops every utterance that has not started yet"""
+        dropped = []
+        while True:
+            try:
+                _,_,utterance = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if utterance is None:
+                #Keep the close request
+                self._queue.put((float('inf'),next(self._order),None))
+                break
+            dropped.append(utterance)
+        with self._lock:
+            for utterance in dropped:
+                utterance.finish(False)
+            self._pending -= len(dropped)
+            self._idle.notify_all()
+        return len(dropped)
+
+    def interrupt(self) -> Annotated[int,"The utterances dropped"]:
+        """Drops the queued utterances and cuts the one being spoken short"""
+        dropped = self.flush()
+        with self._lock:
+            current = self._current
+            if current is not None:
+                current.finish(False)
+        if current is not None:
+            self.backend.stop()
+            dropped += 1
+        return dropped
+
+    def wait_idle(self,timeout : Annotated[Optional[float],"The max seconds to wait"] = None) -> Annotated[bool,"If the queue was emptied"]:
+        """Blocks until everything queued has been spoken or dropped"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def close(self,timeout : Annotated[Optional[float],"The max seconds to let queued speech finish"] = None) -> None:
+        """Lets the queued speech finish, or drops it after the timeout, and stops the thread"""
+        if not self.wait_idle(timeout):
+            self.interrupt()
+        self._queue.put((float('inf'),next(self._order),None))
+        self._thread.join(timeout)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_speech_worker() -> Annotated[SpeechWorker,"The speech worker of the process"]:
+    """
+    Returns the speech worker of this process, started with the backend from the environment
+    the first time it is asked for. Queued speech is given TTS_EXIT_WAIT seconds to finish at exit
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = SpeechWorker(backend_from_env())
+            atexit.register(_worker.close,float(os.environ.get('TTS_EXIT_WAIT','30')))
+        return _worker
@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import threading
+from typing_extensions import Annotated,Dict,List,Optional,Callable
+from typing import Any
+
+from speech import Utterance
+
+# Speaks a streamed completion a sentence at a time. autogen prints every streamed chunk through the
+# default IOStream, so SpeakingStream stands in for it while a reply is generated: the chunks are
+# still printed, and every finished sentence is handed to the speech worker while the rest of the
+# reply is being generated. The time to the first sentence and the time of the whole reply are
+# recorded for every reply
+# Configuration (environment):
+#   STREAM_REPLIES   1 to stream the replies of the speaking agents (default), 0 to wait for the whole reply
+#   STREAM_LOG       1 to print the timings of every streamed reply
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+# The end of a sentence, punctuation and the space after it, or a line break
+_SENTENCE_END = re.compile(r'(?<=[.!?])[\"\')\]]*\s+|\n+')
+
+
+class SentenceSplitter:
+    """
+    Cuts a stream of text chunks into sentences, holding back sentences shorter than
+    min_chars so a stray "1." or "Hi." is spoken with the text after it
+    """
+
+    def __init__(self,min_chars : Annotated[int,"The shortest piece of text spoken on its own"] = 20):
+        self.min_chars = min_chars
+        self._buffer = ''
+
+    def feed(self,text : Annotated[str,"The next chunk of the reply"]) -> Annotated[List[str],"The finished sentences"]:
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            sentence = self._buffer[start:match.end()].strip()
+            if len(sentence) >= self.min_chars:
+                sentences.append(sentence)
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> Annotated[Optional[str],"The text left after the last sentence"]:
+        rest = self._buffer.strip()
+        self._buffer = ''
+        return rest or None
+
+
+class SpeakingStream:
+    """
+    An autogen IOStream that passes everything on to another stream and speaks the streamed
+    chunks sentence by sentence, timing the reply from when the stream is created
+    """
+
+    def __init__(self,base : Annotated[Any,"The IOStream to print to, the console"],
+                 speak : Annotated[Callable[[str],Utterance],"Queues a sentence to be spoken"],
+                 on_reply : Annotated[Optional[Callable[[Dict[str,Any]],None]],"Called with the timings of the reply"] = None,
+                 min_chars : Annotated[int,"The shortest piece of text spoken on its own"] = 20):
+        self.base = base
+        self.speak = speak
+        self.on_reply = on_reply
+        self.splitter = SentenceSplitter(min_chars)
+        self.sentences = 0
+        self.started = time.perf_counter()
+        self.first_sentence = None
+        self._finished = False
+
+    def _say(self,sentence : str) -> None:
+        if self.first_sentence is None:
+            self.first_sentence = time.perf_counter() - self.started
+        self.sentences += 1
+        self.speak(sentence)
+
+    def print(self,*objects : Any,sep : str = " ",end : str = "\n",flush : bool = False) -> None:
+        self.base.print(*objects,sep=sep,end=end,flush=flush)
+        #The streamed chunks are the only prints without a line end, the rest is the chat log
+        if end == "" and not self._finished:
+            text = _ANSI.sub('',sep.join(str(item) for item in objects))
+            for sentence in self.splitter.feed(text):
+                self._say(sentence)
+
+    def input(self,prompt : str = "",*,password : bool = False) -> str:
+        return self.base.input(prompt,password=password)
+
+    def finish(self) -> Annotated[Dict[str,Any],"The timings of the reply"]:
+        """
+        Speaks the text after the last sentence and reports the timings of the reply
+        """
+        if not self._finished:
+            self._finished = True
+            rest = self.splitter.flush()
+            if rest:
+                self._say(rest)
+            self.timings = {
+                'sentences': self.sentences,
+                'first_sentence_seconds': self.first_sentence,
+                'total_seconds': time.perf_counter() - self.started
+            }
+            if self.on_reply is not None and self.sentences:
+                self.on_reply(self.timings)
+        return self.timings
+
+
+class ReplyTimings:
+    """
+    Collects the time to the first sentence and the total time of the streamed replies
+    """
+
+    def __init__(self,log : Annotated[bool,"Print the timings of every reply"] = False):
+        self.log = log
+        self._lock = threading.Lock()
+        self.replies = []
+
+    def record(self,timings : Annotated[Dict[str,Any],"The timings from SpeakingStream.finish"]) -> None:
+        with self._lock:
+            self.replies.append(timings)
+        if self.log:
+            print(f"Streamed reply: first sentence after {timings['first_sentence_seconds']:.2f}s, "
+                  f"whole reply after {timings['total_seconds']:.2f}s, {timings['sentences']} sentences")
+
+    def reset(self) -> None:
+        with self._lock:
+            self.replies = []
+
+    def stats(self) -> Annotated[Dict[str,Any],"The mean timings"]:
+        """
+        Returns the mean time to the first sentence and the mean total time of the replies
+        """
+        with self._lock:
+            replies = list(self.replies)
+        count = len(replies)
+        return {
+            'replies': count,
+            'mean_first_sentence_seconds': sum(reply['first_sentence_seconds'] for reply in replies) / count if count else 0.0,
+            'mean_total_seconds': sum(reply['total_seconds'] for reply in replies) / count if count else 0.0
+        }
+
+    def report(self) -> Annotated[str,"The mean timings as text"]:
+        """Returns the mean timings of the replies as a line of text"""
+        stats = self.stats()
+        return (f"Streamed replies: {stats['replies']}, first sentence after {stats['mean_first_sentence_seconds']:.2f}s "
+                f"on average, whole reply after {stats['mean_total_seconds']:.2f}s")
+
+
+reply_timings = ReplyTimings(log=os.environ.get('STREAM_LOG','1') == '1')
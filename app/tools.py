@@ -1,106 +1,89 @@
 import speech_recognition as sr
-import pyttsx3
-from groq import Groq
-from typing_extensions import Annotated
+from typing_extensions import Annotated,Optional
 from dotenv import load_dotenv
 import os
 
+from gateway import get_gateway,DEFAULT_SYSTEM_MESSAGE
+from llm_cache import get_cache,cache_key
+from speech import get_speech_worker,Utterance,PRIORITY_HIGH,PRIORITY_NORMAL
+
 env_path = "D:/ABRAR/1_PERSONAL/Wolf_Tech/Mazduur_AI/app/.env"
 load_dotenv(env_path)
 
+#Function to answer a call from the response cache, or ask the gateway and cache its answer
+#Only calls at temperature 0 are cached, a sampled answer is never replayed
+def _cached_chat(system_message: str, message: str, site: str, cache: bool,
+                 temperature: Optional[float] = None, model: str = "llama3-8b-8192") -> str:
+    options = {} if temperature is None else {'temperature': temperature}
+    llm_cache = get_cache()
+    if llm_cache is None:
+        return get_gateway().chat(system_message,message,model=model,site=site,**options)
+    if not cache or temperature != 0:
+        llm_cache.bypassed(site)
+        return get_gateway().chat(system_message,message,model=model,site=site,**options)
+
+    key = cache_key(model,system_message,message,temperature)
+    response = llm_cache.get(key,site)
+    if response is None:
+        response = get_gateway().chat(system_message,message,model=model,site=site,**options)
+        llm_cache.put(key,response,site)
+    return response
+
 #Tool to get response from an llm
-def use_llm(message: Annotated[str, "The message for the llm"]) -> Annotated[str, "The response from the llm"]:
+def use_llm(message: Annotated[str, "The message for the llm"],
+            site: Annotated[str, "The name of the caller, for the LLM accounting"] = 'use_llm',
+            cache: Annotated[bool, "Answer from the response cache, False for calls that must be asked again"] = True,
+            temperature: Annotated[Optional[float], "The sampling temperature, None for the provider default, only 0 is cached"] = None
+            ) -> Annotated[str, "The response from the llm"]:
     """
-    Use LLM to complete a particular task
+    Use LLM to complete a particular task, through the shared LLM gateway and response cache
 
     Returns:
         str: The LLM's response to the given task
     """
-    
-    client = Groq(
-        api_key=os.environ["GROQ_KEY"],
-    )
-    messages = [
-        {
-            'role': 'system',
-            'content': 'You are an assistant for solving NLP and Reasoning tasks, do not give any code in your response'
-        },
-        {
-            'role': 'user',
-            'content': message
-        }
-    ]
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="llama3-8b-8192",
-    )
-    response = chat_completion.choices[0].message.content
-
-    return response
-
-# Tool to get response from an llm
-
+    return _cached_chat(DEFAULT_SYSTEM_MESSAGE,message,site,cache,temperature)
 
+# Tool to get response from an llm with a custom system message
 def use_llm_naked(system_message: Annotated[str,"The system message for the llm"],
-                  message: Annotated[str, "The message for the llm"]
+                  message: Annotated[str, "The message for the llm"],
+                  site: Annotated[str, "The name of the caller, for the LLM accounting"] = 'use_llm_naked',
+                  cache: Annotated[bool, "Answer from the response cache, False for calls that must be asked again"] = True,
+                  temperature: Annotated[Optional[float], "The sampling temperature, None for the provider default, only 0 is cached"] = None
                   ) -> Annotated[str, "The response from the llm"]:
     """
-    Use LLM to complete a particular task
+    Use LLM to complete a particular task, through the shared LLM gateway and response cache
 
     Returns:
         str: The LLM's response to the given task
     """
-
-    client = Groq(
-        api_key=os.environ["GROQ_KEY"],
-    )
-    messages = [
-        {
-            'role': 'system',
-            'content': system_message
-        },
-        {
-            'role': 'user',
-            'content': message
-        }
-    ]
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="llama3-8b-8192",
-    )
-    response = chat_completion.choices[0].message.content
-
-    return response
+    return _cached_chat(system_message,message,site,cache,temperature)
 
 
 # Function to convert text to speech
-def speak_text(command:Annotated[str,"The text to convert to speech"]) -> None:
-    # Initialize the engine
-    engine = pyttsx3.init()
-    
-    voices = engine.getProperty('voices')  # getting details of current voice
-    # changing index, changes voices. 1 for female 0 for male
-    engine.setProperty('voice', voices[0].id)
-
-
-    # getting details of current speaking rate
-    rate = engine.getProperty('rate')
-    engine.setProperty('rate', 175)     # setting up new voice rate, default is 200
-    
-    engine.say(command)
-    engine.runAndWait()
-    return
+def speak_text(command:Annotated[str,"The text to convert to speech"],
+               priority:Annotated[int,"PRIORITY_HIGH to be spoken before the queued speech"] = PRIORITY_NORMAL,
+               wait:Annotated[bool,"Block until the text has been spoken"] = False) -> Annotated[Utterance,"The handle to wait on"]:
+    """
+    Queues the text on the speech worker and returns the handle of the utterance,
+    only blocking if wait is set
+    """
+    utterance = get_speech_worker().speak(command,priority)
+    if wait:
+        utterance.wait()
+    return utterance
 
 
 # Function to convert text to speech
 def recognize_speech() -> Annotated[str, "Returns the user spoken command"]:
     recog = sr.Recognizer()
+    #Let the question queued just before this be heard, and keep it out of the noise sample and the recording
+    get_speech_worker().wait_idle()
     try:
         with sr.Microphone() as source:
             # adjust for ambient noise
             recog.adjust_for_ambient_noise(source, duration=0.2)
 
-            speak_text("Start speaking now")
+            speak_text("Start speaking now",priority=PRIORITY_HIGH,wait=True)
             # listen to user
             audio = recog.listen(source)
 
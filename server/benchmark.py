@@ -0,0 +1,295 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from typing_extensions import Annotated,List,Dict,Optional,Callable
+from typing import Any
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+from load_test import post,get
+
+# A reproducible benchmark of the ingest and copy paths. It starts the server in a scratch directory
+# with its own SQLite DB and RSA keys, and use_llm replaced by a local fake with a fixed latency.
+# At every backlog size it measures /new_dm and paged /copy_dms at a fixed concurrency, then fills
+# the backlog up to the next size through /new_dms. The last step is one full /copy_dms per client.
+# The server takes its usual environment, so DM_STORE=sqlite or DM_ENCRYPTION=envelope can be compared
+# Usage (from the server directory):
+#   python benchmark.py --backlog 0 1000 10000 100000 --concurrency 8 --llm-latency 0.05
+#   python benchmark.py --backlog 0 1000 --save baseline.json
+#   python benchmark.py --backlog 0 1000 --compare baseline.json --tolerance 0.25
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Filler DMs come from a small set of messages, after the first copy of each one they are classified
+# from the classification cache so filling a big backlog does not wait on the fake LLM
+FILLER_MESSAGES = [
+    "Hey, love your page!",
+    "Is the blue dress available in medium?",
+    "How much is the leather bag?",
+    "I placed an order yesterday, order id 4411",
+    "Would you like to collaborate on a reel?",
+    "Do you ship to Pune?",
+    "Thanks for the quick delivery",
+    "Can I get the red one in size 8?"
+]
+NUMBERED_LINE = re.compile(r'^\s*(\d+): ',re.MULTILINE)
+
+
+#==========================================SERVER==================================================
+def fake_llm(latency : Annotated[float,"The seconds every call takes"]) -> Callable[[str],str]:
+    """
+    Returns a stand-in for use_llm that sleeps for latency and answers every numbered message of a
+    batch prompt, or a single label for a one message prompt
+    """
+    def use_llm(message : str) -> str:
+        time.sleep(latency)
+        numbers = NUMBERED_LINE.findall(message)
+        if numbers:
+            return '\n'.join(f"{number}: Intent" for number in numbers)
+        return 'Intent'
+    return use_llm
+
+
+def serve(port : Annotated[int,"The port to listen on"],latency : Annotated[float,"The fake LLM latency"]) -> None:
+    """
+    Runs the server with the fake LLM, this is what the benchmark starts in a child process
+    """
+    sys.path.insert(0,SERVER_DIR)
+    import helper
+    helper.use_llm = fake_llm(latency)
+    import classifier
+    classifier.use_llm = helper.use_llm
+    import uvicorn
+    import main
+    uvicorn.run(main.app,host='127.0.0.1',port=port,log_level='warning')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1',0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir : Annotated[str,"The scratch directory"],
+                 latency : Annotated[float,"The fake LLM latency"]) -> Annotated[tuple,"The process and its url"]:
+    """
+    Starts the server in workdir against a scratch DB and waits till it answers
+    """
+    port = free_port()
+    env = dict(os.environ)
+    env['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir,'db','benchmark.sqlite')}"
+    env.setdefault('GROQ_KEY','benchmark')
+    #the limiter, the request log and the compactor would blur the numbers, they can be turned back on
+    env.setdefault('INGEST_RATE','0')
+    env.setdefault('REQUEST_LOG','0')
+    env.setdefault('COMPACT_INTERVAL','0')
+    process = subprocess.Popen([sys.executable,os.path.join(SERVER_DIR,'benchmark.py'),'--serve','--port',str(port),
+                                '--llm-latency',str(latency)],cwd=workdir,env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with {process.returncode}")
+        try:
+            if get(f'{url}/stats/clients') == 200:
+                return process,url
+        except (urllib.error.URLError,ConnectionError):
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The server did not start in 60 seconds")
+
+#==========================================DRIVER==================================================
+def percentile(latencies : Annotated[List[float],"Sorted latencies"],p : Annotated[float,"0 to 100"]) -> float:
+    # Nearest rank
+    if not latencies:
+        return 0.0
+    return latencies[max(0,min(len(latencies) - 1,math.ceil(p / 100 * len(latencies)) - 1))]
+
+
+def summarize(name : str,backlog : int,latencies : List[float],elapsed : float,failed : int) -> Dict[str,Any]:
+    latencies = sorted(latencies)
+    return {
+        'op': name,
+        'backlog': backlog,
+        'requests': len(latencies),
+        'failed': failed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies,50) * 1000,
+        'p95_ms': percentile(latencies,95) * 1000,
+        'p99_ms': percentile(latencies,99) * 1000
+    }
+
+
+def drive(total : Annotated[int,"The number of requests"],
+          concurrency : Annotated[int,"The requests in flight"],
+          send : Annotated[Callable[[int],int],"Sends request number n and returns its status"]) -> tuple:
+    """
+    Sends total requests with concurrency of them in flight, returns the latencies, seconds and failures
+    """
+    def slot(index : int) -> List[tuple]:
+        results = []
+        for number in range(index,total,concurrency):
+            start = time.perf_counter()
+            status = send(number)
+            results.append((time.perf_counter() - start,status))
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [result for slot_results in pool.map(slot,range(concurrency)) for result in slot_results]
+    elapsed = time.perf_counter() - start
+    return [latency for latency,_ in results],elapsed,sum(1 for _,status in results if status != 200)
+
+
+def create_clients(url : str,workdir : str,count : int) -> Dict[str,Any]:
+    """
+    Writes a fresh public key for every benchmark client and creates them one after the other
+    """
+    keys_dir = os.path.join(workdir,'db','public_keys')
+    client_ids = [f'bench_{index}' for index in range(count)]
+    for client_id in client_ids:
+        private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+        with open(os.path.join(keys_dir,f'{client_id}.pem'),'wb') as file:
+            file.write(private_key.public_key().public_bytes(
+                serialization.Encoding.PEM,serialization.PublicFormat.SubjectPublicKeyInfo))
+    send = lambda number:post(f'{url}/create_client',
+                              {'client_name':client_ids[number],'client_id':client_ids[number],'business_name':'benchmark'})
+    latencies,elapsed,failed = drive(count,1,send)
+    return client_ids,summarize('create_client',0,latencies,elapsed,failed)
+
+
+def fill(url : str,client_ids : List[str],count : int,offset : int,batch : int) -> None:
+    """
+    Adds count filler DMs spread over the clients through /new_dms
+    """
+    def send(number : int) -> int:
+        client_id = client_ids[number % len(client_ids)]
+        start = offset + number * batch
+        size = min(batch,offset + count - start)
+        items = [{'insta_id':f'filler_{start + index}','message':FILLER_MESSAGES[(start + index) % len(FILLER_MESSAGES)]}
+                 for index in range(size)]
+        return post(f'{url}/new_dms/{client_id}',items)
+    _,_,failed = drive(math.ceil(count / batch),len(client_ids),send)
+    if failed:
+        print(f"{failed} fill batches failed")
+
+
+def wait_for_classifier(url : str,timeout : float = 600.0) -> None:
+    # Reads are only measured once nothing is pending, a page stops at a DM still being classified
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with urllib.request.urlopen(f'{url}/stats/classifier') as response:
+            stats = json.loads(response.read())
+        if stats['pending'] == 0 and stats['depth'] == 0 and stats['deferred'] == 0:
+            return
+        time.sleep(0.2)
+    print("The classifier did not catch up, reads may stop at pending DMs")
+
+
+def run(backlogs : List[int],clients : int,concurrency : int,requests : int,page_size : int,
+        latency : float,batch : int,keep : bool) -> List[Dict[str,Any]]:
+    workdir = tempfile.mkdtemp(prefix='mazduur_benchmark_')
+    os.makedirs(os.path.join(workdir,'db','data_bins'))
+    os.makedirs(os.path.join(workdir,'db','public_keys'))
+    process,url = start_server(workdir,latency)
+    results = []
+    try:
+        client_ids,created = create_clients(url,workdir,clients)
+        results.append(created)
+        backlog = 0
+        sent = 0
+        for target in sorted(backlogs):
+            if target > backlog:
+                fill(url,client_ids,target - backlog,backlog,batch)
+                backlog = target
+            wait_for_classifier(url)
+
+            send = lambda number:get(f'{url}/copy_dms/{client_ids[number % len(client_ids)]}'
+                                     f'?page_size={page_size}&cursor=0&pending=skip')
+            results.append(summarize('copy_dms_page',backlog,*drive(requests,concurrency,send)))
+
+            def send(number : int) -> int:
+                return post(f'{url}/new_dm/{client_ids[number % len(client_ids)]}',
+                            {'insta_id':f'bench_user_{sent + number}','message':f'Is item {sent + number} still in stock?'})
+            results.append(summarize('new_dm',backlog,*drive(requests,concurrency,send)))
+            sent += requests
+            backlog += requests
+
+        wait_for_classifier(url)
+        send = lambda number:get(f'{url}/copy_dms/{client_ids[number]}?pending=skip')
+        results.append(summarize('copy_dms_full',backlog,*drive(len(client_ids),min(concurrency,len(client_ids)),send)))
+    finally:
+        process.terminate()
+        process.wait()
+        if keep:
+            print(f"Kept the benchmark directory {workdir}")
+        else:
+            shutil.rmtree(workdir,ignore_errors=True)
+    return results
+
+
+def compare(results : List[Dict[str,Any]],baseline : List[Dict[str,Any]],tolerance : float) -> List[str]:
+    """
+    Returns the ops whose p95 got slower or whose throughput dropped by more than tolerance
+    """
+    regressions = []
+    previous = {(result['op'],result['backlog']):result for result in baseline}
+    for result in results:
+        before = previous.get((result['op'],result['backlog']))
+        if before is None:
+            continue
+        if before['p95_ms'] and result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{result['op']} at {result['backlog']}: p95 {before['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms")
+        if before['throughput'] and result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{result['op']} at {result['backlog']}: {before['throughput']:.1f} -> {result['throughput']:.1f} req/s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and throughput of the server as the DM backlog grows")
+    parser.add_argument('--backlog',type=int,nargs='+',default=[0,1000,10000,100000],help="The backlog sizes to measure at")
+    parser.add_argument('--clients',type=int,default=8,help="The backlog is spread over this many clients")
+    parser.add_argument('--concurrency',type=int,default=8,help="The requests in flight while measuring")
+    parser.add_argument('--requests',type=int,default=200,help="The requests of every measured op at every backlog size")
+    parser.add_argument('--page-size',type=int,default=100)
+    parser.add_argument('--llm-latency',type=float,default=0.05,help="The seconds every fake LLM call takes")
+    parser.add_argument('--fill-batch',type=int,default=500,help="The DMs per /new_dms call while filling")
+    parser.add_argument('--save',help="Write the results to this JSON file")
+    parser.add_argument('--compare',help="A JSON file from --save to check the results against")
+    parser.add_argument('--tolerance',type=float,default=0.25,help="The slowdown allowed by --compare")
+    parser.add_argument('--keep',action='store_true',help="Keep the scratch directory")
+    parser.add_argument('--serve',action='store_true',help=argparse.SUPPRESS)
+    parser.add_argument('--port',type=int,default=0,help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port,args.llm_latency)
+        sys.exit(0)
+
+    results = run(args.backlog,args.clients,args.concurrency,args.requests,args.page_size,
+                  args.llm_latency,args.fill_batch,args.keep)
+    print(f"{'op':>14} {'backlog':>8} {'requests':>8} {'failed':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        print(f"{result['op']:>14} {result['backlog']:>8} {result['requests']:>8} {result['failed']:>6} {result['throughput']:>9.1f} "
+              f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}")
+    if args.save:
+        with open(args.save,'w') as file:
+            json.dump(results,file,indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results,json.load(file),args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
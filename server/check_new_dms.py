@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import urllib.request
+import urllib.error
+from typing_extensions import Annotated,List
+from typing import Any
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+from benchmark import start_server
+
+# Checks that one bad DM in a /new_dms batch fails on its own. The batch mixes valid DMs with one
+# too long for RSA records, and the response must be a 200 with the valid DMs stored, the long one
+# failed with its error, and the long one still failing, not a duplicate, when it is sent again.
+# The server runs in a scratch directory with the fake LLM of the benchmark
+# Usage (from the server directory):
+#   python check_new_dms.py
+
+
+def post_json(url : Annotated[str,"The endpoint"],body : Annotated[Any,"The JSON body"]) -> Annotated[tuple,"The status code and the response"]:
+    request = urllib.request.Request(url,data=json.dumps(body).encode(),headers={'Content-Type':'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status,json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code,json.loads(e.read())
+
+
+def get_json(url : Annotated[str,"The endpoint"]) -> Annotated[tuple,"The status code and the response"]:
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status,json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code,json.loads(e.read())
+
+
+def create_client(url : str,workdir : str,client_id : str) -> None:
+    private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+    with open(os.path.join(workdir,'db','public_keys',f'{client_id}.pem'),'wb') as file:
+        file.write(private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,serialization.PublicFormat.SubjectPublicKeyInfo))
+    status,content = post_json(f'{url}/create_client',{'client_name':client_id,'client_id':client_id,'business_name':'check'})
+    if status != 200:
+        raise RuntimeError(f"Creating {client_id} failed with {status} {content}")
+
+
+def check_mixed_batch(url : Annotated[str,"The server url"],client_id : Annotated[str,"A client without DMs"]) -> List[str]:
+    """
+    Sends a batch with one DM too long for an RSA record between valid ones, returns what went wrong
+    """
+    problems = []
+    items = [
+        {'insta_id':'check_user_0','message':'Is the blue dress available in medium?'},
+        {'insta_id':'check_user_1','message':'x' * 300},
+        {'insta_id':'check_user_2','message':'Do you ship to Pune?'}
+    ]
+    status,content = post_json(f'{url}/new_dms/{client_id}',items)
+    if status != 200:
+        return [f"The batch got {status} {content}"]
+    statuses = [item['status'] for item in content['items']]
+    if statuses != ['ok','failed','ok']:
+        problems.append(f"The items got {statuses}, expected ['ok', 'failed', 'ok']")
+    if not content['items'][1].get('error'):
+        problems.append("The long DM has no error")
+    if (content['accepted'],content['duplicates'],content['failed']) != (2,0,1):
+        problems.append(f"The counts are {content['accepted']} accepted, {content['duplicates']} duplicates, {content['failed']} failed")
+
+    status,content = get_json(f'{url}/sync_dms/{client_id}?pending=wait')
+    if status != 200 or len(content['db_details']) != 2:
+        problems.append(f"sync_dms got {status} with {len(content.get('db_details',[]))} DMs, expected the 2 valid ones")
+
+    #the claim of the failed DM was let go, so it is tried again and not taken for a copy
+    status,content = post_json(f'{url}/new_dms/{client_id}',items[1:2])
+    if status != 200 or content['items'][0]['status'] != 'failed':
+        problems.append(f"Sending the long DM again got {status} {content}")
+    return problems
+
+
+def run(keep : bool) -> List[str]:
+    workdir = tempfile.mkdtemp(prefix='mazduur_check_')
+    os.makedirs(os.path.join(workdir,'db','data_bins'))
+    os.makedirs(os.path.join(workdir,'db','public_keys'))
+    os.environ['DM_ENCRYPTION'] = 'rsa'
+    process,url = start_server(workdir,0.0)
+    try:
+        create_client(url,workdir,'check_mixed')
+        return check_mixed_batch(url,'check_mixed')
+    finally:
+        process.terminate()
+        process.wait()
+        if keep:
+            print(f"Kept the check directory {workdir}")
+        else:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that a bad DM in a /new_dms batch does not fail the batch")
+    parser.add_argument('--keep',action='store_true',help="Keep the scratch directory")
+    args = parser.parse_args()
+
+    problems = run(args.keep)
+    for problem in problems:
+        print(f"FAILED {problem}")
+    print("OK" if not problems else f"{len(problems)} problems")
+    sys.exit(1 if problems else 0)
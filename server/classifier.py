@@ -0,0 +1,540 @@
+import re
+import json
+import time
+import queue
+import hashlib
+import datetime
+import threading
+import traceback
+import unicodedata
+from collections import OrderedDict,deque
+from typing_extensions import Annotated,Dict,List,Set,Tuple,Callable,Optional
+from typing import Any
+
+from helper import use_llm
+from models import Classification_Cache
+from metrics import metrics
+
+#==========================================CLASSIFIER==============================================
+CLASS_DEFINITIONS = """
+    Casual: A normal message not enquiring about any product
+    Intent: A message that might have a mention of any product or item name
+    Desire: A message that may contain more details than just the name of the item or shows high desire to buy something
+    Order: A message that conveys that the user has ordered an item already or sending details to process an order
+    Collaboration: A message that may indicate that the user wants to collaborate on some project or deal
+"""
+
+# Matches one answer line of a batch prompt, for eg "3: Order" or "3. order"
+BATCH_ANSWER = re.compile(r'^\s*\[?(\d+)\]?\s*[:.)\-]\s*\**\s*([A-Za-z]+)',re.MULTILINE)
+
+batch_counters = {'batch_calls':0,'batched_messages':0,'fallback_messages':0}
+_counter_lock = threading.Lock()
+
+
+def parse_label(response : Annotated[str,"The LLM response"]) -> Annotated[str,"The class label"]:
+    """
+    Picks the class label out of an LLM response
+
+    Args:
+        response (str): The LLM response for a message
+
+    Returns:
+        str: One of Casual, Intent, Desire, Order, Collaboration or None if no class was found
+    """
+    response = response.lower()
+    if 'casual' in response:
+        return 'Casual'
+    elif 'intent' in response:
+        return 'Intent'
+    elif 'desire' in response:
+        return 'Desire'
+    elif 'order' in response:
+        return 'Order'
+    elif 'collaboration' in response:
+        return 'Collaboration'
+    else:
+        return 'None'
+
+#Function to classify dm
+def classify_dm(message : Annotated[str,"The message that the user sent"]
+                ) -> Annotated[str,"The classification for the message"]:
+    """
+    Classifies a DM sent to a client
+
+    Args:
+        message (str): The message received by the client
+
+    Returns
+        str: The class label of the message
+                Casual: A normal message not enquiring about any product
+                Intent: A message that might have a mention of any product or item name
+                Desire: A message that may contain more details than just the name of the item or shows high desire to buy something
+                Order: A message that conveys that the user has ordered an item already or sending details to process an order
+                Collaboration: A message that may indicate that the user wants to collaborate on some project or deal     
+    """
+    
+    try:
+        response = use_llm(
+            f"""
+    The following message is from a person on instagram. I want you to classify this message for my business
+    There are five classes in which you can put this message in
+    {CLASS_DEFINITIONS}
+    The user message is: {message}
+
+    Your answer must only be the class and nothing else
+    """
+        )
+
+        print(response)
+        return parse_label(response)
+    except Exception as e:
+        print(e)
+        return 'None'
+
+#Function to classify many dms with one llm call
+def classify_dms(messages : Annotated[List[str],"The messages that the users sent"]
+                 ) -> Annotated[List[str],"The classification for each message"]:
+    """
+    Classifies a batch of DMs with a single LLM call. The messages are numbered in the prompt
+    and the answer is parsed back per number, every message whose answer is missing or
+    not a known class is classified again on its own with classify_dm
+
+    Args:
+        messages (List[str]): The messages received by the clients
+
+    Returns:
+        List[str]: The class label of each message, in the same order as messages
+    """
+    if len(messages) == 1:
+        return [classify_dm(messages[0])]
+
+    labels = [None] * len(messages)
+    numbered = '\n    '.join(f"{i}: {json.dumps(message,ensure_ascii=False)}" for i,message in enumerate(messages,1))
+    try:
+        response = use_llm(
+            f"""
+    The following numbered messages are from people on instagram. I want you to classify each message for my business
+    There are five classes in which you can put a message in
+    {CLASS_DEFINITIONS}
+    The user messages are:
+    {numbered}
+
+    Your answer must have one line per message in the format <number>: <class> and nothing else
+    """
+        )
+        for number,label in BATCH_ANSWER.findall(response):
+            index = int(number) - 1
+            label = parse_label(label)
+            if 0 <= index < len(labels) and labels[index] is None and label != 'None':
+                labels[index] = label
+    except Exception as e:
+        print(e)
+
+    missing = [i for i,label in enumerate(labels) if label is None]
+    with _counter_lock:
+        batch_counters['batch_calls'] += 1
+        batch_counters['batched_messages'] += len(messages)
+        batch_counters['fallback_messages'] += len(missing)
+    for i in missing:
+        labels[i] = classify_dm(messages[i])
+    return labels
+
+
+#==========================================CACHE===================================================
+def normalize_message(message : Annotated[str,"The message that the user sent"]) -> Annotated[str,"The normalized message"]:
+    """
+    Case folds a message, turns punctuation into spaces and collapses whitespace,
+    so "Price??" and "price" are the same message. Emoji are kept as they are
+
+    Args:
+        message (str): The message received by the client
+
+    Returns:
+        str: The normalized message
+    """
+    text = ''.join(' ' if unicodedata.category(char).startswith('P') else char for char in message.casefold())
+    return ' '.join(text.split())
+
+
+def message_hash(message : Annotated[str,"The message that the user sent"]) -> Annotated[str,"The hex digest"]:
+    """Returns the sha256 hex digest of the normalized message"""
+    return hashlib.sha256(normalize_message(message).encode()).hexdigest()
+
+
+class ClassificationCache:
+    """
+    A TTL and size bounded LRU cache of class labels keyed by the hash of the normalized message.
+    With a session factory the labels are also kept in the Classification_Cache_Table,
+    so they outlive a restart. Only hashes are stored, never the message
+    """
+
+    def __init__(self,
+                 max_size : Annotated[int,"The max number of labels kept in memory"] = 10000,
+                 ttl : Annotated[float,"The seconds a label stays valid"] = 7 * 24 * 3600,
+                 session_factory : Annotated[Any,"A sessionmaker to persist labels with"] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.Session = session_factory
+        self._labels = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def get(self,message : Annotated[str,"The message that the user sent"]) -> Annotated[Optional[str],"The cached label or None"]:
+        """
+        Looks up the label of a message, first in memory and then on disk
+
+        Args:
+            message (str): The message received by the client
+
+        Returns:
+            Optional[str]: The cached class label, or None on a miss
+        """
+        key = message_hash(message)
+        now = time.time()
+        with self._lock:
+            entry = self._labels.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._labels.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._labels[key]
+
+        label = self._get_persisted(key,now)
+        with self._lock:
+            if label is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._remember(key,label,now)
+        return label
+
+    def put(self,message : Annotated[str,"The message that the user sent"],
+            label : Annotated[str,"The class label of the message"]) -> None:
+        """
+        Caches the label of a message, failed classifications (None) are not cached
+        """
+        if label == 'None':
+            return
+        key = message_hash(message)
+        self._remember(key,label,time.time())
+        if self.Session is not None:
+            session = self.Session()
+            try:
+                session.merge(Classification_Cache(message_hash=key,intent=label,created_time=datetime.datetime.now()))
+                session.commit()
+            except Exception as e:
+                print(f"Could not persist classification due to {e}")
+            finally:
+                session.close()
+
+    def _remember(self,key : str,label : str,now : float) -> None:
+        with self._lock:
+            self._labels[key] = (label,now + self.ttl)
+            self._labels.move_to_end(key)
+            while len(self._labels) > self.max_size:
+                self._labels.popitem(last=False)
+
+    def _get_persisted(self,key : str,now : float) -> Optional[str]:
+        if self.Session is None:
+            return None
+        session = self.Session()
+        try:
+            row = session.query(Classification_Cache).filter(Classification_Cache.message_hash == key).first()
+            if row is None:
+                return None
+            if row.created_time.timestamp() + self.ttl <= now:
+                session.delete(row)
+                session.commit()
+                return None
+            return row.intent
+        finally:
+            session.close()
+
+    def stats(self) -> Annotated[Dict[str,Any],"The cache counters"]:
+        """
+        Returns the size and hit rate of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._labels),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'persistent': self.Session is not None,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+#==========================================QUEUE===================================================
+# How long an idle worker waits for a new job before it takes deferred jobs
+IDLE_POLL = 0.5
+
+class ClassificationJob:
+    """
+    A DM that has been stored with a pending intent and is waiting to be classified
+
+    Args:
+        client_id (str): The id of the client who got the message
+        seq (int): The sequence number of the stored record
+        message (str): The plain text message to classify
+        on_done (Callable[[str],None]): Called with the class label once the message is classified
+    """
+
+    def __init__(self,client_id : str,seq : int,message : str,on_done : Callable[[str],None]):
+        self.client_id = client_id
+        self.seq = seq
+        self.message = message
+        self.on_done = on_done
+        self.enqueued_at = time.monotonic()
+
+
+class ClassificationQueue:
+    """
+    A bounded pool of background worker threads that classify stored DMs,
+    so new_dm can return before the LLM does.
+    Deferred jobs, from clients over their rate, are picked up when the queue is empty, or ahead of
+    the queued jobs once they have waited max_defer seconds, so steady traffic cannot starve them.
+    It keeps track of which records of each client are still pending
+    """
+
+    def __init__(self,
+                 workers : Annotated[int,"The number of worker threads"] = 4,
+                 max_size : Annotated[int,"The max number of queued jobs"] = 10000,
+                 batch_size : Annotated[int,"The max number of messages per LLM call"] = 8,
+                 batch_wait : Annotated[float,"The max seconds to hold a job while filling a batch"] = 0.2,
+                 max_defer : Annotated[float,"The max seconds a deferred job waits for the queue to go idle"] = 10.0,
+                 classify : Annotated[Callable[[List[str]],List[str]],"The function that labels a batch of messages"] = classify_dms,
+                 cache : Annotated[Optional[ClassificationCache],"The cache of labels to check before the LLM"] = None):
+        self.workers = workers
+        self.cache = cache
+        self.batch_size = max(1,batch_size)
+        self.batch_wait = batch_wait
+        self.max_defer = max_defer
+        self.classify = classify
+        self._queue = queue.Queue(maxsize=max_size)
+        self._deferred = deque()
+        self.max_deferred = max_size
+        self._threads = []
+        self._pending = {}
+        self._cond = threading.Condition()
+        # Only one idle worker fills a batch at a time, so jobs are not spread thin over workers
+        self._collect_lock = threading.Lock()
+        self.processed = 0
+        self.batches = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self) -> None:
+        """Starts the worker threads"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,name=f"classifier-{i}",daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Stops the worker threads once the jobs already queued and the deferred ones are done"""
+        #Deferred jobs go ahead of the stop signals, or their records would never get an intent
+        with self._cond:
+            deferred = list(self._deferred)
+            self._deferred.clear()
+        for job in deferred:
+            self._queue.put(job)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self,job : Annotated[ClassificationJob,"The job to classify"]) -> Annotated[bool,"True if queued"]:
+        """
+        Queues a job without blocking
+
+        Args:
+            job (ClassificationJob): The job to classify
+
+        Returns:
+            bool: True if the job was queued, False if the queue is full
+        """
+        with self._cond:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self._pending.setdefault(job.client_id,{})[job.seq] = job.enqueued_at
+            return True
+
+    def defer(self,job : Annotated[ClassificationJob,"The job to classify later"]) -> Annotated[bool,"True if deferred"]:
+        """
+        Keeps a job aside till the workers have nothing else to do, or for at most max_defer seconds
+
+        Args:
+            job (ClassificationJob): The job to classify
+
+        Returns:
+            bool: True if the job was kept, False if there are already max_size deferred jobs
+        """
+        with self._cond:
+            if len(self._deferred) >= self.max_deferred:
+                self.rejected += 1
+                return False
+            self._deferred.append(job)
+            self._pending.setdefault(job.client_id,{})[job.seq] = job.enqueued_at
+            return True
+
+    def _take_deferred(self,overdue : bool = False) -> List[ClassificationJob]:
+        # Takes up to a batch of deferred jobs, oldest first, only the ones older than max_defer if overdue
+        with self._cond:
+            batch = []
+            now = time.monotonic()
+            while self._deferred and len(batch) < self.batch_size:
+                if overdue and now - self._deferred[0].enqueued_at < self.max_defer:
+                    break
+                batch.append(self._deferred.popleft())
+            return batch
+
+    def _next_batch(self) -> Tuple[List[ClassificationJob],bool]:
+        # Starts with the deferred jobs older than max_defer, else blocks for one job, then keeps
+        # collecting till the batch is full or batch_wait runs out.
+        # Deferred jobs are also taken when no job comes in for IDLE_POLL seconds.
+        # Returns the batch and whether a stop signal was seen
+        batch = self._take_deferred(overdue=True)
+        if not batch:
+            while True:
+                try:
+                    job = self._queue.get(timeout=IDLE_POLL)
+                    break
+                except queue.Empty:
+                    batch = self._take_deferred()
+                    if batch:
+                        return batch,False
+            if job is None:
+                return [],True
+            batch = [job]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                return batch,True
+            batch.append(job)
+        return batch,False
+
+    def _work(self) -> None:
+        stop = False
+        while not stop:
+            with self._collect_lock:
+                batch,stop = self._next_batch()
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                labels = self._classify_batch([job.message for job in batch])
+            except Exception:
+                traceback.print_exc()
+                labels = ['None'] * len(batch)
+            with self._cond:
+                self.batches += 1
+            for job,label in zip(batch,labels):
+                try:
+                    job.on_done(label)
+                except Exception:
+                    traceback.print_exc()
+                    with self._cond:
+                        self.failed += 1
+                finally:
+                    self._finish(job,started - job.enqueued_at)
+
+    def _classify_batch(self,messages : List[str]) -> List[str]:
+        # Answers repeats from the cache and sends every distinct message to the LLM once
+        if self.cache is None:
+            with metrics.timer('classify_llm'):
+                return self.classify(messages)
+        keys = [normalize_message(message) for message in messages]
+        labels = {}
+        misses = {}
+        for key,message in zip(keys,messages):
+            if key not in labels:
+                labels[key] = self.cache.get(message)
+                if labels[key] is None:
+                    misses[key] = message
+        if misses:
+            with metrics.timer('classify_llm'):
+                classified = self.classify(list(misses.values()))
+            for (key,message),label in zip(misses.items(),classified):
+                labels[key] = label
+                self.cache.put(message,label)
+        return [labels[key] for key in keys]
+
+    def _finish(self,job : ClassificationJob,wait : float) -> None:
+        with self._cond:
+            client_pending = self._pending.get(job.client_id,{})
+            client_pending.pop(job.seq,None)
+            if not client_pending:
+                self._pending.pop(job.client_id,None)
+            self.processed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait,wait)
+            self._cond.notify_all()
+
+    def pending_seqs(self,client_id : Annotated[str,"The client ID"]) -> Annotated[Set[int],"The pending record sequence numbers"]:
+        """
+        Returns the sequence numbers of a client's records that are still waiting for an intent
+        """
+        with self._cond:
+            return set(self._pending.get(client_id,{}))
+
+    def wait_for_client(self,client_id : Annotated[str,"The client ID"],
+                        timeout : Annotated[float,"The max seconds to wait"]) -> Annotated[bool,"True if nothing is pending"]:
+        """
+        Blocks until every queued job of a client is done or the timeout runs out
+
+        Args:
+            client_id (str): The id of the client
+            timeout (float): The max number of seconds to wait
+
+        Returns:
+            bool: True if the client has no pending jobs left
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: client_id not in self._pending,timeout=timeout)
+
+    def stats(self) -> Annotated[Dict[str,Any],"The queue depth and age metrics"]:
+        """
+        Returns the depth of the queue, the age of the oldest pending job and the worker counters
+        """
+        with self._cond:
+            now = time.monotonic()
+            enqueued = [at for client_pending in self._pending.values() for at in client_pending.values()]
+            return {
+                'depth': self._queue.qsize(),
+                'deferred': len(self._deferred),
+                'pending': len(enqueued),
+                'oldest_age_seconds': now - min(enqueued) if enqueued else 0.0,
+                'workers': self.workers,
+                'batch_size': self.batch_size,
+                'batch_wait_seconds': self.batch_wait,
+                'max_defer_seconds': self.max_defer,
+                'processed': self.processed,
+                'batches': self.batches,
+                'avg_batch_size': self.processed / self.batches if self.batches else 0.0,
+                'llm_batch_calls': batch_counters['batch_calls'],
+                'llm_batch_fallbacks': batch_counters['fallback_messages'],
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'avg_wait_seconds': self.total_wait / self.processed if self.processed else 0.0,
+                'max_wait_seconds': self.max_wait
+            }
@@ -0,0 +1,188 @@
+import datetime
+import threading
+from typing_extensions import Annotated,Dict,List,Optional,Callable
+from typing import Any
+
+from models import ClientID_Table,LastUpdate
+
+
+class ClientRegistry:
+    """
+    An in-memory copy of ClientID_Table and LastUpdate indexed by client_id, so the hot paths
+    resolve a client without going to the DB. New clients and sync updates are written through
+    to the DB. A client_id that is not in memory is looked up in the DB once, it may have been
+    created by another process
+    """
+
+    def __init__(self,session_factory : Annotated[Callable,"The sessionmaker of the DB"]):
+        self.session_factory = session_factory
+        self._clients = {}
+        self._sync = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+
+    def load(self) -> Annotated[int,"The number of clients loaded"]:
+        """
+        Loads every client and its sync record from the DB, replacing what is in memory
+        """
+        session = self.session_factory()
+        try:
+            clients = {client.client_id:client for client in session.query(ClientID_Table).all()}
+            sync = {row.client_id:self._sync_state(row) for row in session.query(LastUpdate).all()}
+            session.expunge_all()
+        finally:
+            session.close()
+        with self._lock:
+            self._clients = clients
+            self._sync = sync
+            self.loaded = len(clients)
+        return len(clients)
+
+    def clients(self) -> Annotated[List[ClientID_Table],"All the clients in memory"]:
+        with self._lock:
+            return list(self._clients.values())
+
+    def get(self,client_id : Annotated[str,"The client ID"]) -> Annotated[Optional[ClientID_Table],"The client or None"]:
+        """
+        Gets a client from memory, falling back to the DB if it is not there
+
+        Args:
+            client_id (str): The client's id
+
+        Returns:
+            Optional[ClientID_Table]: The client, or None if the id does not exist
+        """
+        with self._lock:
+            client = self._clients.get(client_id)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+
+        session = self.session_factory()
+        try:
+            client = session.query(ClientID_Table).filter(ClientID_Table.client_id == client_id).first()
+            if client is None:
+                return None
+            session.expunge(client)
+        finally:
+            session.close()
+        with self._lock:
+            self._clients.setdefault(client_id,client)
+        return client
+
+    def add(self,client : Annotated[ClientID_Table,"The new client"]) -> None:
+        """
+        Saves a new client in the DB and then in memory
+        """
+        session = self.session_factory()
+        try:
+            session.add(client)
+            session.commit()
+            session.refresh(client)
+            session.expunge(client)
+        finally:
+            session.close()
+        with self._lock:
+            self._clients[client.client_id] = client
+
+    def update(self,client_id : Annotated[str,"The client ID"],**fields) -> Annotated[Optional[ClientID_Table],"The updated client or None"]:
+        """
+        Changes columns of a client in the DB and then in memory
+
+        Args:
+            client_id (str): The client's id
+            **fields: The columns to change and their new values
+
+        Returns:
+            Optional[ClientID_Table]: The updated client, or None if the id does not exist
+        """
+        session = self.session_factory()
+        try:
+            client = session.query(ClientID_Table).filter(ClientID_Table.client_id == client_id).first()
+            if client is None:
+                return None
+            for field,value in fields.items():
+                setattr(client,field,value)
+            session.commit()
+            session.refresh(client)
+            session.expunge(client)
+        finally:
+            session.close()
+        with self._lock:
+            self._clients[client_id] = client
+        return client
+
+    #==========================================SYNC RECORDS========================================
+    @staticmethod
+    def _sync_state(row : Optional[LastUpdate]) -> Dict[str,Any]:
+        if row is None:
+            return {'last_updated_time':None,'last_delivered_seq':0,'last_acked_seq':0}
+        return {
+            'last_updated_time':row.last_updated_time,
+            'last_delivered_seq':row.last_delivered_seq or 0,
+            'last_acked_seq':row.last_acked_seq or 0
+        }
+
+    def sync_state(self,client_id : Annotated[str,"The client ID"]) -> Annotated[Dict[str,Any],"The sync record"]:
+        """
+        Returns a copy of the last updated time, last delivered seq and last acknowledged seq of a client
+        """
+        with self._lock:
+            return dict(self._sync.get(client_id) or self._sync_state(None))
+
+    def refresh_sync(self,client_id : Annotated[str,"The client ID"]) -> Annotated[Dict[str,Any],"The sync record"]:
+        """
+        Reads the sync record of a client from the DB again, for when another process may have changed it
+        """
+        session = self.session_factory()
+        try:
+            state = self._sync_state(session.query(LastUpdate).filter(LastUpdate.client_id == client_id).first())
+        finally:
+            session.close()
+        with self._lock:
+            self._sync[client_id] = state
+            return dict(state)
+
+    def _update_sync(self,client_id : str,field : str,seq : int) -> None:
+        # The DB keeps the max of what every process wrote, memory keeps what the DB has
+        session = self.session_factory()
+        try:
+            row = session.query(LastUpdate).filter(LastUpdate.client_id == client_id).first()
+            if row is None:
+                row = LastUpdate(client_id = client_id,last_delivered_seq = 0,last_acked_seq = 0)
+                session.add(row)
+            row.last_updated_time = datetime.datetime.now()
+            setattr(row,field,max(getattr(row,field) or 0,seq))
+            session.commit()
+            state = self._sync_state(row)
+        finally:
+            session.close()
+        with self._lock:
+            self._sync[client_id] = state
+
+    def record_delivery(self,client_id : Annotated[str,"The client ID"],
+                        cursor : Annotated[int,"The highest seq handed to the client"]) -> None:
+        """Saves the time of the poll and the highest seq a client has been sent"""
+        self._update_sync(client_id,'last_delivered_seq',cursor)
+
+    def record_ack(self,client_id : Annotated[str,"The client ID"],
+                   through : Annotated[int,"The seq the client has everything up to"]) -> None:
+        """Saves the highest seq a client has confirmed it has"""
+        self._update_sync(client_id,'last_acked_seq',through)
+
+    def stats(self) -> Annotated[Dict[str,Any],"The registry counters"]:
+        """
+        Returns the size and hit/miss counters of the registry
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._clients),
+                'loaded': self.loaded,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,136 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing_extensions import Annotated,Dict,List,Tuple,Optional
+from typing import Any
+
+# A claimed key whose DM is still being stored
+IN_PROGRESS = -1
+
+
+class DedupIndex:
+    """
+    Remembers the idempotency keys of the DMs each client got recently, in a bounded LRU set per client,
+    so a DM a webhook relay sends again is acknowledged without classifying, encrypting or storing it.
+    A key is given by the sender. Deriving keys from the insta_id, the message and the time bucket it
+    came in is opt in with a window of a few seconds, the previous bucket is checked too so a retry
+    across a bucket edge is still caught. A user sending "ok" twice within the window is taken for a
+    retry, so the window is kept short
+    """
+
+    def __init__(self,
+                 per_client : Annotated[int,"The max keys remembered per client"] = 10000,
+                 window : Annotated[float,"The seconds of a time bucket for derived keys, 0 to only use given keys"] = 0.0,
+                 max_clients : Annotated[int,"The max number of clients with an index in memory"] = 10000):
+        self.per_client = per_client
+        self.window = window
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.evictions = 0
+
+    def keys_for(self,insta_id : Annotated[str,"The instagram id of the sender"],
+                 message : Annotated[str,"The message"],
+                 idempotency_key : Annotated[Optional[str],"The key given by the sender"] = None
+                 ) -> Annotated[List[str],"The key to store first, then the older keys to check"]:
+        """
+        Returns the keys a DM is checked against, the first one is the one it is remembered under
+
+        Args:
+            insta_id (str): The instagram id of the user who sent the message
+            message (str): The message
+            idempotency_key (Optional[str]): The key given by the sender, used as is when present
+
+        Returns:
+            List[str]: The keys of the DM, empty when it is not checked
+        """
+        if idempotency_key:
+            return ['key:' + idempotency_key]
+        if self.window <= 0:
+            # Derived keys are off, only keys given by the sender are checked
+            return []
+        bucket = int(time.time() // self.window)
+        digest = lambda bucket:hashlib.sha256(f"{insta_id}\0{message}\0{bucket}".encode('utf-8')).hexdigest()
+        return [digest(bucket),digest(bucket - 1)]
+
+    def _index(self,client_id : str) -> OrderedDict:
+        # Called with the lock held
+        index = self._clients.get(client_id)
+        if index is None:
+            index = self._clients[client_id] = OrderedDict()
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        self._clients.move_to_end(client_id)
+        return index
+
+    def claim(self,client_id : Annotated[str,"The client ID"],
+              keys : Annotated[List[str],"The keys from keys_for"]
+              ) -> Annotated[Tuple[bool,Optional[int]],"If the DM is new, else the seq of the first copy"]:
+        """
+        Checks a DM against the index and claims its key if it is new, so a copy arriving while
+        the first one is being stored is a duplicate too. A claim must be completed or released
+
+        Args:
+            client_id (str): The id of the client
+            keys (List[str]): The keys of the DM
+
+        Returns:
+            Tuple[bool,Optional[int]]: True and None for a new DM, or False and the seq of the
+                stored copy (None while the first copy is still being stored)
+        """
+        if not keys:
+            return True,None
+        with self._lock:
+            self.checked += 1
+            index = self._index(client_id)
+            for key in keys:
+                if key in index:
+                    index.move_to_end(key)
+                    self.duplicates += 1
+                    seq = index[key]
+                    return False,(None if seq == IN_PROGRESS else seq)
+            index[keys[0]] = IN_PROGRESS
+            while len(index) > self.per_client:
+                index.popitem(last=False)
+                self.evictions += 1
+            return True,None
+
+    def complete(self,client_id : Annotated[str,"The client ID"],keys : Annotated[List[str],"The claimed keys"],
+                 seq : Annotated[int,"The seq the DM was stored under"]) -> None:
+        """Records the seq of a claimed DM once it is stored"""
+        if not keys:
+            return
+        key = keys[0]
+        with self._lock:
+            index = self._clients.get(client_id)
+            if index is not None and key in index:
+                index[key] = seq
+
+    def release(self,client_id : Annotated[str,"The client ID"],keys : Annotated[List[str],"The claimed keys"]) -> None:
+        """Drops a claim whose DM was not stored, so a retry is let through"""
+        if not keys:
+            return
+        key = keys[0]
+        with self._lock:
+            index = self._clients.get(client_id)
+            if index is not None and index.get(key) == IN_PROGRESS:
+                del index[key]
+
+    def stats(self) -> Annotated[Dict[str,Any],"The dedup counters"]:
+        """
+        Returns how many DMs were checked and how many of them were duplicates
+        """
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'keys': sum(len(index) for index in self._clients.values()),
+                'per_client': self.per_client,
+                'window_seconds': self.window,
+                'checked': self.checked,
+                'duplicates': self.duplicates,
+                'duplicate_rate': self.duplicates / self.checked if self.checked else 0.0,
+                'evictions': self.evictions
+            }
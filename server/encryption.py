@@ -0,0 +1,270 @@
+import os
+import threading
+from collections import OrderedDict
+from typing_extensions import Annotated,Dict,Tuple,Optional,List
+from typing import Any
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey,RSAPrivateKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Record format versions
+#   1: every field is encrypted on its own with RSA-OAEP
+#   2: one AES-256-GCM data key per record (or batch), wrapped once with RSA-OAEP,
+#      every field is nonce + AES-GCM ciphertext with the field name as associated data
+FORMAT_RSA = 1
+FORMAT_ENVELOPE = 2
+
+NONCE_SIZE = 12
+
+ENCRYPTED_FIELDS = ('insta_id','message','intent')
+
+
+def get_encryption_mode() -> Annotated[int,"The record format version to write"]:
+    """
+    Reads the DM_ENCRYPTION environment variable, rsa (default) or envelope
+
+    Returns:
+        int: FORMAT_RSA or FORMAT_ENVELOPE
+    """
+    mode = os.environ.get('DM_ENCRYPTION','rsa').lower()
+    if mode == 'envelope':
+        return FORMAT_ENVELOPE
+    elif mode == 'rsa':
+        return FORMAT_RSA
+    raise ValueError(f"Unknown DM_ENCRYPTION {mode}, use rsa or envelope")
+
+
+def _oaep() -> padding.OAEP:
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+# Function to load a public key from a PEM file
+def load_public_key(filename : Annotated[str,"The filepath to client's public key"]
+                    ) -> Annotated[RSAPublicKey,"The public key of the client"]:
+    """
+    Load a public key from a PEM file.
+
+    Args:
+        filename (str): The path to the PEM file containing the public key.
+
+    Returns:
+        RSAPublicKey: The loaded RSA public key object.
+    """
+    with open(filename, "rb") as f:
+        public_key_bytes = f.read()
+        public_key = serialization.load_pem_public_key(
+            public_key_bytes,
+            backend=default_backend()
+        )
+    return public_key
+
+
+class PublicKeyRegistry:
+    """
+    An in-process LRU cache of parsed client public keys keyed by client_id.
+    A cached key is only trusted while the PEM file has the same path and mtime,
+    so replacing a client's key file is picked up on the next request
+    """
+
+    def __init__(self,max_size : Annotated[int,"The max number of keys kept in memory"] = 1024):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def get(self,client_id : Annotated[str,"The client ID"],
+            key_name : Annotated[str,"The filepath to client's public key"]
+            ) -> Annotated[RSAPublicKey,"The public key of the client"]:
+        """
+        Returns the parsed public key of a client, reading the PEM file only on a miss
+        or when the file changed since it was cached
+
+        Args:
+            client_id (str): The id of the client
+            key_name (str): The path to the PEM file of the client
+
+        Returns:
+            RSAPublicKey: The public key of the client
+        """
+        mtime = os.stat(key_name).st_mtime_ns
+        with self._lock:
+            entry = self._keys.get(client_id)
+            if entry is not None and entry[0] == key_name and entry[1] == mtime:
+                self._keys.move_to_end(client_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            if entry is not None:
+                self.reloads += 1
+
+        public_key = load_public_key(key_name)
+        self._put(client_id,key_name,mtime,public_key)
+        return public_key
+
+    def _put(self,client_id : str,key_name : str,mtime : int,public_key : RSAPublicKey) -> None:
+        with self._lock:
+            self._keys[client_id] = (key_name,mtime,public_key)
+            self._keys.move_to_end(client_id)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+
+    def warm(self,clients : Annotated[List[Any],"Rows with client_id and key_name"]) -> int:
+        """
+        Loads the keys of the given clients, skipping the ones whose PEM file is missing or broken
+
+        Args:
+            clients (List[Any]): The clients to load, like ClientID_Table rows
+
+        Returns:
+            int: The number of keys loaded
+        """
+        loaded = 0
+        for client in clients[:self.max_size]:
+            try:
+                mtime = os.stat(client.key_name).st_mtime_ns
+                self._put(client.client_id,client.key_name,mtime,load_public_key(client.key_name))
+                loaded += 1
+            except Exception as e:
+                print(f"Could not load key for {client.client_id} due to {e}")
+        return loaded
+
+    def stats(self) -> Annotated[Dict[str,Any],"The cache counters"]:
+        """
+        Returns the size and hit/miss counters of the registry
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+# Function to encrypt data using the public key
+def encrypt_data(data : Annotated[str,"The data to be encrypted"],
+                 public_key: Annotated[RSAPublicKey,"The public key of the client"]
+                  ) -> Annotated[bytes,"The encoded string"]:
+    """
+    Encrypt a data using a client's public key
+
+    Args:
+        data (str): The data that needs to be encoded
+        public_key (RSAPublicKey): The public key of the client
+
+    Returns:
+        bytes: The encoded data byte string
+    """
+    encrypted_data = public_key.encrypt(
+        data.encode(),
+        _oaep()
+    )
+    return encrypted_data
+
+# Function to create a data key for the envelope format
+def new_data_key(public_key : Annotated[RSAPublicKey,"The public key of the client"]
+                 ) -> Annotated[Tuple[bytes,bytes],"The data key and its wrapped copy"]:
+    """
+    Creates a fresh AES-256-GCM data key and wraps it with the client's public key.
+    This is the only RSA operation the envelope format needs, a data key can be
+    shared by every record of a batch
+
+    Args:
+        public_key (RSAPublicKey): The public key of the client
+
+    Returns:
+        Tuple[bytes,bytes]: The raw data key and the RSA-OAEP wrapped data key
+    """
+    data_key = AESGCM.generate_key(bit_length=256)
+    return data_key,public_key.encrypt(data_key,_oaep())
+
+# Function to encrypt a single field with a data key
+def seal_field(data : Annotated[str,"The data to be encrypted"],
+               data_key : Annotated[bytes,"The raw data key"],
+               field : Annotated[str,"The name of the field being encrypted"]
+               ) -> Annotated[bytes,"The nonce followed by the ciphertext"]:
+    """
+    Encrypt a field of a record with AES-GCM
+
+    Args:
+        data (str): The data that needs to be encoded
+        data_key (bytes): The raw data key of the record
+        field (str): The field name, bound to the ciphertext as associated data
+
+    Returns:
+        bytes: The 12 byte nonce followed by the ciphertext and tag
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + AESGCM(data_key).encrypt(nonce,data.encode(),field.encode())
+
+# Function to encrypt all the fields of a DM
+def encrypt_record(fields : Annotated[Dict[str,str],"The plain text fields of the DM"],
+                   public_key : Annotated[RSAPublicKey,"The public key of the client"],
+                   version : Annotated[Optional[int],"The record format to write"] = None,
+                   data_key : Annotated[Optional[Tuple[bytes,bytes]],"A data key shared by a batch"] = None
+                   ) -> Annotated[Dict[str,Any],"The encrypted fields of the record"]:
+    """
+    Encrypts the fields of a DM in the given record format
+
+    Args:
+        fields (Dict[str,str]): The field name to plain text mapping
+        public_key (RSAPublicKey): The public key of the client
+        version (Optional[int]): FORMAT_RSA or FORMAT_ENVELOPE, defaults to DM_ENCRYPTION
+        data_key (Optional[Tuple[bytes,bytes]]): A (data key, wrapped key) pair from new_data_key,
+            to share one RSA operation across a batch. A new one is made if not given
+
+    Returns:
+        Dict[str,Any]: The encrypted fields along with the version and wrapped_key of the record
+    """
+    if version is None:
+        version = get_encryption_mode()
+
+    if version == FORMAT_RSA:
+        record = {field:encrypt_data(value,public_key) for field,value in fields.items()}
+        record.update({'version':FORMAT_RSA,'wrapped_key':None})
+        return record
+
+    if data_key is None:
+        data_key = new_data_key(public_key)
+    key,wrapped_key = data_key
+    record = {field:seal_field(value,key,field) for field,value in fields.items()}
+    record.update({'version':FORMAT_ENVELOPE,'wrapped_key':wrapped_key})
+    return record
+
+# Function to decrypt a record, this is what a client runs on its side
+def decrypt_record(record : Annotated[Dict[str,Any],"The encrypted record"],
+                   private_key : Annotated[RSAPrivateKey,"The private key of the client"]
+                   ) -> Annotated[Dict[str,str],"The plain text fields"]:
+    """
+    Decrypts a record of any format version, records without a version are FORMAT_RSA
+
+    Args:
+        record (Dict[str,Any]): The record with raw ciphertext bytes
+        private_key (RSAPrivateKey): The private key of the client
+
+    Returns:
+        Dict[str,str]: The plain text of every encrypted field present in the record
+    """
+    fields = [field for field in ENCRYPTED_FIELDS if record.get(field) is not None]
+    if record.get('version',FORMAT_RSA) == FORMAT_RSA:
+        return {field:private_key.decrypt(record[field],_oaep()).decode() for field in fields}
+
+    aes = AESGCM(private_key.decrypt(record['wrapped_key'],_oaep()))
+    return {
+        field:aes.decrypt(record[field][:NONCE_SIZE],record[field][NONCE_SIZE:],field.encode()).decode()
+        for field in fields
+    }
@@ -1,11 +1,12 @@
 import os
 import sys
-from groq import Groq
 from typing_extensions import Annotated
 from dotenv import load_dotenv
 
 load_dotenv('.env')
 
+from llm_gateway import get_gateway,DEFAULT_SYSTEM_MESSAGE
+
 def get_base_path():
     if getattr(sys, 'frozen', False):
         # The application is bundled
@@ -16,6 +17,9 @@ def get_base_path():
 
 
 def get_database_url():
+    #DATABASE_URL points the server at another DB, like the scratch DB of a benchmark
+    if os.environ.get('DATABASE_URL'):
+        return os.environ['DATABASE_URL']
     base_path = get_base_path()
     db_path = os.path.join(base_path, 'db', 'auto_db.sqlite')
     return f"sqlite:///{db_path}"
@@ -23,29 +27,9 @@ def get_database_url():
 # Tool to get response from an llm
 def use_llm(message: Annotated[str, "The message for the llm"]) -> Annotated[str, "The response from the llm"]:
     """
-    Use LLM to complete a particular task
+    Use LLM to complete a particular task, through the shared LLM gateway
 
     Returns:
         str: The LLM's response to the given task
     """
-
-    client = Groq(
-        api_key=os.environ["GROQ_KEY"],
-    )
-    messages = [
-        {
-            'role': 'system',
-            'content': 'You are an assistant for solving NLP and Reasoning tasks, do not give any code in your response'
-        },
-        {
-            'role': 'user',
-            'content': message
-        }
-    ]
-    chat_completion = client.chat.completions.create(
-        messages=messages,
-        model="llama3-8b-8192",
-    )
-    response = chat_completion.choices[0].message.content
-
-    return response
+    return get_gateway().chat(DEFAULT_SYSTEM_MESSAGE,message,model="llama3-8b-8192",site='server_classifier')
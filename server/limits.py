@@ -0,0 +1,159 @@
+import time
+import threading
+from collections import OrderedDict
+from typing_extensions import Annotated,Dict,Tuple,Optional
+from typing import Any
+
+# What happens to an ingest request over its client's rate
+#   reject: 429 with Retry-After
+#   defer: the DM is stored but its LLM classification waits till the classifier is idle
+OVER_LIMIT_POLICIES = ('reject','defer')
+
+ADMIT = 'admit'
+DEFER = 'defer'
+REJECT = 'reject'
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens a second up to burst. A request costing n tokens is let in while the bucket
+    holds min(n, burst) of them and may take it below zero, so a batch bigger than the burst still goes
+    through once and the client then waits for the debt to refill
+    """
+
+    def __init__(self,rate : Annotated[float,"Tokens per second"],burst : Annotated[float,"The max tokens"]):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self,now : float) -> None:
+        self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self,cost : Annotated[float,"The tokens the request costs"]) -> Annotated[Tuple[bool,float],"If it was let in and the seconds till it would be"]:
+        if self.rate <= 0:
+            # A rate of 0 turns the limit off
+            return True,0.0
+        now = time.monotonic()
+        self._refill(now)
+        needed = min(cost,self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return True,0.0
+        return False,(needed - self.tokens) / self.rate
+
+    def level(self) -> float:
+        self._refill(time.monotonic())
+        return self.tokens
+
+
+class AdmissionController:
+    """
+    Admission control for the ingest endpoints, a token bucket per client and a cap on the
+    ingest requests in flight across all clients. Keeps per client counters so the tenant
+    that is saturating the server shows up in stats
+    """
+
+    def __init__(self,
+                 rate : Annotated[float,"The DMs per second every client is allowed"] = 20.0,
+                 burst : Annotated[float,"The DMs a client can send at once"] = 100.0,
+                 max_in_flight : Annotated[int,"The max ingest requests being handled at once"] = 256,
+                 over_limit : Annotated[str,"reject or defer"] = 'defer',
+                 max_clients : Annotated[int,"The max number of client buckets kept in memory"] = 10000):
+        if over_limit not in OVER_LIMIT_POLICIES:
+            raise ValueError(f"Unknown over limit policy {over_limit}, use reject or defer")
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.over_limit = over_limit
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.shed = 0
+
+    def _client(self,client_id : str) -> Dict[str,Any]:
+        # Called with the lock held
+        state = self._clients.get(client_id)
+        if state is None:
+            state = {'bucket':TokenBucket(self.rate,self.burst),'in_flight':0,'admitted':0,'deferred':0,'rejected':0,'shed':0}
+            self._clients[client_id] = state
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        self._clients.move_to_end(client_id)
+        return state
+
+    def enter(self,client_id : Annotated[str,"The client ID"],
+              cost : Annotated[float,"The number of DMs in the request"] = 1
+              ) -> Annotated[Tuple[str,float],"ADMIT, DEFER or REJECT and the Retry-After seconds"]:
+        """
+        Decides if an ingest request is let in. Every ADMIT or DEFER must be paired with a leave
+
+        Args:
+            client_id (str): The id of the client
+            cost (float): The number of DMs in the request
+
+        Returns:
+            Tuple[str,float]: ADMIT, DEFER (let in, classify later) or REJECT, and the seconds
+                the client should wait before retrying a REJECT
+        """
+        with self._lock:
+            state = self._client(client_id)
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                state['shed'] += 1
+                return REJECT,1.0
+            allowed,retry_after = state['bucket'].take(cost)
+            if allowed:
+                decision = ADMIT
+                state['admitted'] += 1
+            elif self.over_limit == 'defer':
+                decision = DEFER
+                state['deferred'] += 1
+            else:
+                state['rejected'] += 1
+                return REJECT,retry_after
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight,self.in_flight)
+            state['in_flight'] += 1
+            return decision,0.0
+
+    def leave(self,client_id : Annotated[str,"The client ID"]) -> None:
+        """Marks an admitted request as done"""
+        with self._lock:
+            self.in_flight -= 1
+            state = self._clients.get(client_id)
+            if state is not None:
+                state['in_flight'] -= 1
+
+    def stats(self,top : Annotated[Optional[int],"Only the clients with the most turned away requests"] = 20) -> Annotated[Dict[str,Any],"The limiter state"]:
+        """
+        Returns the global in-flight counters and the bucket and counters of every client,
+        the clients that were deferred, rejected or shed the most come first
+        """
+        with self._lock:
+            clients = []
+            for client_id,state in self._clients.items():
+                clients.append({
+                    'client_id': client_id,
+                    'tokens': round(state['bucket'].level(),2),
+                    'in_flight': state['in_flight'],
+                    'admitted': state['admitted'],
+                    'deferred': state['deferred'],
+                    'rejected': state['rejected'],
+                    'shed': state['shed']
+                })
+            clients.sort(key=lambda client:(-(client['deferred'] + client['rejected'] + client['shed']),-client['in_flight']))
+            return {
+                'rate_per_second': self.rate,
+                'burst': self.burst,
+                'over_limit': self.over_limit,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'shed': self.shed,
+                'tracked_clients': len(self._clients),
+                'clients': clients[:top] if top else clients
+            }
@@ -0,0 +1,344 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from typing_extensions import Annotated,Dict,List,Tuple,Optional
+from typing import Any
+
+import groq
+from groq import Groq,AsyncGroq
+
+# The one place the server, or the app, calls the LLM provider from. The server imports it as one of
+# its own modules and the app through app/gateway.py, so there is a single copy to fix.
+# Clients are built once per API key and base url and reused, so every call shares one HTTP
+# connection pool. Calls are limited per model in how many run at once and by a requests per
+# minute and tokens per minute budget, 429s and 5xx are retried with jittered backoff, and the
+# latency and tokens of every call are counted per call site and model
+# Configuration (environment):
+#   GROQ_KEY               the API key
+#   LLM_MAX_CONCURRENCY    calls in flight per model, default 4
+#   LLM_RPM                requests per minute per model, 0 for no limit, default 0
+#   LLM_TPM                tokens per minute per model, 0 for no limit, default 0
+#   LLM_MAX_RETRIES        retries of a call after a 429, 5xx or connection error, default 4
+#   LLM_TIMEOUT            seconds before a call is given up on, default 60
+
+DEFAULT_MODEL = "llama3-8b-8192"
+DEFAULT_SYSTEM_MESSAGE = 'You are an assistant for solving NLP and Reasoning tasks, do not give any code in your response'
+
+# The errors worth another try, anything else (bad request, auth) fails right away
+RETRYABLE_ERRORS = (groq.RateLimitError,groq.InternalServerError,groq.APIConnectionError,groq.APITimeoutError)
+
+
+class RateBudget:
+    """
+    A token bucket that hands out reservations. A caller takes what it needs, going into debt
+    if the bucket is short, and waits the returned seconds before it goes ahead, so callers are
+    let through in the order they asked
+    """
+
+    def __init__(self,per_minute : Annotated[float,"The budget per minute, 0 for no limit"],
+                 burst : Annotated[Optional[float],"The max saved up, the per minute budget by default"] = None):
+        self.rate = per_minute / 60.0
+        self.burst = burst if burst is not None else per_minute
+        self.level = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self,cost : Annotated[float,"The budget the call takes"]) -> Annotated[float,"The seconds to wait"]:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.burst,self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= cost
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def adjust(self,delta : Annotated[float,"What the call took above its reservation, negative to give back"]) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.level = min(self.burst,self.level - delta)
+
+
+def estimate_tokens(messages : Annotated[List[Dict[str,Any]],"The chat messages"]) -> Annotated[int,"The rough prompt tokens"]:
+    # About four characters a token, close enough to reserve budget before the real count comes back
+    return sum(len(str(message.get('content') or '')) for message in messages) // 4 + 4 * len(messages)
+
+
+class LLMGateway:
+    """
+    Pooled, rate limited and retried chat completions with per call accounting.
+    complete and chat block, acomplete and achat are their asyncio versions
+    """
+
+    def __init__(self,
+                 api_key : Annotated[Optional[str],"The API key, GROQ_KEY by default"] = None,
+                 max_concurrency : Annotated[int,"The calls in flight per model"] = 4,
+                 requests_per_minute : Annotated[float,"The requests per minute per model, 0 for no limit"] = 0,
+                 tokens_per_minute : Annotated[float,"The tokens per minute per model, 0 for no limit"] = 0,
+                 max_retries : Annotated[int,"The retries after a retryable error"] = 4,
+                 backoff_base : Annotated[float,"The first backoff in seconds, doubled every retry"] = 0.5,
+                 backoff_max : Annotated[float,"The longest backoff in seconds"] = 20.0,
+                 timeout : Annotated[float,"The seconds before a call is given up on"] = 60.0,
+                 base_url : Annotated[Optional[str],"Another endpoint for the provider"] = None):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.base_url = base_url
+        self._client = None
+        self._async_clients = {}
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'LLMGateway':
+        return cls(
+            max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY','4')),
+            requests_per_minute=float(os.environ.get('LLM_RPM','0')),
+            tokens_per_minute=float(os.environ.get('LLM_TPM','0')),
+            max_retries=int(os.environ.get('LLM_MAX_RETRIES','4')),
+            timeout=float(os.environ.get('LLM_TIMEOUT','60'))
+        )
+
+    #==========================================POOLS===============================================
+    def client(self) -> Groq:
+        """The shared sync client, retries are done here so the SDK's own are off"""
+        with self._lock:
+            if self._client is None:
+                self._client = Groq(api_key=self.api_key or os.environ["GROQ_KEY"],base_url=self.base_url,
+                                    max_retries=0,timeout=self.timeout)
+            return self._client
+
+    def async_client(self) -> AsyncGroq:
+        """The async client of the running event loop, an httpx async pool can not be shared between loops"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = AsyncGroq(api_key=self.api_key or os.environ["GROQ_KEY"],base_url=self.base_url,
+                                   max_retries=0,timeout=self.timeout)
+                self._async_clients[loop] = client
+            return client
+
+    def _model(self,model : str) -> Dict[str,Any]:
+        # The limits of a model, made the first time it is called
+        with self._lock:
+            limits = self._models.get(model)
+            if limits is None:
+                limits = self._models[model] = {
+                    'slots': threading.BoundedSemaphore(self.max_concurrency),
+                    'async_slots': {},
+                    'requests': RateBudget(self.requests_per_minute),
+                    'tokens': RateBudget(self.tokens_per_minute)
+                }
+            return limits
+
+    def _async_slots(self,limits : Dict[str,Any]) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = limits['async_slots'].get(loop)
+            if slots is None:
+                slots = limits['async_slots'][loop] = asyncio.Semaphore(self.max_concurrency)
+            return slots
+
+    #==========================================RETRIES=============================================
+    def _backoff(self,attempt : int,error : Exception) -> float:
+        # Full jitter, but never sooner than the Retry-After the provider asked for
+        delay = random.uniform(0,min(self.backoff_max,self.backoff_base * (2 ** attempt)))
+        response = getattr(error,'response',None)
+        if response is not None:
+            try:
+                delay = max(delay,float(response.headers.get('retry-after')))
+            except (TypeError,ValueError):
+                pass
+        return min(delay,self.backoff_max)
+
+    def _reserve(self,limits : Dict[str,Any],estimate : int) -> float:
+        return max(limits['requests'].reserve(1),limits['tokens'].reserve(estimate))
+
+    #==========================================ACCOUNTING==========================================
+    def _record(self,site : str,model : str,seconds : float,retries : int,
+                usage : Any,waited : float,error : Optional[Exception] = None) -> None:
+        with self._lock:
+            stats = self._stats.get((site,model))
+            if stats is None:
+                stats = self._stats[(site,model)] = {
+                    'calls':0,'errors':0,'retries':0,'total_seconds':0.0,'max_seconds':0.0,
+                    'throttled_seconds':0.0,'prompt_tokens':0,'completion_tokens':0
+                }
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'],seconds)
+            stats['throttled_seconds'] += waited
+            if error is not None:
+                stats['errors'] += 1
+            if usage is not None:
+                stats['prompt_tokens'] += getattr(usage,'prompt_tokens',0) or 0
+                stats['completion_tokens'] += getattr(usage,'completion_tokens',0) or 0
+
+    def _settle(self,limits : Dict[str,Any],estimate : int,usage : Any) -> None:
+        # Charges the tokens the call really used in place of the estimate
+        if usage is not None and getattr(usage,'total_tokens',None):
+            limits['tokens'].adjust(usage.total_tokens - estimate)
+
+    def stats(self) -> Annotated[Dict[str,Any],"The call counters"]:
+        """
+        Returns the calls, errors, retries, latency and tokens per call site and model
+        """
+        with self._lock:
+            sites = []
+            for (site,model),stats in sorted(self._stats.items()):
+                sites.append({
+                    'site': site,
+                    'model': model,
+                    **stats,
+                    'mean_seconds': stats['total_seconds'] / stats['calls'] if stats['calls'] else 0.0
+                })
+            return {
+                'max_concurrency': self.max_concurrency,
+                'requests_per_minute': self.requests_per_minute,
+                'tokens_per_minute': self.tokens_per_minute,
+                'max_retries': self.max_retries,
+                'sites': sites
+            }
+
+    #==========================================CALLS===============================================
+    def complete(self,messages : Annotated[List[Dict[str,Any]],"The chat messages"],
+                 model : Annotated[str,"The model"] = DEFAULT_MODEL,
+                 site : Annotated[str,"The name of the caller, for the accounting"] = 'default',
+                 **kwargs) -> Annotated[str,"The response text"]:
+        """
+        Sends a chat completion, waiting for a free slot and for the rate budget of the model,
+        and retries it on a 429, 5xx or connection error
+
+        Args:
+            messages (List[Dict[str,Any]]): The chat messages
+            model (str): The model to use
+            site (str): The name of the caller, the accounting is kept per site
+            **kwargs: Passed on to chat.completions.create, for eg temperature
+
+        Returns:
+            str: The content of the first choice
+
+        Raises:
+            groq.APIError: When the call fails for good
+        """
+        limits = self._model(model)
+        estimate = estimate_tokens(messages)
+        started = time.monotonic()
+        waited = 0.0
+        attempt = 0
+        with limits['slots']:
+            while True:
+                wait = self._reserve(limits,estimate)
+                if wait:
+                    waited += wait
+                    time.sleep(wait)
+                try:
+                    response = self.client().chat.completions.create(messages=messages,model=model,**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        self._record(site,model,time.monotonic() - started,attempt,None,waited,e)
+                        raise
+                    delay = self._backoff(attempt,e)
+                    print(f"LLM call from {site} failed with {type(e).__name__}, retrying in {delay:.2f}s")
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                except Exception as e:
+                    self._record(site,model,time.monotonic() - started,attempt,None,waited,e)
+                    raise
+                break
+        self._settle(limits,estimate,response.usage)
+        self._record(site,model,time.monotonic() - started,attempt,response.usage,waited)
+        return response.choices[0].message.content
+
+    async def acomplete(self,messages : Annotated[List[Dict[str,Any]],"The chat messages"],
+                        model : Annotated[str,"The model"] = DEFAULT_MODEL,
+                        site : Annotated[str,"The name of the caller, for the accounting"] = 'default',
+                        **kwargs) -> Annotated[str,"The response text"]:
+        """
+        The asyncio version of complete, it waits without holding up the event loop
+        """
+        limits = self._model(model)
+        estimate = estimate_tokens(messages)
+        started = time.monotonic()
+        waited = 0.0
+        attempt = 0
+        async with self._async_slots(limits):
+            while True:
+                wait = self._reserve(limits,estimate)
+                if wait:
+                    waited += wait
+                    await asyncio.sleep(wait)
+                try:
+                    response = await self.async_client().chat.completions.create(messages=messages,model=model,**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        self._record(site,model,time.monotonic() - started,attempt,None,waited,e)
+                        raise
+                    delay = self._backoff(attempt,e)
+                    print(f"LLM call from {site} failed with {type(e).__name__}, retrying in {delay:.2f}s")
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception as e:
+                    self._record(site,model,time.monotonic() - started,attempt,None,waited,e)
+                    raise
+                break
+        self._settle(limits,estimate,response.usage)
+        self._record(site,model,time.monotonic() - started,attempt,response.usage,waited)
+        return response.choices[0].message.content
+
+    def chat(self,system_message : Annotated[str,"The system message"],
+             message : Annotated[str,"The user message"],
+             model : Annotated[str,"The model"] = DEFAULT_MODEL,
+             site : Annotated[str,"The name of the caller, for the accounting"] = 'default',
+             **kwargs) -> Annotated[str,"The response text"]:
+        """A system message and a user message, the shape of every call in this repo"""
+        return self.complete(chat_messages(system_message,message),model,site,**kwargs)
+
+    async def achat(self,system_message : Annotated[str,"The system message"],
+                    message : Annotated[str,"The user message"],
+                    model : Annotated[str,"The model"] = DEFAULT_MODEL,
+                    site : Annotated[str,"The name of the caller, for the accounting"] = 'default',
+                    **kwargs) -> Annotated[str,"The response text"]:
+        """The asyncio version of chat"""
+        return await self.acomplete(chat_messages(system_message,message),model,site,**kwargs)
+
+
+def chat_messages(system_message : str,message : str) -> List[Dict[str,str]]:
+    return [
+        {
+            'role': 'system',
+            'content': system_message
+        },
+        {
+            'role': 'user',
+            'content': message
+        }
+    ]
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> Annotated[LLMGateway,"The shared gateway"]:
+    """
+    Returns the gateway of this process, built from the environment the first time it is asked for
+    """
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway.from_env()
+        return _gateway
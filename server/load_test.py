@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import argparse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from typing_extensions import Annotated,List,Dict
+from typing import Any
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+
+# Measures how the throughput of a running server changes with the number of requests in flight.
+# Every in-flight slot sends to its own client, so requests for different clients should overlap
+# Usage (from the server directory, with the server running):
+#   python load_test.py --url http://127.0.0.1:8000 --concurrency 1 2 4 8 16 32 --requests 400
+
+
+def post(url : Annotated[str,"The endpoint"],body : Annotated[Dict[str,Any],"The JSON body"]) -> Annotated[int,"The status code"]:
+    request = urllib.request.Request(url,data=json.dumps(body).encode(),headers={'Content-Type':'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def get(url : Annotated[str,"The endpoint"]) -> Annotated[int,"The status code"]:
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def setup_clients(url : Annotated[str,"The server url"],count : Annotated[int,"The number of clients"]) -> List[str]:
+    """
+    Creates load test clients with a fresh public key each, the server must run from this directory
+    so it finds the keys in ./db/public_keys
+    """
+    os.makedirs('./db/public_keys',exist_ok=True)
+    client_ids = []
+    for index in range(count):
+        client_id = f'load_test_{index}'
+        key_name = f'./db/public_keys/{client_id}.pem'
+        if not os.path.exists(key_name):
+            private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+            with open(key_name,'wb') as file:
+                file.write(private_key.public_key().public_bytes(
+                    serialization.Encoding.PEM,serialization.PublicFormat.SubjectPublicKeyInfo))
+        #an existing client gets a 409 and keeps its DMs
+        post(f'{url}/create_client',{'client_name':client_id,'client_id':client_id,'business_name':'load test'})
+        client_ids.append(client_id)
+    return client_ids
+
+
+def run_level(url : Annotated[str,"The server url"],
+              client_ids : Annotated[List[str],"One client per in-flight slot"],
+              total : Annotated[int,"The number of requests to send"],
+              read_every : Annotated[int,"Send a sync_dms after every this many new_dm"]) -> Dict[str,Any]:
+    """
+    Sends total requests with len(client_ids) of them in flight at a time
+    """
+    concurrency = len(client_ids)
+
+    def slot(index : int) -> List[float]:
+        client_id = client_ids[index]
+        latencies = []
+        for number in range(index,total,concurrency):
+            start = time.perf_counter()
+            if read_every and number % read_every == read_every - 1:
+                status = get(f'{url}/sync_dms/{client_id}?limit=100')
+            else:
+                status = post(f'{url}/new_dm/{client_id}',{'insta_id':f'user_{number}','message':f'Is the blue dress {number} in stock?'})
+            if status != 200:
+                print(f"Request {number} for {client_id} failed with {status}")
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(latency for result in pool.map(slot,range(concurrency)) for latency in result)
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the server at different numbers of in-flight requests")
+    parser.add_argument('--url',default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency',type=int,nargs='+',default=[1,2,4,8,16,32])
+    parser.add_argument('--requests',type=int,default=400,help="Requests sent at every concurrency level")
+    parser.add_argument('--read-every',type=int,default=10,help="Every this many requests is a sync_dms, 0 for none")
+    args = parser.parse_args()
+
+    client_ids = setup_clients(args.url,max(args.concurrency))
+    baseline = None
+    print(f"{'in flight':>10} {'req/s':>10} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for concurrency in args.concurrency:
+        result = run_level(args.url,client_ids[:concurrency],args.requests,args.read_every)
+        baseline = baseline or result['throughput']
+        print(f"{concurrency:>10} {result['throughput']:>10.1f} {result['throughput'] / baseline:>8.2f} "
+              f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f}")
@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import math
+import threading
+from typing_extensions import Annotated,Dict,List,Tuple,Optional
+from typing import Any
+
+CLASSES = ('Casual','Intent','Desire','Order','Collaboration')
+
+#==========================================RULES===================================================
+# (class, confidence, pattern) checked in order, the first match wins
+RULES = [
+    # Messages with no letters or digits at all, like emoji only messages
+    ('Casual',0.95,re.compile(r'^[^\w]*$')),
+    ('Casual',0.95,re.compile(
+        r'^\s*(hi+|hey+|hello+|helo+|hola|yo|namaste|good\s+(morning|afternoon|evening|night)|'
+        r'thanks?(\s+you)?(\s+so\s+much)?|thank\s+you(\s+so\s+much)?|thx|ty|ok(ay)?|k|cool|nice|great|bye)'
+        r'[\s!.,]*[^\w]*$',re.IGNORECASE)),
+    # An order id, for eg "order no 12345", "order id: OD4455" or "order #88123"
+    ('Order',0.95,re.compile(r'\border\s*(no\.?|number|id|#)\s*[:#]?\s*[a-z]{0,3}\d{4,}',re.IGNORECASE)),
+    ('Order',0.92,re.compile(
+        r'\b(where\s+is\s+my\s+(order|parcel|package|delivery)|track(ing)?\s+(id|number|my\s+order)|'
+        r'(not|never)\s+(yet\s+)?(received|delivered|arrived)|cancel\s+my\s+order|refund|'
+        r'return\s+my\s+order|order\s+status)\b',re.IGNORECASE)),
+    ('Collaboration',0.92,re.compile(
+        r'\b(collab|collabs|collaborat\w*|partnership|sponsor\w*|brand\s+deal|paid\s+promotion|'
+        r'barter|pr\s+package)\b',re.IGNORECASE)),
+]
+
+TOKEN = re.compile(r'\w+',re.UNICODE)
+
+
+def tokenize(message : Annotated[str,"The message to tokenize"]) -> Annotated[List[str],"The tokens"]:
+    """
+    Lower cases a message and splits it into word tokens, numbers become <num>
+
+    Args:
+        message (str): The message to tokenize
+
+    Returns:
+        List[str]: The tokens of the message
+    """
+    return ['<num>' if token.isdigit() else token for token in TOKEN.findall(message.lower())]
+
+
+def match_rules(message : Annotated[str,"The message to classify"]
+                ) -> Annotated[Optional[Tuple[str,float]],"The class and confidence or None"]:
+    """
+    Checks a message against the keyword rules
+
+    Args:
+        message (str): The message to classify
+
+    Returns:
+        Optional[Tuple[str,float]]: The class and confidence of the first rule that matched, or None
+    """
+    for label,confidence,pattern in RULES:
+        if pattern.search(message):
+            return label,confidence
+    return None
+
+#==========================================MODEL===================================================
+class NaiveBayesModel:
+    """
+    A multinomial naive bayes model over word tokens, a linear model in log space
+    that is cheap to train, update one message at a time and store as JSON
+    """
+
+    def __init__(self,state : Annotated[Optional[Dict[str,Any]],"A state from to_dict"] = None):
+        state = state or {}
+        self.docs = {label:state.get('docs',{}).get(label,0) for label in CLASSES}
+        self.counts = {label:dict(state.get('counts',{}).get(label,{})) for label in CLASSES}
+        self.totals = {label:sum(self.counts[label].values()) for label in CLASSES}
+        self.vocab = set(token for label in CLASSES for token in self.counts[label])
+
+    @property
+    def size(self) -> int:
+        return sum(self.docs.values())
+
+    def learn(self,message : Annotated[str,"The message"],label : Annotated[str,"The class of the message"]) -> None:
+        """Adds one labelled message to the model"""
+        if label not in CLASSES:
+            return
+        self.docs[label] += 1
+        for token in tokenize(message):
+            self.counts[label][token] = self.counts[label].get(token,0) + 1
+            self.totals[label] += 1
+            self.vocab.add(token)
+
+    def predict(self,message : Annotated[str,"The message to classify"]
+                ) -> Annotated[Tuple[str,float],"The most likely class and its probability"]:
+        """
+        Returns the most likely class of a message and its posterior probability
+        """
+        tokens = tokenize(message)
+        vocab_size = len(self.vocab) + 1
+        scores = {}
+        for label in CLASSES:
+            if not self.docs[label]:
+                continue
+            score = math.log(self.docs[label] / self.size)
+            denominator = self.totals[label] + vocab_size
+            for token in tokens:
+                score += math.log((self.counts[label].get(token,0) + 1) / denominator)
+            scores[label] = score
+        if not scores:
+            return 'None',0.0
+        best = max(scores,key=scores.get)
+        normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best,1.0 / normalizer
+
+    def to_dict(self) -> Dict[str,Any]:
+        return {'docs':self.docs,'counts':self.counts}
+
+#==========================================CLASSIFIER==============================================
+class LocalClassifier:
+    """
+    The fast path in front of the LLM. Keyword rules answer first, then the naive bayes model.
+    A class is only returned when its confidence is at least the threshold, otherwise the
+    message is left for the LLM. Counts how much of the traffic it answers on its own
+    """
+
+    def __init__(self,
+                 model_path : Annotated[Optional[str],"The JSON file the model is kept in"] = None,
+                 threshold : Annotated[float,"The min confidence to answer without the LLM"] = 0.9,
+                 min_docs : Annotated[int,"The min number of training messages before the model is used"] = 200,
+                 learn_online : Annotated[bool,"Learn from the LLM labels as they come in"] = False):
+        self.model_path = model_path
+        self.threshold = threshold
+        self.min_docs = min_docs
+        self.learn_online = learn_online
+        self._lock = threading.Lock()
+        self.model = self._load()
+        self._unsaved = 0
+        self.total = 0
+        self.rule_hits = 0
+        self.model_hits = 0
+
+    def _load(self) -> NaiveBayesModel:
+        if self.model_path and os.path.exists(self.model_path):
+            with open(self.model_path,'r',encoding='utf-8') as file:
+                return NaiveBayesModel(json.load(file))
+        return NaiveBayesModel()
+
+    def save(self) -> None:
+        """Writes the model to model_path"""
+        if not self.model_path:
+            return
+        with self._lock:
+            state = json.dumps(self.model.to_dict())
+            self._unsaved = 0
+        temp_path = self.model_path + '.tmp'
+        with open(temp_path,'w',encoding='utf-8') as file:
+            file.write(state)
+        os.replace(temp_path,self.model_path)
+
+    def classify(self,message : Annotated[str,"The message to classify"]
+                 ) -> Annotated[Optional[str],"The class or None to ask the LLM"]:
+        """
+        Classifies a message locally if it is confident enough
+
+        Args:
+            message (str): The message to classify
+
+        Returns:
+            Optional[str]: The class label, or None if the LLM should classify the message
+        """
+        label = None
+        rule = match_rules(message)
+        with self._lock:
+            self.total += 1
+            if rule is not None and rule[1] >= self.threshold:
+                self.rule_hits += 1
+                label = rule[0]
+            elif self.model.size >= self.min_docs:
+                predicted,confidence = self.model.predict(message)
+                if confidence >= self.threshold:
+                    self.model_hits += 1
+                    label = predicted
+        return label
+
+    def learn(self,message : Annotated[str,"The message"],label : Annotated[str,"The class from the LLM"]) -> None:
+        """
+        Adds an LLM labelled message to the model when online learning is on.
+        The model is saved every 100 new messages
+        """
+        if not self.learn_online or label not in CLASSES:
+            return
+        with self._lock:
+            self.model.learn(message,label)
+            self._unsaved += 1
+            save = self._unsaved >= 100
+        if save:
+            self.save()
+
+    def train(self,examples : Annotated[List[Tuple[str,str]],"The (message, class) pairs"]) -> int:
+        """
+        Replaces the model with one trained from labelled history
+
+        Args:
+            examples (List[Tuple[str,str]]): The messages and their classes
+
+        Returns:
+            int: The number of examples used
+        """
+        model = NaiveBayesModel()
+        for message,label in examples:
+            model.learn(message,label)
+        with self._lock:
+            self.model = model
+        self.save()
+        return model.size
+
+    def stats(self) -> Annotated[Dict[str,Any],"The fast path counters"]:
+        """
+        Returns how many messages the fast path answered and what fraction of the traffic that is
+        """
+        with self._lock:
+            absorbed = self.rule_hits + self.model_hits
+            return {
+                'total': self.total,
+                'rule_hits': self.rule_hits,
+                'model_hits': self.model_hits,
+                'absorbed_fraction': absorbed / self.total if self.total else 0.0,
+                'threshold': self.threshold,
+                'model_size': self.model.size,
+                'model_active': self.model.size >= self.min_docs
+            }
+
+
+def load_examples(path : Annotated[str,"The path to a JSON lines file"]) -> Annotated[List[Tuple[str,str]],"The examples"]:
+    """
+    Reads labelled history from a JSON lines file with a message and intent on every line,
+    the format a client gets by decrypting its copied DMs
+
+    Args:
+        path (str): The path to the file
+
+    Returns:
+        List[Tuple[str,str]]: The (message, class) pairs with a known class
+    """
+    examples = []
+    with open(path,'r',encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get('intent') in CLASSES:
+                examples.append((row['message'],row['intent']))
+    return examples
+
+
+if __name__ == "__main__":
+    # Retrains the model from labelled history
+    # Usage: python local_classifier.py labelled.jsonl [model_path]
+    model_path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('LOCAL_CLASSIFY_MODEL','./db/intent_model.json')
+    classifier = LocalClassifier(model_path)
+    used = classifier.train(load_examples(sys.argv[1]))
+    print(f"Trained on {used} messages, saved to {model_path}")
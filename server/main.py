@@ -1,27 +1,41 @@
 import os
 import sys
 import base64
-from fastapi import FastAPI,Response,Path,Body
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing_extensions import Annotated,Tuple,Dict,Union,List
+from fastapi import FastAPI,Response,Path,Body,Query,Request,Header
+from fastapi.responses import JSONResponse,StreamingResponse,PlainTextResponse
+from pydantic import BaseModel,ValidationError
+from typing_extensions import Annotated,Tuple,Dict,Union,List,Set,Iterator,Callable
 from typing import Any
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy.exc import IntegrityError
+import json
 import datetime
-import pickle as pk
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+import math
+import asyncio
+import functools
 import traceback
-
-from models import ClientID_Table,Base,LastUpdate
-from helper import use_llm
+import contextvars
+
+from models import ClientID_Table,Base,configure_sqlite
+from storage import get_dm_store
+from encryption import PublicKeyRegistry,encrypt_record,new_data_key,get_encryption_mode,FORMAT_RSA,FORMAT_ENVELOPE
+from classifier import ClassificationQueue,ClassificationJob,ClassificationCache
+from local_classifier import LocalClassifier
+from limits import AdmissionController,ADMIT,REJECT
+from dedup import DedupIndex
+from retention import RetentionPolicy,Compactor
+from metrics import metrics,MetricsMiddleware
+from helper import get_gateway
+from clients import ClientRegistry
+from transfer import (MEDIA_TYPES,STREAM_FORMATS,available_formats,negotiate_format,negotiate_encoding,
+                      encode_dm_row,row_encoder,stream_start,encode_page_end,compress)
 
 app = FastAPI()
+#per request timing, counters and the timing log line
+app.add_middleware(MetricsMiddleware)
 
 def get_base_path():
     if getattr(sys, 'frozen', False):
@@ -33,6 +47,9 @@ def get_base_path():
 
 
 def get_database_url():
+    #DATABASE_URL points the server at another DB, like the scratch DB of a benchmark
+    if os.environ.get('DATABASE_URL'):
+        return os.environ['DATABASE_URL']
     base_path = get_base_path()
     db_path = os.path.join(base_path,'db', 'auto_db.sqlite')
     return f"sqlite:///{db_path}"
@@ -41,132 +58,314 @@ def get_database_url():
 DATABASE_URL = get_database_url()
 
 
-engine = create_engine(DATABASE_URL, echo=True)
+#the blocking DB, file and crypto work of a request runs on this pool, off the event loop
+BLOCKING_WORKERS = int(os.environ.get('BLOCKING_WORKERS','32'))
+blocking_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS,thread_name_prefix='blocking')
+
+#one pooled connection per blocking worker so no worker waits on the connection pool
+#SQL_ECHO=1 logs every statement, the request timing log covers the rest
+engine = create_engine(DATABASE_URL, echo=os.environ.get('SQL_ECHO','0') == '1', pool_size=BLOCKING_WORKERS, max_overflow=0)
+configure_sqlite(engine)
 Session = sessionmaker(bind=engine)
-session = Session()
+
+dm_store = get_dm_store(Session)
+client_registry = ClientRegistry(Session)
+key_registry = PublicKeyRegistry(int(os.environ.get('KEY_CACHE_SIZE','1024')))
+classification_cache = ClassificationCache(
+    max_size=int(os.environ.get('CLASSIFY_CACHE_SIZE','10000')),
+    ttl=float(os.environ.get('CLASSIFY_CACHE_TTL',str(7 * 24 * 3600))),
+    session_factory=Session if os.environ.get('CLASSIFY_CACHE_PERSIST','0') == '1' else None
+)
+classification_queue = ClassificationQueue(
+    workers=int(os.environ.get('CLASSIFY_WORKERS','4')),
+    max_size=int(os.environ.get('CLASSIFY_QUEUE_SIZE','10000')),
+    batch_size=int(os.environ.get('CLASSIFY_BATCH_SIZE','8')),
+    batch_wait=float(os.environ.get('CLASSIFY_BATCH_WAIT','0.2')),
+    max_defer=float(os.environ.get('CLASSIFY_DEFER_MAX_WAIT','10')),
+    cache=classification_cache
+)
+CLASSIFY_WAIT_TIMEOUT = float(os.environ.get('CLASSIFY_WAIT_TIMEOUT','30'))
+#A stored DM without an intent counts as being classified for this long, then it goes out unclassified
+PENDING_MAX_AGE = float(os.environ.get('PENDING_MAX_AGE','300'))
+local_classifier = LocalClassifier(
+    model_path=os.environ.get('LOCAL_CLASSIFY_MODEL','./db/intent_model.json'),
+    threshold=float(os.environ.get('LOCAL_CLASSIFY_THRESHOLD','0.9')),
+    learn_online=os.environ.get('LOCAL_CLASSIFY_LEARN','0') == '1'
+)
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS','10000'))
+admission = AdmissionController(
+    rate=float(os.environ.get('INGEST_RATE','20')),
+    burst=float(os.environ.get('INGEST_BURST','100')),
+    max_in_flight=int(os.environ.get('INGEST_MAX_IN_FLIGHT','256')),
+    over_limit=os.environ.get('INGEST_OVER_LIMIT','defer').lower()
+)
+#only the idempotency keys clients send are checked, DEDUP_WINDOW=5 also catches a relay resending
+#the same DM within about 5 to 10 seconds when it sends no key
+dedup_index = DedupIndex(
+    per_client=int(os.environ.get('DEDUP_PER_CLIENT','10000')),
+    window=float(os.environ.get('DEDUP_WINDOW','0'))
+)
+#expires the DMs outside the retention policy of each client and compacts their storage
+compactor = Compactor(
+    dm_store,
+    client_registry.clients,
+    RetentionPolicy.from_env(),
+    interval=float(os.environ.get('COMPACT_INTERVAL','60')),
+    min_dead_ratio=float(os.environ.get('COMPACT_MIN_DEAD_RATIO','0.5')),
+    min_dead_bytes=int(os.environ.get('COMPACT_MIN_DEAD_BYTES',str(1 << 20)))
+)
+#transport compression of /copy_dms, on when the client sends Accept-Encoding
+COPY_COMPRESSION = os.environ.get('COPY_COMPRESSION','1') == '1'
 
 #==========================================HELPER_TOOLS============================================
-# Function to load a public key from a PEM file
-def load_public_key(filename : Annotated[str,"The filepath to client's public key"]
-                    ) -> Annotated[RSAPublicKey,"The public key of the client"]:
+# Function to run blocking work off the event loop
+async def run_blocking(func : Annotated[Callable,"The blocking function"],*args,**kwargs) -> Any:
     """
-    Load a public key from a PEM file.
+    Runs a blocking function on the blocking pool so the event loop keeps serving other requests.
+    The function runs in a copy of the caller's context so its stage timings count towards the request
 
     Args:
-        filename (str): The path to the PEM file containing the public key.
+        func (Callable): The function doing DB, file or crypto work
+        *args, **kwargs: The arguments of the function
 
     Returns:
-        RSAPublicKey: The loaded RSA public key object.
+        Any: What the function returns
     """
-    with open(filename, "rb") as f:
-        public_key_bytes = f.read()
-        public_key = serialization.load_pem_public_key(
-            public_key_bytes,
-            backend=default_backend()
-        )
-    return public_key
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(blocking_pool,functools.partial(context.run,func,*args,**kwargs))
 
-# Function to encrypt data using the public key
-def encrypt_data(data : Annotated[str,"The data to be encrypted"],
-                 public_key: Annotated[RSAPublicKey,"The public key of the client"]
-                  ) -> Annotated[bytes,"The encoded string"]:
+#Function to find a client
+def lookup_client(client_id : Annotated[str,"The client ID"]) -> Annotated[Union[ClientID_Table,None],"The client or None"]:
+    """
+    Gets a client from the client registry, timed as the client_lookup stage
+    """
+    with metrics.timer('client_lookup'):
+        return client_registry.get(client_id)
+
+#Function to get the public key of a client
+def load_client_key(client : Annotated[ClientID_Table,"The client"]) -> Annotated[Any,"The public key of the client"]:
+    """
+    Gets the public key of a client from the key registry, timed as the key_load stage
+    """
+    with metrics.timer('key_load'):
+        return key_registry.get(client.client_id,client.key_name)
+
+#Function to fill in the intent of a stored dm
+def store_intent(client : Annotated[ClientID_Table,"The client who got the message"],
+                 seq : Annotated[int,"The seq of the stored record"],
+                 classification : Annotated[str,"The class label of the message"],
+                 public_key : Annotated[Any,"The public key of the client"],
+                 version : Annotated[int,"The record format of the stored record"],
+                 data_key : Annotated[Any,"The data key of the record for the envelope format"]) -> None:
     """
-    Encrypt a data using a client's public key
+    Encrypts the class label of a DM the same way as the rest of its record and stores it
 
     Args:
-        data (str): The data that needs to be encoded
+        client (ClientID_Table): The client who got the message
+        seq (int): The seq of the record returned by the DM store
+        classification (str): The class label of the message
         public_key (RSAPublicKey): The public key of the client
-    
-    Returns:
-        bytes: The encoded data byte string
-    """
-    encrypted_data = public_key.encrypt(
-        data.encode(),
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    return encrypted_data
+        version (int): FORMAT_RSA or FORMAT_ENVELOPE
+        data_key (Optional[Tuple[bytes,bytes]]): The data key the record was sealed with
+    """
+    with metrics.timer('encrypt'):
+        intent = encrypt_record({'intent':classification},public_key,version,data_key)['intent']
+    with metrics.timer('storage_write'):
+        dm_store.set_intent(client,seq,intent)
+
+#Function to turn a dm into a record ready to be stored
+def prepare_dm(insta_id : Annotated[str,"The instagram id of the user who sent the message"],
+               message : Annotated[str,"The message the instagram id user has sent"],
+               public_key : Annotated[Any,"The public key of the client"],
+               version : Annotated[int,"The record format to write"],
+               data_key : Annotated[Any,"The data key for the envelope format"]
+               ) -> Annotated[Tuple[Dict[str,Any],Union[str,None]],"The record and its class label"]:
+    """
+    Classifies a DM right away if it is a repeat or an obvious one and encrypts it into a record
+
+    Args:
+        insta_id (str): The instagram id of the user who sent the message
+        message (str): The message the user sent
+        public_key (RSAPublicKey): The public key of the client
+        version (int): FORMAT_RSA or FORMAT_ENVELOPE
+        data_key (Optional[Tuple[bytes,bytes]]): The data key to seal the record with
 
-#Function to classify dm
-def classify_dm(message : Annotated[str,"The message that the user sent"]
-                ) -> Annotated[str,"The classification for the message"]:
+    Returns:
+        Tuple[Dict[str,Any],Optional[str]]: The encrypted record, and its class label
+            or None if the intent is pending and the DM needs to go to the classification queue
+    """
+    with metrics.timer('classify_local'):
+        classification = classification_cache.get(message)
+        if classification is None:
+            classification = local_classifier.classify(message)
+
+    fields = {
+        'insta_id' : insta_id,
+        'message' : message
+    }
+    if classification is not None:
+        fields['intent'] = classification
+    with metrics.timer('encrypt'):
+        record = encrypt_record(fields,public_key,version,data_key)
+    #a pending intent is filled in by the classification queue
+    record.setdefault('intent',None)
+    record['timestamp'] = datetime.datetime.now()
+    return record,classification
+
+#Function to classify a stored dm in the background
+def queue_classification(client : Annotated[ClientID_Table,"The client who got the message"],
+                         seq : Annotated[int,"The seq of the stored record"],
+                         message : Annotated[str,"The message the instagram id user has sent"],
+                         public_key : Annotated[Any,"The public key of the client"],
+                         version : Annotated[int,"The record format of the stored record"],
+                         data_key : Annotated[Any,"The data key of the record for the envelope format"],
+                         defer : Annotated[bool,"Classify when the classifier is idle"] = False) -> None:
+    """
+    Puts a stored DM with a pending intent on the classification queue, or aside till the queue is idle
+    when it is deferred. If the queue is full the intent is stored as None right away
     """
-    Classifies a DM sent to a client
+    def on_done(classification):
+        local_classifier.learn(message,classification)
+        store_intent(client,seq,classification,public_key,version,data_key)
+    job = ClassificationJob(client.client_id,seq,message,on_done)
+    if not (classification_queue.defer(job) if defer else classification_queue.submit(job)):
+        on_done('None')
+
+#Function to read a bulk ingestion body
+def parse_dm_batch(raw : Annotated[bytes,"The request body"]
+                   ) -> Annotated[List[Tuple[Any,Union[str,None]]],"The items and their parse errors"]:
+    """
+    Reads a JSON array or an NDJSON body of DMs
 
     Args:
-        message (str): The message received by the client
+        raw (bytes): The request body
 
-    Returns
-        str: The class label of the message
-                Casual: A normal message not enquiring about any product
-                Intent: A message that might have a mention of any product or item name
-                Desire: A message that may contain more details than just the name of the item or shows high desire to buy something
-                Order: A message that conveys that the user has ordered an item already or sending details to process an order
-                Collaboration: A message that may indicate that the user wants to collaborate on some project or deal     
+    Returns:
+        List[Tuple[Any,Optional[str]]]: Every item with None, or None with the error of an NDJSON line that is not JSON
+
+    Raises:
+        ValueError: If the body is not UTF-8 or is a JSON array that does not parse
     """
-    
-    try:
-        response = use_llm(
-            f"""
-    The following message is from a person on instagram. I want you to classify this message for my business
-    There are five classes in which you can put this message in
-    Casual: A normal message not enquiring about any product
-    Intent: A message that might have a mention of any product or item name
-    Desire: A message that may contain more details than just the name of the item or shows high desire to buy something
-    Order: A message that conveys that the user has ordered an item already or sending details to process an order
-    Collaboration: A message that may indicate that the user wants to collaborate on some project or deal
+    text = raw.decode('utf-8').strip()
+    if text.startswith('['):
+        items = json.loads(text)
+        if not isinstance(items,list):
+            raise ValueError("Expected a JSON array")
+        return [(item,None) for item in items]
+
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append((json.loads(line),None))
+        except json.JSONDecodeError as e:
+            items.append((None,f"Invalid JSON line: {e}"))
+    return items
+
+#Function to check if a stored dm is still waiting for its intent
+def is_pending(row : Annotated[Dict[str,Any],"A stored record"],
+               pending : Annotated[Set[int],"The seqs of the records still being classified"]) -> bool:
+    """
+    A DM is pending while it is on the classification queue of this process, or while its stored
+    intent is still None and it is younger than PENDING_MAX_AGE, as it may be on the queue of another
+    worker process or have come in after pending was read. DMs found pending by their intent are
+    added to pending, so they are kept when the DMs around them are removed
 
-    The user message is: {message}
+    Args:
+        row (Dict[str,Any]): A stored record
+        pending (Set[int]): The seqs of the records still being classified
 
-    Your answer must only be the class and nothing else
+    Returns:
+        bool: True if the DM has to wait for its intent
     """
-        )
+    if row['seq'] in pending:
+        return True
+    timestamp = row.get('timestamp')
+    if row.get('intent') is None and timestamp is not None and \
+            (datetime.datetime.now() - timestamp).total_seconds() < PENDING_MAX_AGE:
+        pending.add(row['seq'])
+        return True
+    return False
+
+#Function to get one page of the dms a client has received
+def get_dm_page(client : Annotated[ClientID_Table,"The client"],
+                cursor : Annotated[int,"The seq the client already has everything up to"],
+                page_size : Annotated[int,"The max number of DMs in the page"],
+                pending : Annotated[Set[int],"The seqs of the records still being classified"],
+                encode : Annotated[Callable,"Turns a stored record into a row of the response"] = encode_dm_row
+                ) -> Annotated[Tuple[List[Any],int,bool],"The rows, the next cursor and if there is more"]:
+    """
+    Reads the DMs after a cursor, at most page_size of them. The page stops right before
+    a DM that is still being classified so the cursor never moves past it
 
-        response = response.lower()
-        print(response)
-        if 'casual' in response:
-            return 'Casual'
-        elif 'intent' in response:
-            return 'Intent'
-        elif 'desire' in response:
-            return 'Desire'
-        elif 'order' in response:
-            return 'Order'
-        elif 'collaboration' in response:
-            return 'Collaboration'
-        else:
-            return 'None'
-    except Exception as e:
-        print(e)
-        return 'None'
+    Args:
+        client (ClientID_Table): The client
+        cursor (int): The seq the client already has everything up to, 0 to start from the beginning
+        page_size (int): The max number of DMs in the page
+        pending (Set[int]): The seqs of the records still being classified
+        encode (Callable): Turns a stored record into a row, encode_dm_row by default
 
-# Function to check if a client ID exists
-def client_id_exists(client_id: Annotated[str,"The new client ID"]) -> Annotated[bool,"Id exist status"]:
+    Returns:
+        Tuple[List[Dict[str,Any]],int,bool]: The rows, the cursor to ask for the next page with
+            and whether there are more DMs after this page
+    """
+    rows = []
+    next_cursor = cursor
+    has_more = False
+    with metrics.timer('storage_read'):
+        records = dm_store.iter_records(client,after=cursor)
+        try:
+            for row in records:
+                if is_pending(row,pending) or len(rows) == page_size:
+                    has_more = True
+                    break
+                rows.append(encode(row))
+                next_cursor = row['seq']
+        finally:
+            records.close()
+    return rows,next_cursor,has_more
+
+#Function to stream all the dms a client has received
+def stream_dm_details(client : Annotated[ClientID_Table,"The client"],
+                      pending : Annotated[Set[int],"The seqs of the records still being classified"],
+                      fmt : Annotated[str,"ndjson, frames or msgpack"] = 'ndjson'
+                      ) -> Annotated[Iterator[bytes],"The rows of the stream"]:
     """
-    Checks if a client id exists in the DB or not
+    Yields every DM of a client as a row of a stream format while it is read from the store,
+    once all of them are sent the ones that were sent are removed from the server
 
     Args:
-        client_id (str): The client's id
+        client (ClientID_Table): The client
+        pending (Set[int]): The seqs of the records still being classified, these are left for the next copy
+        fmt (str): The stream format, one of STREAM_FORMATS
 
     Returns:
-        bool: True if the id exists or False
+        Iterator[bytes]: The start of the stream and then one row per DM
     """
-    # Query the client_tables table for the client_id
-    query = session.query(ClientID_Table).filter(
-        ClientID_Table.client_id == client_id).first()
-    return query is not None
+    encode = row_encoder(fmt)
+    last_seq = 0
+    yield stream_start(fmt)
+    for row in dm_store.iter_records(client):
+        if is_pending(row,pending):
+            continue
+        last_seq = row['seq']
+        yield encode(row)
+    #dms that came in while streaming are after last_seq and stay for the next copy
+    client_registry.record_delivery(client.client_id,last_seq)
+    acknowledge_dms(client,last_seq,pending)
 
 #Function to get the dms a client has received
-def get_dm_details(client_id : Annotated[str, "The client ID"]
+def get_dm_details(client_id : Annotated[str, "The client ID"],
+                   skip : Annotated[Union[Set[int],None],"The seqs of the records to leave out"] = None
                    ) -> Annotated[Union[List[Dict[str, Any]], str],"Returns dictionary of rows or error string"]:
     """
     Get all the DMs that a client has received in a given time
 
     Args:
         client_id (str): The id of the client
+        skip (Optional[Set[int]]): The seqs of the records to leave out, like the ones still being classified.
+            DMs found pending by their intent are added to it
 
     Returns:
         Union[List[Dict[str, Any]], str]: The function can either return
@@ -176,32 +375,46 @@ def get_dm_details(client_id : Annotated[str, "The client ID"]
             
             A string telling what error happened
     """
+    skip = set() if skip is None else skip
     try:
-        session = Session()
-        client = session.query(ClientID_Table).filter(ClientID_Table.client_id == client_id).first()
-        data_bin = None
-        with open(client.bin_name,'rb') as file:
-            data_bin = pk.load(file)
-        row_details = [{
-            'insta_id': base64.b64encode(row['insta_id']).decode('utf-8'),
-            'message': base64.b64encode(row['message']).decode('utf-8'),
-            'intent': base64.b64encode(row['intent']).decode('utf-8'),
-            'timestamp': row['timestamp'].strftime("%d-%m-%y %H:%M:%S.%f")[:-3]
-        } for row in data_bin]
-        print(row_details)
-        session.close()
+        client = lookup_client(client_id)
+        with metrics.timer('storage_read'):
+            data_bin = dm_store.read_all(client)
+        row_details = [encode_dm_row(row) for row in data_bin if not is_pending(row,skip)]
         return row_details
     except Exception as e:
         return f"Failed due to {e}"
 
+#Function to remove the dms a client has confirmed
+def acknowledge_dms(client : Annotated[ClientID_Table,"The client"],
+                    through : Annotated[int,"The seq the client has everything up to"],
+                    keep : Annotated[Union[Set[int],None],"The seqs of the records to keep"] = None) -> None:
+    """
+    Removes the DMs a client has confirmed it has, the ones with a seq up to through,
+    and saves through as the last acknowledged seq of the client
+
+    Args:
+        client (ClientID_Table): The client
+        through (int): The seq the client has everything up to
+        keep (Optional[Set[int]]): The seqs of the records to keep, like the ones still being classified
+    """
+    with metrics.timer('storage_write'):
+        dm_store.trim(client,through,keep)
+    client_registry.record_ack(client.client_id,through)
+
 #Function to clear the dm details
-def clear_dm_details(client_id: Annotated[str, "The client ID"]
+def clear_dm_details(client_id: Annotated[str, "The client ID"],
+                     through : Annotated[int,"The highest seq that was copied"],
+                     keep : Annotated[Union[Set[int],None],"The seqs of the records to keep"] = None
                      ) -> Annotated[Tuple[bool, str], "A tuple with status and message"]:
     """
-    Clears the server copy of all the DMs that the client id received
+    Clears the server copy of the DMs that the client id received up to the last one that was copied,
+    DMs that came in after the copy stay on the server
 
     Args:
         client_id (str): The id of the client
+        through (int): The highest seq that was copied
+        keep (Optional[Set[int]]): The seqs of the records to keep, like the ones still being classified
 
     Returns
         Tuple[bool,str]: It returns either
@@ -212,19 +425,279 @@ def clear_dm_details(client_id: Annotated[str, "The client ID"]
             False,"Error mesage" if the clearing was unsuccessful and the error message
     """
     try:
-        session = Session()
-        client = session.query(ClientID_Table).filter(
-            ClientID_Table.client_id == client_id).first()
-        data_bin = []
-        with open(client.bin_name,'wb') as file:
-            pk.dump(data_bin,file)
-        session.close()
+        acknowledge_dms(lookup_client(client_id),through,keep)
         return True,"Success"
     except Exception as e:
         return False,f"Failed due to {e}"
     
+#Function to add a client
+def add_client(client : Annotated[ClientID_Table,"The new client"]) -> Annotated[bool,"False if the client already exists"]:
+    """
+    Creates the DM store of a new client and saves the client in the DB. An existing client is
+    left as it is, its DMs and cursors stay. The seqs of the store start past any cursor saved
+    for the client id, so a client never gets a DM with a seq it has already synced past
+    """
+    if client_registry.get(client.client_id) is not None:
+        return False
+    sync = client_registry.refresh_sync(client.client_id)
+    dm_store.create(client,max(sync['last_delivered_seq'],sync['last_acked_seq']) + 1)
+    try:
+        client_registry.add(client)
+    except IntegrityError:
+        #created by another request at the same time
+        return False
+    return True
+
+#Function to encrypt and store one dm
+def add_dm(client : Annotated[ClientID_Table,"The client who got the message"],
+           insta_id : Annotated[str,"The instagram id of the user who sent the message"],
+           message : Annotated[str,"The message the instagram id user has sent"],
+           defer : Annotated[bool,"Classify when the classifier is idle"] = False) -> Annotated[int,"The seq of the stored DM"]:
+    """
+    Encrypts and stores a DM, sending it to the classification queue if its intent is not known yet
+    """
+    client_public_key = load_client_key(client)
+
+    version = get_encryption_mode()
+    with metrics.timer('encrypt'):
+        data_key = new_data_key(client_public_key) if version == FORMAT_ENVELOPE else None
+    record,classification = prepare_dm(insta_id,message,client_public_key,version,data_key)
+    with metrics.timer('storage_write'):
+        seq = dm_store.append(client,record)
+
+    if classification is None:
+        queue_classification(client,seq,message,client_public_key,version,data_key,defer)
+    return seq
+
+#Function to encrypt and store a batch of dms
+def add_dms(client : Annotated[ClientID_Table,"The client who got the messages"],
+            items : Annotated[List[Tuple[Any,Union[str,None]]],"The items from parse_dm_batch"],
+            defer : Annotated[bool,"Classify when the classifier is idle"] = False
+            ) -> Annotated[Dict[str,Any],"The response content"]:
+    """
+    Validates, encrypts and stores a batch of DMs in one append, DMs that were already
+    received are acknowledged with the seq of the first copy and not stored again.
+    A DM that cannot be encrypted fails on its own, the rest of the batch is still stored
+
+    Args:
+        client (ClientID_Table): The client who got the messages
+        items (List[Tuple[Any,Optional[str]]]): The items and their parse errors
+        defer (bool): Leave the classification of the DMs till the classifier is idle
+
+    Returns:
+        Dict[str,Any]: The accepted, duplicate and failed counts with a status for every item
+    """
+    client_public_key = load_client_key(client)
+
+    #one data key is shared by the whole batch
+    version = get_encryption_mode()
+    with metrics.timer('encrypt'):
+        data_key = new_data_key(client_public_key) if version == FORMAT_ENVELOPE else None
+
+    statuses = [None] * len(items)
+    prepared = []
+    claimed = []
+    repeats = []
+    duplicates = 0
+    try:
+        for index,(item,error) in enumerate(items):
+            if error is None:
+                try:
+                    dm = DM_Details.model_validate(item)
+                except ValidationError as e:
+                    error = f"Invalid DM details: {e.errors(include_url=False,include_input=False)}"
+            if error is not None:
+                statuses[index] = {'index':index,'status':'failed','error':error}
+                continue
+            keys = dedup_index.keys_for(dm.insta_id,dm.message,dm.idempotency_key)
+            new,seq = dedup_index.claim(client.client_id,keys)
+            if not new:
+                duplicates += 1
+                statuses[index] = {'index':index,'status':'duplicate','seq':seq}
+                if seq is None:
+                    #a copy of a DM earlier in the batch gets its seq once the batch is stored
+                    repeats.append((index,keys))
+                continue
+            try:
+                record,classification = prepare_dm(dm.insta_id,dm.message,client_public_key,version,data_key)
+            except Exception as e:
+                #only this DM failed, it can be sent again
+                dedup_index.release(client.client_id,keys)
+                statuses[index] = {'index':index,'status':'failed','error':str(e)}
+                continue
+            claimed.append(keys)
+            prepared.append((index,dm,keys,record,classification))
+
+        #every record of the batch is stored in one go
+        with metrics.timer('storage_write'):
+            seqs = dm_store.append_many(client,[record for _,_,_,record,_ in prepared])
+    except Exception:
+        #nothing was stored, so the DMs can be sent again
+        for keys in claimed:
+            dedup_index.release(client.client_id,keys)
+        raise
+
+    for (index,dm,keys,record,classification),seq in zip(prepared,seqs):
+        dedup_index.complete(client.client_id,keys,seq)
+        if classification is None:
+            queue_classification(client,seq,dm.message,client_public_key,version,data_key,defer)
+        intent = 'classified' if classification else 'deferred' if defer else 'pending'
+        statuses[index] = {'index':index,'status':'ok','seq':seq,'intent':intent}
+    stored = {keys[0]:seq for (_,_,keys,_,_),seq in zip(prepared,seqs) if keys}
+    for index,keys in repeats:
+        statuses[index]['seq'] = next((stored[key] for key in keys if key in stored),None)
+
+    return {
+        "message": "Success",
+        "accepted": len(prepared),
+        "duplicates": duplicates,
+        "failed": len(items) - len(prepared) - duplicates,
+        "items": statuses
+    }
+
+#Function to copy one page of dms
+def copy_dm_page(client : Annotated[ClientID_Table,"The client"],
+                 cursor : Annotated[int,"The next_cursor of the last page"],
+                 page_size : Annotated[int,"The max number of DMs in the page"],
+                 pending : Annotated[Set[int],"The seqs of the records still being classified"],
+                 encode : Annotated[Callable,"Turns a stored record into a row of the response"] = encode_dm_row
+                 ) -> Annotated[Tuple[Union[List[Any],None],int,bool],"The rows, the next cursor and if there is more"]:
+    """
+    Removes the DMs up to the cursor, the client has them already, and reads the next page.
+    A cursor past the last one handed out removes nothing, the rows are None and the
+    cursor returned is the last one handed out
+    """
+    last_delivered_seq = ack_dm_cursor(client,cursor,pending)
+    if last_delivered_seq is not None:
+        return None,last_delivered_seq,False
+    row_details,next_cursor,has_more = get_dm_page(client,cursor,page_size,pending,encode)
+    client_registry.record_delivery(client.client_id,next_cursor)
+    return row_details,next_cursor,has_more
+
+#Function to copy all the dms and clear the copied ones
+def copy_all_dm_details(client_id : Annotated[str,"The client ID"],
+                        pending : Annotated[Set[int],"The seqs of the records still being classified"]
+                        ) -> Annotated[Tuple[Dict[str,Any],int],"The response content and status code"]:
+    """
+    Reads every DM of a client and clears the ones that were read from the server
+    """
+    row_details = get_dm_details(client_id,pending)
+    if isinstance(row_details,str):
+        return {'failed': f"While reading {row_details}"},500
+    #only what was copied is cleared, dms that came in meanwhile stay for the next copy
+    through = max((row['seq'] for row in row_details),default=0)
+    client_registry.record_delivery(client_id,through)
+    status,message = clear_dm_details(client_id,through,pending)
+
+    if not status:
+        return {'failed': f"While deleting {message}"},500
+    return {'db_details':row_details},200
+
+#Function to read the dms after a cursor without removing them
+def sync_dm_page(client : Annotated[ClientID_Table,"The client"],
+                 since : Annotated[Union[int,None],"The cursor of the last sync or None for the last acknowledged one"],
+                 limit : Annotated[int,"The max number of DMs in the page"],
+                 pending : Annotated[Set[int],"The seqs of the records still being classified"]
+                 ) -> Annotated[Tuple[List[Dict[str,Any]],int,bool],"The rows, the cursor and if there is more"]:
+    """
+    Reads a page of DMs after a cursor and remembers the cursor that was handed out
+    """
+    if since is None:
+        since = client_registry.sync_state(client.client_id)['last_acked_seq']
+    row_details,cursor,has_more = get_dm_page(client,since,limit,pending)
+    client_registry.record_delivery(client.client_id,cursor)
+    return row_details,cursor,has_more
+
+#Function to check and apply an acknowledgement
+def ack_dm_cursor(client : Annotated[ClientID_Table,"The client"],
+                  cursor : Annotated[int,"The cursor the client has stored"],
+                  pending : Annotated[Set[int],"The seqs of the records still being classified"]
+                  ) -> Annotated[Union[int,None],"None or the last synced cursor if the cursor is past it"]:
+    """
+    Removes the DMs up to a cursor unless the cursor was never handed to the client.
+    A cursor that is not past the last acknowledged one has nothing new to remove, so
+    a client polling without moving its cursor does not write to the store
+    """
+    sync = client_registry.sync_state(client.client_id)
+    if cursor <= sync['last_acked_seq'] and not pending:
+        return None
+    last_delivered_seq = sync['last_delivered_seq']
+    if cursor > last_delivered_seq:
+        #the cursor may have been handed out by another process
+        last_delivered_seq = client_registry.refresh_sync(client.client_id)['last_delivered_seq']
+    #a cursor the client was never given would remove DMs it has not seen
+    if cursor > last_delivered_seq:
+        return last_delivered_seq
+    acknowledge_dms(client,cursor,pending)
+    return None
+
+#Function to turn away an ingest request
+def too_many_requests(client_id : Annotated[str,"The client ID"],
+                      retry_after : Annotated[float,"The seconds till the request would be let in"]) -> JSONResponse:
+    """
+    Returns the 429 response for a request the admission controller did not let in
+    """
+    retry_after = max(1,math.ceil(retry_after))
+    content = {"failed": f"Too many DMs for {client_id}, retry in {retry_after} seconds"}
+    return JSONResponse(content=content,status_code=429,headers={'Retry-After':str(retry_after)})
+
+#Function to split the classification cache lookups by result for the metrics
+def cache_lookups(stats : Annotated[Dict[str,Any],"The classification cache stats"]) -> Dict[Tuple,int]:
+    return {
+        (('result','memory_hit'),): stats['hits'] - stats['disk_hits'],
+        (('result','disk_hit'),): stats['disk_hits'],
+        (('result','miss'),): stats['misses']
+    }
+
 #============================================FASTAPI===============================================
-class Client_Details(BaseModel):
+@app.on_event('startup')
+def load_client_registry():
+    loaded = client_registry.load()
+    print(f"Loaded {loaded} clients")
+
+@app.on_event('startup')
+def warm_key_registry():
+    loaded = key_registry.warm(client_registry.clients())
+    print(f"Loaded {loaded} client public keys")
+
+@app.on_event('startup')
+def start_classification_queue():
+    classification_queue.start()
+
+@app.on_event('shutdown')
+def stop_classification_queue():
+    classification_queue.stop()
+    if local_classifier.learn_online:
+        local_classifier.save()
+
+@app.on_event('startup')
+def register_gauges():
+    metrics.gauge('classify_queue_jobs','Classification jobs waiting, by state',lambda:{
+        (('state',state),):value for state,value in classification_queue.stats().items() if state in ('depth','deferred','pending')})
+    metrics.gauge('ingest_in_flight','Ingest requests being handled',lambda:admission.stats(top=0)['in_flight'])
+    metrics.gauge('clients','Clients in the client registry',lambda:client_registry.stats()['size'])
+    metrics.counter('classify_cache_lookups_total','Classification cache lookups, by result',lambda:cache_lookups(classification_cache.stats()))
+    metrics.gauge('classify_cache_hit_ratio','Share of classification cache lookups that were hits',lambda:classification_cache.stats()['hit_rate'])
+    metrics.gauge('classify_cache_entries','Labels in the classification cache',lambda:classification_cache.stats()['size'])
+
+@app.on_event('startup')
+def start_compactor():
+    compactor.start()
+
+@app.on_event('shutdown')
+def stop_compactor():
+    compactor.stop()
+
+@app.on_event('shutdown')
+def stop_blocking_pool():
+    blocking_pool.shutdown(wait=True)
+
+class Retention_Details(BaseModel):
+    retain_max_age : Annotated[Union[float,None],"The seconds DMs are kept for, 0 for no limit, None for the server default"] = None
+    retain_max_records : Annotated[Union[int,None],"The max number of DMs kept, 0 for no limit, None for the server default"] = None
+    retain_max_bytes : Annotated[Union[int,None],"The max bytes of DMs kept, 0 for no limit, None for the server default"] = None
+
+class Client_Details(Retention_Details):
     client_name: Annotated[str,"The client name"]
     client_id: Annotated[str,"The client id"]
     business_name: Annotated[str,"The business name"]
@@ -232,26 +705,28 @@ class Client_Details(BaseModel):
 class DM_Details(BaseModel):
     insta_id : Annotated[str,"The instagram id of the user who sent the message"]
     message : Annotated[str,"The message the instagram id user has sent"]
+    idempotency_key : Annotated[Union[str,None],"A key that is the same every time the DM is sent again"] = None
+
+class Ack_Details(BaseModel):
+    cursor : Annotated[int,"The cursor of the last sync the client has stored"]
 
 @app.post('/create_client',response_class=JSONResponse,description="Creates a new client in the DB")
 async def create_client(body:Client_Details = Body(...,description="The client details to enter")):
     try:
-        session = Session()
         client = ClientID_Table(
             client_id = body.client_id,
             client_name = body.client_name,
             business_name = body.business_name,
             bin_name = f'./db/data_bins/{body.client_id}.data',
-            key_name = f'./db/public_keys/{body.client_id}.pem'
+            key_name = f'./db/public_keys/{body.client_id}.pem',
+            retain_max_age = body.retain_max_age,
+            retain_max_records = body.retain_max_records,
+            retain_max_bytes = body.retain_max_bytes
         )
 
-        data_bin = []
-        with open(client.bin_name,'wb') as file:
-            pk.dump(data_bin,file)
-
-        session.add(client)
-        session.commit()
-        session.close()
+        if not await run_blocking(add_client,client):
+            content = {'failed':f"Client {body.client_id} already exists"}
+            return JSONResponse(content=content,status_code=409)
 
         content = {'message':'Success'}
 
@@ -264,38 +739,37 @@ async def create_client(body:Client_Details = Body(...,description="The client d
 
 @app.post('/new_dm/{client_id}',response_class=JSONResponse,description="Adds a new DM into the DB")
 async def new_dm(client_id:str = Path(...,description="The client id who got the message"),
-                 body:DM_Details = Body(...,description = "The DM details captured by the API")):
+                 body:DM_Details = Body(...,description = "The DM details captured by the API"),
+                 idempotency_key:Union[str,None] = Header(None,description="A key that is the same every time the DM is sent again")):
     try:
-        session = Session()
-        if not client_id_exists(client_id):
+        client = await run_blocking(lookup_client,client_id)
+        if client is None:
             content = {"failed": f"Client Does not Exist, Please Contact Admin"}
             return JSONResponse(content=content, status_code=404)
         else:
-            client = session.query(ClientID_Table).filter(
-                ClientID_Table.client_id == client_id).first()
-            databin = None
-            with open(client.bin_name,'rb') as file:
-                databin = pk.load(file)
-            
-            client_public_key = load_public_key(client.key_name)
-
-            #classify the dm
-            classification = classify_dm(body.message)
-
-
-            databin.append(
-                {
-                    'insta_id' : encrypt_data(body.insta_id,client_public_key),
-                    'message' : encrypt_data(body.message,client_public_key),
-                    'intent' : encrypt_data(classification,client_public_key),
-                    'timestamp': datetime.datetime.now()
-                }
-            )
-
-            with open(client.bin_name,'wb') as file:
-                pk.dump(databin,file)
+            #a DM sent again is acknowledged without classifying, encrypting or storing it
+            keys = dedup_index.keys_for(body.insta_id,body.message,idempotency_key or body.idempotency_key)
+            new,seq = dedup_index.claim(client_id,keys)
+            if not new:
+                content = {"message": "Success","duplicate": True,"seq": seq}
+                return JSONResponse(content=content, status_code=200)
+
+            decision,retry_after = admission.enter(client_id)
+            if decision == REJECT:
+                dedup_index.release(client_id,keys)
+                return too_many_requests(client_id,retry_after)
+            try:
+                seq = await run_blocking(add_dm,client,body.insta_id,body.message,decision != ADMIT)
+            except Exception:
+                dedup_index.release(client_id,keys)
+                raise
+            finally:
+                admission.leave(client_id)
+            dedup_index.complete(client_id,keys,seq)
 
             content = {"message": "Success"}
+            if decision != ADMIT:
+                content['classification'] = 'deferred'
             return JSONResponse(content=content, status_code=200)
     
     except Exception as e:
@@ -303,35 +777,211 @@ async def new_dm(client_id:str = Path(...,description="The client id who got the
         content = {"failed" : f"Failed in new_dm due to {e}"}
         return JSONResponse(content=content,status_code=500)
 
- 
+
+
+@app.post('/new_dms/{client_id}',response_class=JSONResponse,description="Adds a batch of DMs into the DB, the body is a JSON array or NDJSON of DM details")
+async def new_dms(request:Request,
+                  client_id:str = Path(...,description="The client id who got the messages")):
+    try:
+        client = await run_blocking(lookup_client,client_id)
+        if client is None:
+            content = {"failed": f"Client Does not Exist, Please Contact Admin"}
+            return JSONResponse(content=content, status_code=404)
+
+        try:
+            items = await run_blocking(parse_dm_batch,await request.body())
+        except ValueError as e:
+            content = {"failed": f"Could not read the DMs due to {e}"}
+            return JSONResponse(content=content, status_code=400)
+        if len(items) > BULK_MAX_ITEMS:
+            content = {"failed": f"At most {BULK_MAX_ITEMS} DMs can be sent in one request"}
+            return JSONResponse(content=content, status_code=413)
+
+        decision,retry_after = admission.enter(client_id,max(1,len(items)))
+        if decision == REJECT:
+            return too_many_requests(client_id,retry_after)
+        try:
+            content = await run_blocking(add_dms,client,items,decision != ADMIT)
+        finally:
+            admission.leave(client_id)
+        return JSONResponse(content=content, status_code=200)
+
+    except Exception as e:
+        traceback.print_exc()
+        content = {"failed" : f"Failed in new_dms due to {e}"}
+        return JSONResponse(content=content,status_code=500)
+
+
 @app.get('/copy_dms/{client_id}',response_class=JSONResponse,description="Returns all the DM of a client and clears them in the server")
-async def copy_dms(client_id:str = Path(...,description="The client id requesting updates")):
+async def copy_dms(request:Request,
+                   client_id:str = Path(...,description="The client id requesting updates"),
+                   pending:str = Query('wait',pattern='^(wait|skip)$',description="wait for DMs still being classified or skip them till the next copy"),
+                   format:Union[str,None] = Query(None,pattern='^(json|ndjson|frames|msgpack)$',description="json for one JSON body, ndjson to stream one DM per line, frames or msgpack to stream raw ciphertexts. Defaults to the Accept header, then json"),
+                   page_size:Union[int,None] = Query(None,ge=1,le=10000,description="Return at most this many DMs after the cursor"),
+                   cursor:int = Query(0,ge=0,description="With page_size, the next_cursor of the last page. The DMs up to it are removed from the server")):
     try:   
-        session = Session()
-        current_time = datetime.datetime.now()
-        last_update_record = session.query(LastUpdate).filter(LastUpdate.client_id == client_id).first()
-        if last_update_record is None:
-            last_update = LastUpdate(client_id = client_id,last_updated_time = current_time)
-            session.add(last_update)
-            session.commit()
-            last_update_record = session.query(LastUpdate).filter(LastUpdate.client_id == client_id).first()
-
-        last_update_record.last_updated_time = current_time
-        session.commit()
-        row_details = get_dm_details(client_id)
-        status,message = clear_dm_details(client_id)
-
-        if not status:
-            content = {'failed': f"While deleting {message}"}
-            return JSONResponse(content=content,status_code=500)
-        
-        content = {'db_details':row_details}
-        return JSONResponse(content=content,status_code=200)
+        if format is None:
+            format = negotiate_format(request.headers.get('accept')) or 'json'
+        elif format not in available_formats():
+            content = {"failed": f"The {format} format is not available on this server"}
+            return JSONResponse(content=content, status_code=406)
+        #gzip, or zstd when it is installed, if the client accepts it
+        encoding = negotiate_encoding(request.headers.get('accept-encoding')) if COPY_COMPRESSION else None
+        headers = {'Vary':'Accept, Accept-Encoding'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+
+        if pending == 'wait':
+            #waiting is idle time, it stays on the default executor and off the blocking pool
+            await asyncio.get_running_loop().run_in_executor(
+                None,classification_queue.wait_for_client,client_id,CLASSIFY_WAIT_TIMEOUT)
+        #DMs still being classified stay on the server for the next copy
+        pending_seqs = classification_queue.pending_seqs(client_id)
+
+        if page_size is not None or format in STREAM_FORMATS:
+            client = await run_blocking(lookup_client,client_id)
+            if client is None:
+                content = {"failed": f"Client Does not Exist, Please Contact Admin"}
+                return JSONResponse(content=content, status_code=404)
+
+            if page_size is None:
+                #a sync generator is iterated in a worker thread by StreamingResponse
+                return StreamingResponse(compress(stream_dm_details(client,pending_seqs,format),encoding),
+                                         media_type=MEDIA_TYPES[format],headers=headers)
+
+            #the client has everything up to the cursor, so that part of the backlog can go
+            encode = encode_dm_row if format == 'json' else row_encoder(format)
+            row_details,next_cursor,has_more = await run_blocking(copy_dm_page,client,cursor,page_size,pending_seqs,encode)
+            if row_details is None:
+                content = {"failed": f"Cursor {cursor} is past the last cursor handed out {next_cursor}"}
+                return JSONResponse(content=content, status_code=400)
+            if format in STREAM_FORMATS:
+                chunks = [stream_start(format)] + row_details + [encode_page_end(format,next_cursor,has_more)]
+            else:
+                content = {'db_details':row_details,'next_cursor':next_cursor,'has_more':has_more}
+                chunks = [json.dumps(content).encode()]
+            return Response(content=b''.join(compress(chunks,encoding)),media_type=MEDIA_TYPES[format],headers=headers)
+
+        content,status_code = await run_blocking(copy_all_dm_details,client_id,pending_seqs)
+        if status_code != 200:
+            return JSONResponse(content=content,status_code=status_code)
+        return Response(content=b''.join(compress([json.dumps(content).encode()],encoding)),media_type=MEDIA_TYPES['json'],headers=headers)
         
     except Exception as e:
         content = {'failed':f"In main {e}"}
         return JSONResponse(content=content,status_code=500)
-    
 
 
+@app.get('/sync_dms/{client_id}',response_class=JSONResponse,description="Returns the DMs of a client after a cursor without removing them")
+async def sync_dms(client_id:str = Path(...,description="The client id requesting updates"),
+                   since:Union[int,None] = Query(None,ge=0,description="The cursor of the last sync, defaults to the last acknowledged cursor"),
+                   limit:int = Query(500,ge=1,le=10000,description="Return at most this many DMs"),
+                   pending:str = Query('skip',pattern='^(wait|skip)$',description="wait for DMs still being classified or stop the page before them")):
+    try:
+        client = await run_blocking(lookup_client,client_id)
+        if client is None:
+            content = {"failed": f"Client Does not Exist, Please Contact Admin"}
+            return JSONResponse(content=content, status_code=404)
+
+        if pending == 'wait':
+            await asyncio.get_running_loop().run_in_executor(
+                None,classification_queue.wait_for_client,client_id,CLASSIFY_WAIT_TIMEOUT)
+        pending_seqs = classification_queue.pending_seqs(client_id)
+
+        row_details,cursor,has_more = await run_blocking(sync_dm_page,client,since,limit,pending_seqs)
+        content = {'db_details':row_details,'cursor':cursor,'has_more':has_more}
+        return JSONResponse(content=content,status_code=200)
+
+    except Exception as e:
+        traceback.print_exc()
+        content = {'failed':f"In sync_dms {e}"}
+        return JSONResponse(content=content,status_code=500)
+
+
+@app.post('/ack_dms/{client_id}',response_class=JSONResponse,description="Removes the DMs a client has stored, up to the cursor of a sync")
+async def ack_dms(client_id:str = Path(...,description="The client id acknowledging DMs"),
+                  body:Ack_Details = Body(...,description="The cursor of the last sync the client has stored")):
+    try:
+        client = await run_blocking(lookup_client,client_id)
+        if client is None:
+            content = {"failed": f"Client Does not Exist, Please Contact Admin"}
+            return JSONResponse(content=content, status_code=404)
+
+        last_delivered_seq = await run_blocking(ack_dm_cursor,client,body.cursor,classification_queue.pending_seqs(client_id))
+        if last_delivered_seq is not None:
+            content = {"failed": f"Cursor {body.cursor} is past the last synced cursor {last_delivered_seq}"}
+            return JSONResponse(content=content, status_code=400)
+
+        content = {'message':'Success','acked_cursor':body.cursor}
+        return JSONResponse(content=content,status_code=200)
+
+    except Exception as e:
+        traceback.print_exc()
+        content = {'failed':f"In ack_dms {e}"}
+        return JSONResponse(content=content,status_code=500)
+
+
+@app.post('/retention/{client_id}',response_class=JSONResponse,description="Sets how long and how many DMs are kept for a client")
+async def set_retention(client_id:str = Path(...,description="The client id to set the retention of"),
+                        body:Retention_Details = Body(...,description="The limits to change, the ones left out are not changed")):
+    try:
+        fields = {field:getattr(body,field) for field in body.model_fields_set}
+        client = await run_blocking(client_registry.update,client_id,**fields)
+        if client is None:
+            content = {"failed": f"Client Does not Exist, Please Contact Admin"}
+            return JSONResponse(content=content, status_code=404)
+
+        content = {'message':'Success','policy':compactor.policy.for_client(client).as_dict()}
+        return JSONResponse(content=content,status_code=200)
+
+    except Exception as e:
+        content = {'failed':f"In set_retention {e}"}
+        return JSONResponse(content=content,status_code=500)
+
+
+@app.get('/stats/backlog',response_class=JSONResponse,description="Returns the DMs every client has waiting on the server as of the last compactor pass, the biggest backlogs come first")
+async def backlog_stats(top:int = Query(20,ge=0,description="Return this many clients, 0 for all")):
+    return JSONResponse(content=compactor.stats(top),status_code=200)
+
+
+@app.get('/metrics',response_class=PlainTextResponse,description="Returns the stage timers, request counters and gauges in the Prometheus text format")
+async def prometheus_metrics():
+    return PlainTextResponse(content=metrics.render(),media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.get('/stats/stages',response_class=JSONResponse,description="Returns the count and mean time of every hot path stage")
+async def stage_stats():
+    return JSONResponse(content=metrics.stats(),status_code=200)
+
+
+@app.get('/stats/llm',response_class=JSONResponse,description="Returns the LLM gateway calls, retries, latency and tokens per call site")
+async def llm_stats():
+    return JSONResponse(content=get_gateway().stats(),status_code=200)
+
+
+@app.get('/stats/clients',response_class=JSONResponse,description="Returns the client registry counters")
+async def client_stats():
+    return JSONResponse(content=client_registry.stats(),status_code=200)
+
+
+@app.get('/stats/limits',response_class=JSONResponse,description="Returns the ingest limiter state, the clients turned away the most come first")
+async def limit_stats(top:int = Query(20,ge=0,description="Return this many clients, 0 for all")):
+    return JSONResponse(content=admission.stats(top),status_code=200)
+
+
+@app.get('/stats/dedup',response_class=JSONResponse,description="Returns how many ingested DMs were duplicates")
+async def dedup_stats():
+    return JSONResponse(content=dedup_index.stats(),status_code=200)
+
+
+@app.get('/stats/keys',response_class=JSONResponse,description="Returns the public key cache counters")
+async def key_stats():
+    return JSONResponse(content=key_registry.stats(),status_code=200)
+
 
+@app.get('/stats/classifier',response_class=JSONResponse,description="Returns the classification queue depth and age metrics")
+async def classifier_stats():
+    content = classification_queue.stats()
+    content['local'] = local_classifier.stats()
+    content['cache'] = classification_cache.stats()
+    return JSONResponse(content=content,status_code=200)
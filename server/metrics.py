@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing_extensions import Annotated,Dict,List,Tuple,Optional,Callable,Iterator
+from typing import Any
+
+# Upper bounds in seconds of the latency histogram buckets, from a memory hit to an LLM call
+LATENCY_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0)
+
+# The stage timings of the request being handled, run_blocking carries it over to the blocking pool
+_request_stages = contextvars.ContextVar('request_stages',default=None)
+
+
+class Histogram:
+    """
+    A cumulative latency histogram with a count and a sum, the way Prometheus exports one
+    """
+
+    def __init__(self,buckets : Annotated[Tuple[float,...],"The upper bounds of the buckets"] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self,value : Annotated[float,"The seconds taken"]) -> None:
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str,int]]:
+        # The (le, count) pairs of the exposition format, the last one is +Inf
+        pairs = []
+        total = 0
+        for bound,count in zip(self.buckets + (float('inf'),),self.counts):
+            total += count
+            pairs.append(('+Inf' if bound == float('inf') else repr(bound),total))
+        return pairs
+
+
+def _labels(**labels) -> str:
+    escape = lambda value:str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name,value in labels.items()) + '}'
+
+
+class MetricsRegistry:
+    """
+    The per-stage timers and per-endpoint request counters of the server, with gauges read
+    from the other components when the metrics are scraped
+    """
+
+    def __init__(self,prefix : Annotated[str,"The prefix of every metric name"] = 'mazduur'):
+        self.prefix = prefix
+        self._stages = {}
+        self._requests = {}
+        self._request_latency = {}
+        self._errors = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    #==========================================RECORDING===========================================
+    def observe(self,stage : Annotated[str,"The stage name"],seconds : Annotated[float,"The seconds taken"]) -> None:
+        """
+        Records the time a stage took, in the stage histogram and in the timings of the current request
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage,0.0) + seconds
+
+    @contextmanager
+    def timer(self,stage : Annotated[str,"The stage name"]) -> Iterator[None]:
+        """
+        Times the block under it as a stage, the time is recorded even if the block raises
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage,time.perf_counter() - started)
+
+    def record_request(self,endpoint : Annotated[str,"The route path"],
+                       method : Annotated[str,"The HTTP method"],
+                       status : Annotated[int,"The response status"],
+                       seconds : Annotated[float,"The seconds the request took"],
+                       error : Annotated[bool,"If the request raised or answered with a 5xx"] = False) -> None:
+        """Counts a finished request and records its latency"""
+        with self._lock:
+            key = (endpoint,method,status)
+            self._requests[key] = self._requests.get(key,0) + 1
+            histogram = self._request_latency.get((endpoint,method))
+            if histogram is None:
+                histogram = self._request_latency[(endpoint,method)] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                self._errors[(endpoint,method)] = self._errors.get((endpoint,method),0) + 1
+
+    def gauge(self,name : Annotated[str,"The metric name without the prefix"],
+              help_text : Annotated[str,"The HELP line"],
+              read : Annotated[Callable[[],Any],"Returns the value, or a dict of label tuples to values"]) -> None:
+        """
+        Registers a gauge that is read when the metrics are scraped.
+        read returns a number, or a dict mapping ((label,value),...) tuples to numbers
+        """
+        self._gauges.append((name,help_text,read,'gauge'))
+
+    def counter(self,name : Annotated[str,"The metric name without the prefix, ending in _total"],
+                help_text : Annotated[str,"The HELP line"],
+                read : Annotated[Callable[[],Any],"Returns the value, or a dict of label tuples to values"]) -> None:
+        """
+        Registers a counter kept by another component, read when the metrics are scraped
+        the same way as a gauge
+        """
+        self._gauges.append((name,help_text,read,'counter'))
+
+    #==========================================EXPORT==============================================
+    def render(self) -> Annotated[str,"The metrics in the Prometheus text format"]:
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+        lines = []
+        prefix = self.prefix
+        with self._lock:
+            stages = {stage:(histogram.cumulative(),histogram.sum,histogram.count) for stage,histogram in self._stages.items()}
+            latency = {key:(histogram.cumulative(),histogram.sum,histogram.count) for key,histogram in self._request_latency.items()}
+            requests = dict(self._requests)
+            errors = dict(self._errors)
+
+        lines.append(f'# HELP {prefix}_stage_seconds Time spent in each stage of the request hot path')
+        lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+        for stage,(buckets,total,count) in sorted(stages.items()):
+            for le,value in buckets:
+                lines.append(f'{prefix}_stage_seconds_bucket{_labels(stage=stage,le=le)} {value}')
+            lines.append(f'{prefix}_stage_seconds_sum{_labels(stage=stage)} {total}')
+            lines.append(f'{prefix}_stage_seconds_count{_labels(stage=stage)} {count}')
+
+        lines.append(f'# HELP {prefix}_requests_total Requests handled per endpoint, method and status')
+        lines.append(f'# TYPE {prefix}_requests_total counter')
+        for (endpoint,method,status),value in sorted(requests.items()):
+            lines.append(f'{prefix}_requests_total{_labels(endpoint=endpoint,method=method,status=status)} {value}')
+
+        lines.append(f'# HELP {prefix}_request_errors_total Requests per endpoint that raised or answered with a 5xx')
+        lines.append(f'# TYPE {prefix}_request_errors_total counter')
+        for (endpoint,method),value in sorted(errors.items()):
+            lines.append(f'{prefix}_request_errors_total{_labels(endpoint=endpoint,method=method)} {value}')
+
+        lines.append(f'# HELP {prefix}_request_seconds Time to handle a request per endpoint')
+        lines.append(f'# TYPE {prefix}_request_seconds histogram')
+        for (endpoint,method),(buckets,total,count) in sorted(latency.items()):
+            for le,value in buckets:
+                lines.append(f'{prefix}_request_seconds_bucket{_labels(endpoint=endpoint,method=method,le=le)} {value}')
+            lines.append(f'{prefix}_request_seconds_sum{_labels(endpoint=endpoint,method=method)} {total}')
+            lines.append(f'{prefix}_request_seconds_count{_labels(endpoint=endpoint,method=method)} {count}')
+
+        for name,help_text,read,kind in self._gauges:
+            try:
+                value = read()
+            except Exception as e:
+                print(f"Reading the gauge {name} failed due to {e}")
+                continue
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            if isinstance(value,dict):
+                for labels,item in value.items():
+                    lines.append(f'{prefix}_{name}{_labels(**dict(labels))} {item}')
+            else:
+                lines.append(f'{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def stats(self) -> Annotated[Dict[str,Any],"The stage timers as JSON"]:
+        """
+        Returns the count, total and mean milliseconds of every stage
+        """
+        with self._lock:
+            return {
+                stage:{
+                    'count': histogram.count,
+                    'total_ms': round(histogram.sum * 1000,3),
+                    'mean_ms': round(histogram.sum * 1000 / histogram.count,3) if histogram.count else 0.0
+                }
+                for stage,histogram in sorted(self._stages.items())
+            }
+
+
+metrics = MetricsRegistry()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every request, counts it per endpoint and status, and prints a
+    JSON line with its stage timings when REQUEST_LOG is on. Requests are labelled by the
+    route path, like /new_dm/{client_id}, so the number of series does not grow with clients
+    """
+
+    def __init__(self,app,registry : Annotated[MetricsRegistry,"The registry to record in"] = metrics,
+                 log_requests : Annotated[Optional[bool],"Print a timing line per request"] = None):
+        self.app = app
+        self.registry = registry
+        self.log_requests = os.environ.get('REQUEST_LOG','1') == '1' if log_requests is None else log_requests
+
+    async def __call__(self,scope,receive,send):
+        if scope['type'] != 'http':
+            return await self.app(scope,receive,send)
+
+        stages = {}
+        token = _request_stages.set(stages)
+        started = time.perf_counter()
+        status = 500
+        error = False
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope,receive,send_wrapper)
+        except Exception:
+            error = True
+            raise
+        finally:
+            _request_stages.reset(token)
+            seconds = time.perf_counter() - started
+            route = scope.get('route')
+            endpoint = getattr(route,'path','unmatched')
+            error = error or status >= 500
+            self.registry.record_request(endpoint,scope['method'],status,seconds,error)
+            if self.log_requests:
+                print(json.dumps({
+                    'event': 'request',
+                    'method': scope['method'],
+                    'endpoint': endpoint,
+                    'path': scope['path'],
+                    'status': status,
+                    'ms': round(seconds * 1000,3),
+                    'stages_ms': {stage:round(value * 1000,3) for stage,value in stages.items()}
+                }))
@@ -1,12 +1,34 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, BLOB, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, BLOB, DateTime, inspect, text, event
 from sqlalchemy.ext.declarative import declarative_base
 from helper import get_database_url
+import os
 import datetime
 
 DATABASE_URL = get_database_url()
 print(DATABASE_URL)
+
+
+def configure_sqlite(engine) -> None:
+    """
+    Turns on WAL mode and a busy timeout on every connection of a SQLite engine.
+    With WAL readers do not block the writer, and with the busy timeout a writer waits for another
+    process to commit instead of failing, so several worker processes can share the DB
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    busy_timeout = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS','30000'))
+
+    @event.listens_for(engine,'connect')
+    def on_connect(dbapi_connection,connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={busy_timeout}')
+        cursor.close()
+
+
 # Define the database connection
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(DATABASE_URL, echo=os.environ.get('SQL_ECHO','0') == '1')
+configure_sqlite(engine)
 Base = declarative_base()
 
 
@@ -19,6 +41,10 @@ class ClientID_Table(Base):
     business_name = Column(String)
     bin_name = Column(String,unique=True)
     key_name = Column(String,unique=True)
+    #the retention of the client's DMs, None falls back to the server defaults and 0 turns a limit off
+    retain_max_age = Column(Float)
+    retain_max_records = Column(Integer)
+    retain_max_bytes = Column(Integer)
 
 
 class LastUpdate(Base):
@@ -27,8 +53,53 @@ class LastUpdate(Base):
     id = Column(Integer,primary_key=True,autoincrement=True)
     client_id = Column(String,unique=True)
     last_updated_time = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    #the highest seq handed to the client and the highest seq the client confirmed it has
+    last_delivered_seq = Column(Integer, nullable=False, default=0)
+    last_acked_seq = Column(Integer, nullable=False, default=0)
+
+
+class DM_Record(Base):
+    __tablename__ = "DM_Record_Table"
+    #ids are never reused, they are the seq of the records
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = Column(Integer,primary_key=True,autoincrement=True)
+    client_id = Column(String,index=True)
+    insta_id = Column(BLOB)
+    message = Column(BLOB)
+    intent = Column(BLOB)
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.now)
+    version = Column(Integer, nullable=False, default=1)
+    wrapped_key = Column(BLOB)
+
+
+class Classification_Cache(Base):
+    __tablename__ = "Classification_Cache_Table"
+
+    message_hash = Column(String,primary_key=True)
+    intent = Column(String, nullable=False)
+    created_time = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+def add_missing_columns(engine) -> None:
+    """
+    Adds the columns that were added to a model after its table was created.
+    create_all only creates missing tables, so older databases get the new columns here
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f" NOT NULL DEFAULT {column.default.arg!r}"
+                connection.execute(text(ddl))
 
 
 # Create the database tables
 Base.metadata.create_all(engine)
+add_missing_columns(engine)
 
@@ -0,0 +1,190 @@
+import os
+import time
+import threading
+from typing_extensions import Annotated,Dict,List,Optional,Callable
+from typing import Any
+
+from storage import DMStore,records_to_expire,LOG_MAGIC
+
+
+class RetentionPolicy:
+    """
+    The limits the DMs of a client are kept within, the oldest DMs go first.
+    A limit that is 0 is off
+    """
+
+    def __init__(self,
+                 max_age : Annotated[float,"The seconds a DM is kept for"] = 0.0,
+                 max_records : Annotated[int,"The max number of DMs kept"] = 0,
+                 max_bytes : Annotated[int,"The max bytes of ciphertext kept"] = 0):
+        self.max_age = max_age
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls) -> 'RetentionPolicy':
+        """The server default, from RETAIN_MAX_AGE (seconds), RETAIN_MAX_RECORDS and RETAIN_MAX_BYTES"""
+        return cls(
+            max_age=float(os.environ.get('RETAIN_MAX_AGE','0')),
+            max_records=int(os.environ.get('RETAIN_MAX_RECORDS','0')),
+            max_bytes=int(os.environ.get('RETAIN_MAX_BYTES','0'))
+        )
+
+    def for_client(self,client : Annotated[Any,"A ClientID_Table row"]) -> 'RetentionPolicy':
+        """Returns this policy with the limits the client has set itself in their place"""
+        pick = lambda own,default:default if own is None else own
+        return RetentionPolicy(
+            max_age=pick(getattr(client,'retain_max_age',None),self.max_age),
+            max_records=pick(getattr(client,'retain_max_records',None),self.max_records),
+            max_bytes=pick(getattr(client,'retain_max_bytes',None),self.max_bytes)
+        )
+
+    def enabled(self) -> bool:
+        return bool(self.max_age or self.max_records or self.max_bytes)
+
+    def as_dict(self) -> Dict[str,Any]:
+        return {'max_age':self.max_age,'max_records':self.max_records,'max_bytes':self.max_bytes}
+
+
+class Compactor:
+    """
+    A background thread that goes over every client now and then, expires the DMs outside its
+    retention policy and compacts its storage once enough of it is removed records.
+    It keeps the backlog of every client it looked at, for the stats endpoint
+    """
+
+    def __init__(self,
+                 store : Annotated[DMStore,"The DM store"],
+                 clients : Annotated[Callable[[],List[Any]],"Returns all the clients"],
+                 policy : Annotated[RetentionPolicy,"The server default policy"],
+                 interval : Annotated[float,"The seconds between passes"] = 60.0,
+                 min_dead_ratio : Annotated[float,"The share of the storage that has to be removed records"] = 0.5,
+                 min_dead_bytes : Annotated[int,"The bytes of removed records needed before compacting"] = 1 << 20):
+        self.store = store
+        self.clients = clients
+        self.policy = policy
+        self.interval = interval
+        self.min_dead_ratio = min_dead_ratio
+        self.min_dead_bytes = min_dead_bytes
+        self._backlog = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.passes = 0
+        self.errors = 0
+        self.expired = 0
+        self.compactions = 0
+        self.freed_bytes = 0
+        self.last_pass_seconds = 0.0
+
+    def start(self) -> None:
+        """Starts the background thread, an interval of 0 or less leaves it off"""
+        if self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._work,name="compactor",daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread once the client it is on is done"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
+
+    def run_once(self) -> Annotated[int,"The number of clients looked at"]:
+        """
+        Runs one pass over every client
+        """
+        started = time.monotonic()
+        clients = self.clients()
+        for client in clients:
+            if self._stop.is_set():
+                break
+            try:
+                self.check(client)
+            except Exception as e:
+                self.errors += 1
+                print(f"Compacting {client.client_id} failed due to {e}")
+        self.passes += 1
+        self.last_pass_seconds = time.monotonic() - started
+        return len(clients)
+
+    def check(self,client : Annotated[Any,"A ClientID_Table row"]) -> Annotated[Dict[str,Any],"The backlog of the client"]:
+        """
+        Expires the DMs of a client that are outside its policy, compacts its storage if it is worth it
+        and saves its backlog
+
+        Args:
+            client (ClientID_Table): The client
+
+        Returns:
+            Dict[str,Any]: The backlog of the client after the pass
+        """
+        policy = self.policy.for_client(client)
+        removed = 0
+        if policy.enabled():
+            #only a client with a policy can have records to expire
+            through,removed = records_to_expire(self.store.scan(client),policy.max_age,policy.max_records,policy.max_bytes)
+            if removed:
+                self.store.trim(client,through)
+
+        current = self.store.backlog(client)
+        live_bytes = current['bytes']
+        freed = 0
+        storage_bytes = self.store.storage_bytes(client)
+        if storage_bytes is not None:
+            dead_bytes = storage_bytes - live_bytes - len(LOG_MAGIC)
+            if dead_bytes >= self.min_dead_bytes and dead_bytes >= self.min_dead_ratio * storage_bytes:
+                freed = self.store.compact(client)
+                storage_bytes = self.store.storage_bytes(client)
+
+        with self._lock:
+            previous = self._backlog.get(client.client_id,{})
+            backlog = {
+                'client_id': client.client_id,
+                'records': current['records'],
+                'bytes': live_bytes,
+                'storage_bytes': storage_bytes,
+                'first_seq': current['first_seq'],
+                'last_seq': current['last_seq'],
+                'oldest': current['oldest'].isoformat() if current['oldest'] else None,
+                'newest': current['newest'].isoformat() if current['newest'] else None,
+                'expired': previous.get('expired',0) + removed,
+                'compactions': previous.get('compactions',0) + (1 if freed else 0),
+                'freed_bytes': previous.get('freed_bytes',0) + freed,
+                'policy': policy.as_dict(),
+                'checked_at': time.time()
+            }
+            self._backlog[client.client_id] = backlog
+            self.expired += removed
+            self.compactions += 1 if freed else 0
+            self.freed_bytes += freed
+        return dict(backlog)
+
+    def stats(self,top : Annotated[Optional[int],"Only the clients with the biggest backlog"] = 20) -> Annotated[Dict[str,Any],"The compactor state"]:
+        """
+        Returns the pass counters and the backlog of every client as of the last time it was looked at,
+        the biggest backlogs come first
+        """
+        with self._lock:
+            clients = sorted(self._backlog.values(),key=lambda backlog:(-backlog['bytes'],-backlog['records']))
+            return {
+                'interval_seconds': self.interval,
+                'default_policy': self.policy.as_dict(),
+                'passes': self.passes,
+                'last_pass_seconds': round(self.last_pass_seconds,3),
+                'errors': self.errors,
+                'expired': self.expired,
+                'compactions': self.compactions,
+                'freed_bytes': self.freed_bytes,
+                'tracked_clients': len(self._backlog),
+                'total_records': sum(backlog['records'] for backlog in clients),
+                'total_bytes': sum(backlog['bytes'] for backlog in clients),
+                'clients': [dict(backlog) for backlog in (clients[:top] if top else clients)]
+            }
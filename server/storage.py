@@ -0,0 +1,771 @@
+import os
+import bisect
+import struct
+import datetime
+import threading
+import pickle as pk
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+from typing_extensions import Annotated,Dict,List,Tuple,Any,Optional,Iterator
+
+from sqlalchemy import func,text
+
+from models import DM_Record
+
+#==========================================LOG_FORMAT==============================================
+# Every log file starts with LOG_MAGIC, followed by frames of
+#   [u32 payload length][u8 frame kind][payload]
+# so an append only ever touches the tail of the file. Frame kinds are
+#   KIND_RECORD: a DM record with its seq
+#   KIND_INTENT: the encrypted intent of an earlier record that was stored as pending
+#   KIND_SEQ: the next seq to hand out and the id of the log, written first when a log is (re)written
+#   KIND_TRIM: every record up to a seq is gone, except a list of seqs to keep
+LOG_MAGIC = b'MZDLOG1\n'
+FRAME_HEADER = struct.Struct('<IB')
+KIND_RECORD = 1
+KIND_INTENT = 2
+KIND_SEQ = 3
+KIND_TRIM = 4
+
+RECORD_FIELDS = ('insta_id','message','intent','timestamp','version','wrapped_key')
+BINARY_FIELDS = ('insta_id','message','intent','wrapped_key')
+
+
+def encode_frame(kind : Annotated[int,"The frame kind"],
+                 payload : Annotated[Dict[str,Any],"The frame payload"]
+                 ) -> Annotated[bytes,"The length prefixed frame"]:
+    """
+    Encodes a payload into a single length prefixed frame
+
+    Args:
+        kind (int): The kind of frame, for eg KIND_RECORD
+        payload (Dict[str,Any]): The data to store in the frame
+
+    Returns:
+        bytes: The frame bytes ready to be appended to a log
+    """
+    data = pk.dumps(payload,protocol=pk.HIGHEST_PROTOCOL)
+    return FRAME_HEADER.pack(len(data),kind) + data
+
+
+def iter_frames(file,end : Annotated[int,"The offset to stop reading at"],
+                start : Annotated[int,"The offset of the first frame to read"] = len(LOG_MAGIC)
+                ) -> Iterator[Tuple[int,Dict[str,Any],int,int]]:
+    """
+    Reads the complete frames of a log file one at a time, from just after the magic header up to end.
+    A partially written frame at the tail (crash in the middle of an append) is ignored
+
+    Args:
+        file: The opened binary log file
+        end (int): The offset to stop at, frames appended after a read started are left out
+        start (int): The offset of a frame to start at, the first frame by default
+
+    Returns:
+        Iterator[Tuple[int,Dict[str,Any],int,int]]: The kind, payload, payload offset and payload length of every frame
+    """
+    position = start
+    file.seek(position)
+    while position + FRAME_HEADER.size <= end:
+        length,kind = FRAME_HEADER.unpack(file.read(FRAME_HEADER.size))
+        offset = position + FRAME_HEADER.size
+        if offset + length > end:
+            break
+        data = file.read(length)
+        position = offset + length
+        yield kind,pk.loads(data),offset,length
+
+
+class FileLock:
+    """
+    An exclusive lock shared by every thread and every process that uses the log at a path.
+    The lock is held on a <path>.lock file next to the log, the log itself is replaced when it is
+    rewritten so it cannot carry the lock. fcntl record locks also work on NFS, on Windows
+    msvcrt locks the first byte of the lock file
+    """
+
+    def __init__(self,path : Annotated[str,"The path of the log to lock"]):
+        self.path = path + '.lock'
+        # Record locks belong to a process, so the threads of a process take turns on this first
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self) -> 'FileLock':
+        self._thread_lock.acquire()
+        try:
+            self._file = open(self.path,'a+b')
+            if fcntl is not None:
+                fcntl.lockf(self._file,fcntl.LOCK_EX)
+            else:
+                self._file.seek(0)
+                while True:
+                    try:
+                        # LK_LOCK gives up after 10 seconds, so keep trying
+                        msvcrt.locking(self._file.fileno(),msvcrt.LK_LOCK,1)
+                        break
+                    except OSError:
+                        continue
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self,*exc_info) -> None:
+        try:
+            if fcntl is not None:
+                fcntl.lockf(self._file,fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(),msvcrt.LK_UNLCK,1)
+            self._file.close()
+        finally:
+            self._file = None
+            self._thread_lock.release()
+
+
+class LogIndex:
+    """
+    What a pass over a log finds: the next seq, where every record and late intent is
+    and which records have been trimmed. It is kept per log and only the frames appended
+    since end are read to bring it up to date.
+    Every record with seq <= through is trimmed, except the ones in kept
+    """
+
+    def __init__(self,log_id : Annotated[Optional[Tuple[int,Optional[str]]],"The log the index is of"] = None):
+        self.log_id = log_id
+        self.end = len(LOG_MAGIC)
+        self.next_seq = 1
+        self.intents = {}
+        self.through = 0
+        self.kept = set()
+        # The seq, frame offset, frame size and timestamp of every record in the order they are in the log
+        self.seqs = []
+        self.positions = []
+        self.sizes = []
+        self.timestamps = []
+        self.ordered = True
+
+    def add_record(self,seq : int,position : int,size : int,timestamp : Optional[datetime.datetime]) -> None:
+        if self.seqs and seq <= self.seqs[-1]:
+            self.ordered = False
+        self.seqs.append(seq)
+        self.positions.append(position)
+        self.sizes.append(size)
+        self.timestamps.append(timestamp)
+
+    def first_after(self,after : int) -> int:
+        # The position in seqs of the first record with a seq above after
+        if not self.ordered:
+            return 0
+        return bisect.bisect_right(self.seqs,after)
+
+    def trim(self,through : int,keep : List[int]) -> None:
+        keep = set(keep)
+        kept = {seq for seq in self.kept if seq > through or seq in keep}
+        kept.update(seq for seq in keep if self.through < seq <= through)
+        self.kept = kept
+        self.through = max(self.through,through)
+
+    def is_live(self,seq : int) -> bool:
+        return seq > self.through or seq in self.kept
+
+
+def load_pickle_bin(path : Annotated[str,"The path to the data bin"]
+                    ) -> Annotated[Optional[List[Dict[str,Any]]],"The legacy rows or None"]:
+    """
+    Loads a data bin written in the old format, a single pickled list of rows
+
+    Args:
+        path (str): The path to the data bin
+
+    Returns:
+        Optional[List[Dict[str,Any]]]: The rows in the bin, or None if the bin
+            does not exist or is not a legacy pickle bin
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path,'rb') as file:
+        if file.read(len(LOG_MAGIC)) == LOG_MAGIC:
+            return None
+        file.seek(0)
+        try:
+            rows = pk.load(file)
+        except EOFError:
+            return []
+    return rows if isinstance(rows,list) else None
+
+def records_to_expire(records : Annotated[List[Tuple[int,datetime.datetime,int]],"The seq, timestamp and size of every record"],
+                      max_age : Annotated[Optional[float],"The max age in seconds"] = None,
+                      max_records : Annotated[Optional[int],"The max number of records"] = None,
+                      max_bytes : Annotated[Optional[int],"The max bytes of all the records"] = None
+                      ) -> Annotated[Tuple[int,int],"The seq to trim through and the number of records removed"]:
+    """
+    Works out how many of the oldest records have to go for the rest to be within the limits.
+    A limit that is None or 0 is not applied
+
+    Args:
+        records (List[Tuple[int,datetime,int]]): The records from DMStore.scan in seq order
+        max_age (Optional[float]): Records older than this many seconds go
+        max_records (Optional[int]): The oldest records go till this many are left
+        max_bytes (Optional[int]): The oldest records go till the rest take up this many bytes
+
+    Returns:
+        Tuple[int,int]: The seq to pass to DMStore.trim and the number of records it removes
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age) if max_age else None
+    count,size = len(records),sum(record[2] for record in records)
+    through = 0
+    removed = 0
+    for seq,timestamp,record_size in records:
+        if not ((cutoff is not None and timestamp < cutoff)
+                or (max_records and count - removed > max_records)
+                or (max_bytes and size > max_bytes)):
+            break
+        through = seq
+        removed += 1
+        size -= record_size
+    return through,removed
+
+def summarize_records(records : Annotated[List[Tuple[int,datetime.datetime,int]],"The seq, timestamp and size of every record"]
+                      ) -> Annotated[Dict[str,Any],"The backlog of the records"]:
+    """
+    Counts the records from DMStore.scan and their bytes, with the first and last seq and the
+    oldest and newest timestamp
+    """
+    timestamps = [timestamp for _,timestamp,_ in records if timestamp is not None]
+    return {
+        'records': len(records),
+        'bytes': sum(size for _,_,size in records),
+        'first_seq': records[0][0] if records else None,
+        'last_seq': records[-1][0] if records else None,
+        'oldest': min(timestamps) if timestamps else None,
+        'newest': max(timestamps) if timestamps else None
+    }
+
+#==========================================DM_STORES===============================================
+class DMStore:
+    """
+    The interface every DM storage engine implements.
+    A client is anything with a client_id and bin_name attribute, like a ClientID_Table row.
+    Every record gets a sequence number (seq) that only ever goes up for a client
+    """
+
+    def create(self,client,next_seq : int = 1) -> None:
+        """
+        Creates an empty storage for a new client whose seqs start at next_seq or above.
+        A storage that is already there keeps its records, its seqs are only moved up to next_seq
+        """
+        raise NotImplementedError
+
+    def append(self,client,record : Dict[str,Any]) -> int:
+        """Appends a single encrypted DM record for a client, returns the seq of the record"""
+        raise NotImplementedError
+
+    def append_many(self,client,records : List[Dict[str,Any]]) -> List[int]:
+        """Appends a batch of encrypted DM records in one go, returns the seq of each record"""
+        return [self.append(client,record) for record in records]
+
+    def set_intent(self,client,seq : int,intent : bytes) -> None:
+        """Fills in the encrypted intent of a record that was stored with a pending intent"""
+        raise NotImplementedError
+
+    def iter_records(self,client,after : int = 0) -> Iterator[Dict[str,Any]]:
+        """Yields the encrypted DM records of a client with a seq above after, one at a time in seq order"""
+        raise NotImplementedError
+
+    def read_all(self,client) -> List[Dict[str,Any]]:
+        """Returns all the encrypted DM records of a client in the order they came in"""
+        raise NotImplementedError
+
+    def trim(self,client,through : int,keep : Optional[List[int]] = None) -> None:
+        """Removes the DM records of a client with a seq up to through, except the ones whose seq is in keep"""
+        raise NotImplementedError
+
+    def clear(self,client,keep : Optional[List[int]] = None) -> None:
+        """Removes all the DM records of a client except the ones whose seq is in keep"""
+        raise NotImplementedError
+
+    def migrate(self,client) -> int:
+        """Moves a legacy pickle bin of a client into this store, returns the number of rows moved"""
+        raise NotImplementedError
+
+    def scan(self,client) -> List[Tuple[int,datetime.datetime,int]]:
+        """Returns the seq, timestamp and stored size in bytes of every record of a client in seq order"""
+        return [(record['seq'],record['timestamp'],sum(len(record[field]) for field in BINARY_FIELDS if record.get(field)))
+                for record in self.iter_records(client)]
+
+    def backlog(self,client) -> Dict[str,Any]:
+        """Returns the number and bytes of the records of a client, see summarize_records"""
+        return summarize_records(self.scan(client))
+
+    def storage_bytes(self,client) -> Optional[int]:
+        """Returns the bytes the storage of a client takes up including removed records, None if not known"""
+        return None
+
+    def expire(self,client,
+               max_age : Optional[float] = None,
+               max_records : Optional[int] = None,
+               max_bytes : Optional[int] = None) -> int:
+        """
+        Removes the oldest records of a client till the rest are younger than max_age seconds,
+        no more than max_records and no more than max_bytes. A limit that is None or 0 is not applied.
+        Returns the number of records removed
+        """
+        through,removed = records_to_expire(self.scan(client),max_age,max_records,max_bytes)
+        if removed:
+            self.trim(client,through)
+        return removed
+
+    def compact(self,client) -> int:
+        """Gives back the space of removed records, returns the bytes freed"""
+        return 0
+
+
+class LogDMStore(DMStore):
+    """
+    Stores the DMs of each client in an append only, length prefixed record log at client.bin_name.
+    Appending a DM costs the same no matter how big the backlog is.
+    Every write holds a FileLock, so any number of worker processes, or hosts on shared storage,
+    can write to the same log. Each process remembers how far it has read a log and only reads
+    what other processes appended since then.
+    Legacy pickle bins found at client.bin_name are converted in place the first time they are touched
+    """
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        # path -> (log id, size, next seq) as of the last time this process looked at the log
+        self._tails = {}
+        # path -> LogIndex of the log as of the last time this process read it
+        self._indexes = {}
+        self._indexes_guard = threading.Lock()
+
+    def _lock(self,path : str) -> FileLock:
+        with self._locks_guard:
+            if path not in self._locks:
+                self._locks[path] = FileLock(path)
+            return self._locks[path]
+
+    def _log_id(self,path : str) -> Tuple[int,Optional[str]]:
+        # The inode and the id in the first KIND_SEQ frame, they change when any process rewrites the log
+        with open(path,'rb') as file:
+            inode = os.fstat(file.fileno()).st_ino
+            for kind,payload,_,_ in iter_frames(file,os.fstat(file.fileno()).st_size):
+                return inode,payload.get('log_id') if kind == KIND_SEQ else None
+        return inode,None
+
+    def _prepare(self,path : str) -> int:
+        # Called with the lock held. Makes sure the file at path is a log, creating or converting it
+        # if needed, and returns the next seq including what other processes appended
+        if not os.path.exists(path):
+            self._write_log(path,[],1)
+        elif path not in self._tails:
+            rows = load_pickle_bin(path)
+            if rows is not None:
+                for seq,row in enumerate(rows,1):
+                    row['seq'] = seq
+                self._write_log(path,rows,len(rows) + 1)
+
+        log_id = self._log_id(path)
+        size = os.path.getsize(path)
+        tail = self._tails.get(path)
+        if tail is not None and tail[0] == log_id and tail[1] == size:
+            return tail[2]
+        if tail is not None and tail[0] == log_id and tail[1] < size:
+            start,next_seq = tail[1],tail[2]
+        else:
+            start,next_seq = len(LOG_MAGIC),1
+        with open(path,'rb') as file:
+            for kind,payload,_,_ in iter_frames(file,size,start):
+                if kind == KIND_RECORD:
+                    next_seq = max(next_seq,payload.get('seq',next_seq) + 1)
+                elif kind == KIND_SEQ:
+                    next_seq = max(next_seq,payload['next_seq'])
+        self._tails[path] = (log_id,size,next_seq)
+        return next_seq
+
+    def _appended(self,path : str,frames : bytes,next_seq : int) -> None:
+        # Called with the lock held after this process appended frames
+        log_id,size,_ = self._tails[path]
+        self._tails[path] = (log_id,size + len(frames),next_seq)
+
+    def _append(self,path : str,frames : bytes,next_seq : int) -> None:
+        with open(path,'ab') as file:
+            file.write(frames)
+        self._appended(path,frames,next_seq)
+
+    def _read_frames(self,index : LogIndex,file,end : int) -> None:
+        # Reads the frames from index.end up to end into the index
+        next_seq = index.next_seq
+        for kind,payload,offset,length in iter_frames(file,end,index.end):
+            if kind == KIND_RECORD:
+                # Records written before sequence numbers existed get their position as seq
+                seq = payload.get('seq',next_seq)
+                index.add_record(seq,offset - FRAME_HEADER.size,FRAME_HEADER.size + length,payload.get('timestamp'))
+                next_seq = max(next_seq,seq + 1)
+            elif kind == KIND_INTENT:
+                index.intents[payload['seq']] = (offset,length)
+            elif kind == KIND_TRIM:
+                index.trim(payload['through'],payload['keep'])
+            elif kind == KIND_SEQ:
+                next_seq = max(next_seq,payload['next_seq'])
+            index.end = offset + length
+        index.next_seq = next_seq
+
+    def _index(self,path : str,file,end : int) -> LogIndex:
+        # The index of the log open in file, up to date to at least end. The index of each log is
+        # kept, so a read only goes over the frames appended since the last one
+        log_id = (os.fstat(file.fileno()).st_ino,None)
+        for kind,payload,_,_ in iter_frames(file,end):
+            log_id = (log_id[0],payload.get('log_id') if kind == KIND_SEQ else None)
+            break
+        with self._indexes_guard:
+            index = self._indexes.get(path)
+            if index is None or index.log_id != log_id:
+                index = LogIndex(log_id)
+            if index.end < end:
+                self._read_frames(index,file,end)
+            self._indexes[path] = index
+            return index
+
+    def _iter(self,path : str,end : int,after : int) -> Iterator[Dict[str,Any]]:
+        for payload,_ in self._live(path,end,after):
+            yield payload
+
+    def _live(self,path : str,end : int,after : int) -> Iterator[Tuple[Dict[str,Any],int]]:
+        # Yields the live records with a seq above after one at a time, with their late intents
+        # filled in and the bytes of their frame. The index says where they are, so the records
+        # at or below after and the trimmed ones are never read
+        with open(path,'rb') as file:
+            # A log swapped in since end was taken can be shorter
+            end = min(end,os.fstat(file.fileno()).st_size)
+            index = self._index(path,file,end)
+            for position in range(index.first_after(after),len(index.seqs)):
+                seq,offset = index.seqs[position],index.positions[position]
+                if offset >= end:
+                    break
+                if seq <= after or not index.is_live(seq):
+                    continue
+                file.seek(offset)
+                length,_ = FRAME_HEADER.unpack(file.read(FRAME_HEADER.size))
+                payload = pk.loads(file.read(length))
+                payload['seq'] = seq
+                if seq in index.intents:
+                    intent_offset,intent_length = index.intents[seq]
+                    file.seek(intent_offset)
+                    payload['intent'] = pk.loads(file.read(intent_length))['intent']
+                yield payload,FRAME_HEADER.size + length
+
+    def _write_temp(self,temp_path : str,rows : Iterator[Dict[str,Any]],next_seq : int) -> None:
+        with open(temp_path,'wb') as file:
+            file.write(LOG_MAGIC)
+            file.write(encode_frame(KIND_SEQ,{'next_seq':next_seq,'log_id':os.urandom(8).hex()}))
+            for row in rows:
+                file.write(encode_frame(KIND_RECORD,row))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _write_log(self,path : str,rows : List[Dict[str,Any]],next_seq : int) -> None:
+        # Writes a fresh log next to path and swaps it in so a crash never leaves half a bin
+        temp_path = path + '.tmp'
+        self._write_temp(temp_path,rows,next_seq)
+        os.replace(temp_path,path)
+        self._tails[path] = (self._log_id(path),os.path.getsize(path),next_seq)
+
+    def _rewrite(self,path : str,keep : List[int],next_seq : int) -> None:
+        # Rewrites the log with only the live records in keep, the next seq is carried over
+        # so pending jobs never point at a reused seq
+        rows = []
+        if keep:
+            keep = set(keep)
+            rows = [row for row in self._iter(path,os.path.getsize(path),0) if row['seq'] in keep]
+        self._write_log(path,rows,next_seq)
+
+    def create(self,client,next_seq : int = 1) -> None:
+        with self._lock(client.bin_name):
+            if not os.path.exists(client.bin_name):
+                self._write_log(client.bin_name,[],next_seq)
+            elif self._prepare(client.bin_name) < next_seq:
+                self._append(client.bin_name,encode_frame(KIND_SEQ,{'next_seq':next_seq}),next_seq)
+
+    def append(self,client,record : Dict[str,Any]) -> int:
+        with self._lock(client.bin_name):
+            seq = self._prepare(client.bin_name)
+            self._append(client.bin_name,encode_frame(KIND_RECORD,{**record,'seq':seq}),seq + 1)
+        return seq
+
+    def append_many(self,client,records : List[Dict[str,Any]]) -> List[int]:
+        with self._lock(client.bin_name):
+            first_seq = self._prepare(client.bin_name)
+            seqs = list(range(first_seq,first_seq + len(records)))
+            frames = b''.join(encode_frame(KIND_RECORD,{**record,'seq':seq}) for seq,record in zip(seqs,records))
+            self._append(client.bin_name,frames,first_seq + len(records))
+        return seqs
+
+    def set_intent(self,client,seq : int,intent : bytes) -> None:
+        frame = encode_frame(KIND_INTENT,{'seq':seq,'intent':intent})
+        with self._lock(client.bin_name):
+            next_seq = self._prepare(client.bin_name)
+            self._append(client.bin_name,frame,next_seq)
+
+    def iter_records(self,client,after : int = 0) -> Iterator[Dict[str,Any]]:
+        with self._lock(client.bin_name):
+            self._prepare(client.bin_name)
+            # Appends made after this point are not part of this read
+            end = os.path.getsize(client.bin_name)
+        return self._iter(client.bin_name,end,after)
+
+    def read_all(self,client) -> List[Dict[str,Any]]:
+        return list(self.iter_records(client))
+
+    def trim(self,client,through : int,keep : Optional[List[int]] = None) -> None:
+        with self._lock(client.bin_name):
+            next_seq = self._prepare(client.bin_name)
+            if through >= next_seq - 1:
+                # Everything is trimmed, so the log can be started over
+                self._rewrite(client.bin_name,keep,next_seq)
+            else:
+                self._append(client.bin_name,encode_frame(KIND_TRIM,{'through':through,'keep':list(keep or [])}),next_seq)
+
+    def clear(self,client,keep : Optional[List[int]] = None) -> None:
+        with self._lock(client.bin_name):
+            next_seq = self._prepare(client.bin_name)
+            self._rewrite(client.bin_name,keep,next_seq)
+
+    def migrate(self,client) -> int:
+        rows = load_pickle_bin(client.bin_name)
+        with self._lock(client.bin_name):
+            self._tails.pop(client.bin_name,None)
+            self._prepare(client.bin_name)
+        return len(rows) if rows is not None else 0
+
+    def scan(self,client) -> List[Tuple[int,datetime.datetime,int]]:
+        # The index has the seq, timestamp and size of every record, so no record is read
+        with self._lock(client.bin_name):
+            self._prepare(client.bin_name)
+            end = os.path.getsize(client.bin_name)
+        with open(client.bin_name,'rb') as file:
+            end = min(end,os.fstat(file.fileno()).st_size)
+            index = self._index(client.bin_name,file,end)
+            entries = zip(index.seqs,index.positions,index.timestamps,index.sizes)
+            return [(seq,timestamp,size) for seq,position,timestamp,size in entries if position < end and index.is_live(seq)]
+
+    def storage_bytes(self,client) -> Optional[int]:
+        try:
+            return os.path.getsize(client.bin_name)
+        except FileNotFoundError:
+            return None
+
+    def compact(self,client) -> int:
+        # The live records are copied into a new log without the lock, so appends carry on meanwhile.
+        # The lock is only held to copy over the frames appended during the copy and swap the logs
+        path = client.bin_name
+        temp_path = path + '.compact'
+        with self._lock(path):
+            next_seq = self._prepare(path)
+            log_id = self._log_id(path)
+            end = os.path.getsize(path)
+        self._write_temp(temp_path,self._iter(path,end,0),next_seq)
+        with self._lock(path):
+            if self._log_id(path) != log_id:
+                # Another process rewrote the log meanwhile, it is already compact
+                os.remove(temp_path)
+                return 0
+            size = os.path.getsize(path)
+            with open(path,'rb') as source,open(temp_path,'ab') as target:
+                source.seek(end)
+                target.write(source.read(size - end))
+                target.flush()
+                os.fsync(target.fileno())
+            os.replace(temp_path,path)
+            # The frames copied over may hold records, so the next seq is worked out again
+            self._tails.pop(path,None)
+            self._prepare(path)
+            return size - os.path.getsize(path)
+
+
+class SQLiteDMStore(DMStore):
+    """
+    Stores the DMs of all clients in the DM_Record_Table of the server database, the row id is the seq.
+    Legacy pickle bins are imported the first time a client is touched and renamed to <bin_name>.migrated
+    """
+
+    def __init__(self,session_factory):
+        self.Session = session_factory
+        self._migrated = set()
+        self._guard = threading.Lock()
+
+    def _prepare(self,client) -> None:
+        if client.client_id in self._migrated:
+            return
+        with self._guard:
+            if client.client_id not in self._migrated:
+                self.migrate(client)
+                self._migrated.add(client.client_id)
+
+    def _to_record(self,row : DM_Record) -> Dict[str,Any]:
+        record = {field:getattr(row,field) for field in RECORD_FIELDS}
+        record['seq'] = row.id
+        return record
+
+    def create(self,client,next_seq : int = 1) -> None:
+        self._migrated.add(client.client_id)
+        if next_seq <= 1:
+            return
+        # The ids are shared by every client and never go down, they only need to be past next_seq
+        session = self.Session()
+        try:
+            params = {'seq':next_seq - 1,'name':DM_Record.__tablename__}
+            session.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = :name AND seq < :seq"),params)
+            session.execute(text("INSERT INTO sqlite_sequence (name,seq) SELECT :name,:seq WHERE NOT EXISTS "
+                                 "(SELECT 1 FROM sqlite_sequence WHERE name = :name)"),params)
+            session.commit()
+        finally:
+            session.close()
+
+    def append(self,client,record : Dict[str,Any]) -> int:
+        self._prepare(client)
+        session = self.Session()
+        try:
+            row = DM_Record(client_id=client.client_id,**{field:record[field] for field in RECORD_FIELDS if field in record})
+            session.add(row)
+            session.commit()
+            return row.id
+        finally:
+            session.close()
+
+    def append_many(self,client,records : List[Dict[str,Any]]) -> List[int]:
+        self._prepare(client)
+        session = self.Session()
+        try:
+            rows = [DM_Record(client_id=client.client_id,**{field:record[field] for field in RECORD_FIELDS if field in record})
+                    for record in records]
+            session.add_all(rows)
+            session.commit()
+            return [row.id for row in rows]
+        finally:
+            session.close()
+
+    def set_intent(self,client,seq : int,intent : bytes) -> None:
+        session = self.Session()
+        try:
+            session.query(DM_Record).filter(
+                DM_Record.client_id == client.client_id,DM_Record.id == seq).update({'intent':intent})
+            session.commit()
+        finally:
+            session.close()
+
+    def iter_records(self,client,after : int = 0) -> Iterator[Dict[str,Any]]:
+        self._prepare(client)
+        session = self.Session()
+        try:
+            rows = session.query(DM_Record).filter(
+                DM_Record.client_id == client.client_id,DM_Record.id > after).order_by(DM_Record.id).yield_per(500)
+            for row in rows:
+                yield self._to_record(row)
+        finally:
+            session.close()
+
+    def read_all(self,client) -> List[Dict[str,Any]]:
+        return list(self.iter_records(client))
+
+    def trim(self,client,through : int,keep : Optional[List[int]] = None) -> None:
+        self._prepare(client)
+        session = self.Session()
+        try:
+            query = session.query(DM_Record).filter(DM_Record.client_id == client.client_id,DM_Record.id <= through)
+            if keep:
+                query = query.filter(DM_Record.id.notin_(keep))
+            query.delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def clear(self,client,keep : Optional[List[int]] = None) -> None:
+        self._prepare(client)
+        session = self.Session()
+        try:
+            query = session.query(DM_Record).filter(DM_Record.client_id == client.client_id)
+            if keep:
+                query = query.filter(DM_Record.id.notin_(keep))
+            query.delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def migrate(self,client) -> int:
+        rows = load_pickle_bin(client.bin_name)
+        if not rows:
+            return 0
+        session = self.Session()
+        try:
+            session.add_all([DM_Record(client_id=client.client_id,**{field:row[field] for field in RECORD_FIELDS if field in row})
+                             for row in rows])
+            session.commit()
+        finally:
+            session.close()
+        os.replace(client.bin_name,client.bin_name + '.migrated')
+        return len(rows)
+
+    def scan(self,client) -> List[Tuple[int,datetime.datetime,int]]:
+        # Only the sizes of the ciphertexts are read, not the ciphertexts
+        self._prepare(client)
+        size = sum(func.coalesce(func.length(getattr(DM_Record,field)),0) for field in BINARY_FIELDS)
+        session = self.Session()
+        try:
+            rows = session.query(DM_Record.id,DM_Record.timestamp,size).filter(
+                DM_Record.client_id == client.client_id).order_by(DM_Record.id).all()
+            return [tuple(row) for row in rows]
+        finally:
+            session.close()
+
+    def backlog(self,client) -> Dict[str,Any]:
+        # Worked out by the DB without reading the records
+        self._prepare(client)
+        size = sum(func.coalesce(func.length(getattr(DM_Record,field)),0) for field in BINARY_FIELDS)
+        session = self.Session()
+        try:
+            records,size,first_seq,last_seq,oldest,newest = session.query(
+                func.count(DM_Record.id),func.coalesce(func.sum(size),0),func.min(DM_Record.id),func.max(DM_Record.id),
+                func.min(DM_Record.timestamp),func.max(DM_Record.timestamp)).filter(DM_Record.client_id == client.client_id).one()
+        finally:
+            session.close()
+        return {'records':records,'bytes':size,'first_seq':first_seq,'last_seq':last_seq,'oldest':oldest,'newest':newest}
+
+
+def get_dm_store(session_factory) -> Annotated[DMStore,"The configured DM store"]:
+    """
+    Builds the DM store selected by the DM_STORE environment variable
+
+    Args:
+        session_factory: The sessionmaker bound to the server database
+
+    Returns:
+        DMStore: A LogDMStore for DM_STORE=log (default) or a SQLiteDMStore for DM_STORE=sqlite
+    """
+    store_type = os.environ.get('DM_STORE','log').lower()
+    if store_type == 'sqlite':
+        return SQLiteDMStore(session_factory)
+    elif store_type == 'log':
+        return LogDMStore()
+    raise ValueError(f"Unknown DM_STORE {store_type}, use log or sqlite")
+
+
+if __name__ == "__main__":
+    # Migrates the legacy pickle bins of every client into the configured store
+    # Usage: python storage.py
+    from sqlalchemy.orm import sessionmaker
+    from models import engine,ClientID_Table
+
+    Session = sessionmaker(bind=engine)
+    store = get_dm_store(Session)
+    session = Session()
+    for client in session.query(ClientID_Table).all():
+        moved = store.migrate(client)
+        print(f"{client.client_id}: migrated {moved} rows")
+    session.close()
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import datetime
+import multiprocessing
+from types import SimpleNamespace
+from typing_extensions import Annotated,List,Dict
+from typing import Any
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base,configure_sqlite
+from storage import LogDMStore,SQLiteDMStore,DMStore
+
+# Checks that several processes writing the DMs of one client at the same time lose nothing.
+# Every process appends its share of the records, singly and in batches, and fills in intents.
+# The records are then counted, every seq must be there exactly once and carry its intent.
+# With --compact one more process keeps compacting the storage while the others write
+# Usage:
+#   DM_STORE=log python stress_storage.py --processes 8 --records 500
+#   DM_STORE=log python stress_storage.py --processes 8 --records 500 --compact
+#   DM_STORE=sqlite python stress_storage.py --processes 8 --records 500
+
+
+def open_store(store_type : Annotated[str,"log or sqlite"],workdir : Annotated[str,"The scratch directory"]) -> DMStore:
+    if store_type == 'log':
+        return LogDMStore()
+    engine = create_engine(f"sqlite:///{os.path.join(workdir,'stress.sqlite')}")
+    configure_sqlite(engine)
+    Base.metadata.create_all(engine)
+    return SQLiteDMStore(sessionmaker(bind=engine))
+
+
+def make_record(worker : int,number : int) -> Dict[str,Any]:
+    return {
+        'insta_id': f'worker_{worker}'.encode(),
+        'message': f'{worker}:{number}'.encode(),
+        'intent': None,
+        'timestamp': datetime.datetime.now(),
+        'version': 1,
+        'wrapped_key': None
+    }
+
+
+def worker(index : int,store_type : str,workdir : str,client : SimpleNamespace,records : int,batch : int,start_at : float,results) -> None:
+    """
+    Appends records for the client, every other write is a batch, then fills in the intent of each one
+    """
+    store = open_store(store_type,workdir)
+    # Start together so the writes overlap
+    time.sleep(max(0.0,start_at - time.time()))
+    seqs = []
+    number = 0
+    while number < records:
+        if (number // batch) % 2 == 0:
+            seqs.append(store.append(client,make_record(index,number)))
+            number += 1
+        else:
+            count = min(batch,records - number)
+            seqs.extend(store.append_many(client,[make_record(index,number + offset) for offset in range(count)]))
+            number += count
+    for seq in seqs:
+        store.set_intent(client,seq,f'{index}'.encode())
+    results.put((index,seqs))
+
+
+def compactor(store_type : str,workdir : str,client : SimpleNamespace,start_at : float,done,results) -> None:
+    """
+    Compacts the storage of the client over and over till the writers are done
+    """
+    store = open_store(store_type,workdir)
+    time.sleep(max(0.0,start_at - time.time()))
+    passes = 0
+    while not done.is_set():
+        store.compact(client)
+        passes += 1
+    results.put(passes)
+
+
+def run(store_type : str,processes : int,records : int,batch : int,compact : bool = False) -> Annotated[List[str],"The problems found"]:
+    workdir = tempfile.mkdtemp(prefix='stress_storage_')
+    client = SimpleNamespace(client_id='stress',bin_name=os.path.join(workdir,'stress.data'))
+    open_store(store_type,workdir).create(client)
+
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1.0
+    jobs = [multiprocessing.Process(target=worker,args=(index,store_type,workdir,client,records,batch,start_at,results))
+            for index in range(processes)]
+    for job in jobs:
+        job.start()
+    done = multiprocessing.Event()
+    compactions = multiprocessing.Queue()
+    if compact:
+        compact_job = multiprocessing.Process(target=compactor,args=(store_type,workdir,client,start_at,done,compactions))
+        compact_job.start()
+    written = dict(results.get() for _ in jobs)
+    for job in jobs:
+        job.join()
+    elapsed = time.time() - start_at
+    if compact:
+        done.set()
+        print(f"{store_type}: compacted {compactions.get()} times while writing")
+        compact_job.join()
+
+    problems = []
+    stored = open_store(store_type,workdir).read_all(client)
+    expected = processes * records
+    handed_out = [seq for seqs in written.values() for seq in seqs]
+    if len(stored) != expected:
+        problems.append(f"Expected {expected} records, found {len(stored)}")
+    if len(set(handed_out)) != len(handed_out):
+        problems.append(f"{len(handed_out) - len(set(handed_out))} seqs were handed out twice")
+    stored_seqs = [row['seq'] for row in stored]
+    if sorted(stored_seqs) != sorted(handed_out):
+        problems.append("The stored seqs are not the seqs that were handed out")
+    for row in stored:
+        worker_index = row['insta_id'].decode().split('_')[1]
+        if row['intent'] != worker_index.encode():
+            problems.append(f"Record {row['seq']} has intent {row['intent']}, expected {worker_index}")
+            break
+    print(f"{store_type}: {processes} processes wrote {expected} records in {elapsed:.2f}s, read back {len(stored)}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent writers on one client's DM store")
+    parser.add_argument('--processes',type=int,default=8)
+    parser.add_argument('--records',type=int,default=500,help="Records written by every process")
+    parser.add_argument('--batch',type=int,default=10,help="The size of the append_many batches")
+    parser.add_argument('--compact',action='store_true',help="Compact the storage while the records are written")
+    args = parser.parse_args()
+
+    problems = run(os.environ.get('DM_STORE','log').lower(),args.processes,args.records,args.batch,args.compact)
+    for problem in problems:
+        print(problem)
+    print("FAILED" if problems else "OK")
+    sys.exit(1 if problems else 0)
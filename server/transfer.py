@@ -0,0 +1,259 @@
+import json
+import zlib
+import base64
+import struct
+import datetime
+from typing_extensions import Annotated,Dict,List,Tuple,Optional,Iterator,Iterable
+from typing import Any
+
+from storage import FRAME_HEADER
+from encryption import FORMAT_RSA
+
+# msgpack and zstandard are optional, the formats and encodings they add are only offered when installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#==========================================FORMATS=================================================
+# The formats /copy_dms can answer in
+#   json: one JSON body, ciphertexts in base64 (the default)
+#   ndjson: one JSON object per line, ciphertexts in base64
+#   frames: FRAMES_MAGIC followed by length prefixed binary frames with the raw ciphertexts
+#   msgpack: a stream of MessagePack maps with the raw ciphertexts
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'frames': 'application/x-mazduur-frames',
+    'msgpack': 'application/x-msgpack'
+}
+STREAM_FORMATS = ('ndjson','frames','msgpack')
+
+# A frames body is FRAMES_MAGIC followed by [u32 payload length][u8 frame kind][payload] frames
+#   KIND_ROW: ROW_HEADER (seq, epoch timestamp, version) then insta_id, message, intent and wrapped_key,
+#             each as a u32 length and the raw bytes, NO_FIELD as the length of a missing field
+#   KIND_PAGE: PAGE_END (next_cursor, has_more), the last frame of a page
+FRAMES_MAGIC = b'MZDDM1\n'
+KIND_ROW = 1
+KIND_PAGE = 2
+ROW_HEADER = struct.Struct('<QdB')
+PAGE_END = struct.Struct('<Q?')
+FIELD_LENGTH = struct.Struct('<I')
+NO_FIELD = 0xFFFFFFFF
+BINARY_FIELDS = ('insta_id','message','intent','wrapped_key')
+
+
+def available_formats() -> Annotated[List[str],"The formats this server can answer in"]:
+    return [fmt for fmt in MEDIA_TYPES if fmt != 'msgpack' or msgpack is not None]
+
+
+def available_encodings() -> Annotated[List[str],"The transport compressions this server can apply"]:
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def _parse_accept(header : Optional[str]) -> List[Tuple[str,float]]:
+    # Splits an Accept or Accept-Encoding header into (value, q) pairs, highest q first
+    choices = []
+    for position,part in enumerate((header or '').split(',')):
+        value,*params = [item.strip() for item in part.split(';')]
+        if not value:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        choices.append((value.lower(),q,position))
+    choices.sort(key=lambda choice:(-choice[1],choice[2]))
+    return [(value,q) for value,q,_ in choices]
+
+
+def negotiate_format(accept : Annotated[Optional[str],"The Accept header"]) -> Annotated[Optional[str],"The format or None"]:
+    """
+    Picks the format of the response from the Accept header
+
+    Args:
+        accept (Optional[str]): The Accept header of the request
+
+    Returns:
+        Optional[str]: The most preferred format the server has, or None if the header names none of them
+    """
+    by_media_type = {MEDIA_TYPES[fmt]:fmt for fmt in available_formats()}
+    for media_type,q in _parse_accept(accept):
+        if q > 0 and media_type in by_media_type:
+            return by_media_type[media_type]
+    return None
+
+
+def negotiate_encoding(accept_encoding : Annotated[Optional[str],"The Accept-Encoding header"]
+                       ) -> Annotated[Optional[str],"zstd, gzip or None"]:
+    """
+    Picks the transport compression from the Accept-Encoding header, zstd is preferred over gzip
+    when the client accepts both equally
+
+    Args:
+        accept_encoding (Optional[str]): The Accept-Encoding header of the request
+
+    Returns:
+        Optional[str]: The compression to apply, or None to send the body as is
+    """
+    accepted = {value:q for value,q in _parse_accept(accept_encoding)}
+    best,best_q = None,0.0
+    for encoding in available_encodings():
+        q = accepted.get(encoding,accepted.get('*',0.0))
+        if q > best_q:
+            best,best_q = encoding,q
+    return best
+
+#==========================================ENCODERS================================================
+#Function to turn a stored record into its JSON form
+def encode_dm_row(row : Annotated[Dict[str,Any],"The stored record"]) -> Annotated[Dict[str,Any],"The JSON ready row"]:
+    """
+    Base64 encodes the ciphertexts of a record and formats its timestamp
+
+    Args:
+        row (Dict[str,Any]): The record from the DM store
+
+    Returns:
+        Dict[str,Any]: The row as sent to the client
+    """
+    return {
+        'seq': row['seq'],
+        'insta_id': base64.b64encode(row['insta_id']).decode('utf-8'),
+        'message': base64.b64encode(row['message']).decode('utf-8'),
+        'intent': base64.b64encode(row['intent']).decode('utf-8') if row['intent'] is not None else None,
+        'timestamp': row['timestamp'].strftime("%d-%m-%y %H:%M:%S.%f")[:-3],
+        'version': row.get('version',FORMAT_RSA),
+        'wrapped_key': base64.b64encode(row['wrapped_key']).decode('utf-8') if row.get('wrapped_key') else None
+    }
+
+
+def encode_frame_row(row : Annotated[Dict[str,Any],"The stored record"]) -> Annotated[bytes,"The KIND_ROW frame"]:
+    """
+    Packs a record into a KIND_ROW frame with its raw ciphertexts and an epoch timestamp
+    """
+    parts = [ROW_HEADER.pack(row['seq'],row['timestamp'].timestamp(),row.get('version',FORMAT_RSA))]
+    for field in BINARY_FIELDS:
+        value = row.get(field)
+        if value is None:
+            parts.append(FIELD_LENGTH.pack(NO_FIELD))
+        else:
+            parts.append(FIELD_LENGTH.pack(len(value)))
+            parts.append(value)
+    payload = b''.join(parts)
+    return FRAME_HEADER.pack(len(payload),KIND_ROW) + payload
+
+
+def encode_msgpack_row(row : Annotated[Dict[str,Any],"The stored record"]) -> Annotated[bytes,"The MessagePack map"]:
+    """
+    Packs a record into a MessagePack map with its raw ciphertexts and an epoch timestamp
+    """
+    return msgpack.packb({
+        'seq': row['seq'],
+        'insta_id': row['insta_id'],
+        'message': row['message'],
+        'intent': row['intent'],
+        'timestamp': row['timestamp'].timestamp(),
+        'version': row.get('version',FORMAT_RSA),
+        'wrapped_key': row.get('wrapped_key')
+    },use_bin_type=True)
+
+
+def row_encoder(fmt : Annotated[str,"A stream format"]):
+    """
+    Returns the function that turns a stored record into the bytes of one row of a stream format
+    """
+    if fmt == 'frames':
+        return encode_frame_row
+    if fmt == 'msgpack':
+        return encode_msgpack_row
+    return lambda row:(json.dumps(encode_dm_row(row)) + '\n').encode()
+
+
+def stream_start(fmt : Annotated[str,"A stream format"]) -> Annotated[bytes,"The bytes a stream starts with"]:
+    return FRAMES_MAGIC if fmt == 'frames' else b''
+
+
+def encode_page_end(fmt : Annotated[str,"A stream format"],
+                    next_cursor : Annotated[int,"The cursor of the next page"],
+                    has_more : Annotated[bool,"If there are more DMs after the page"]) -> Annotated[bytes,"The last row of a page"]:
+    if fmt == 'frames':
+        return FRAME_HEADER.pack(PAGE_END.size,KIND_PAGE) + PAGE_END.pack(next_cursor,has_more)
+    if fmt == 'msgpack':
+        return msgpack.packb({'next_cursor':next_cursor,'has_more':has_more})
+    return (json.dumps({'next_cursor':next_cursor,'has_more':has_more}) + '\n').encode()
+
+
+def compress(chunks : Annotated[Iterable[bytes],"The body"],
+             encoding : Annotated[Optional[str],"zstd, gzip or None"]) -> Annotated[Iterator[bytes],"The compressed body"]:
+    """
+    Compresses a body chunk by chunk as it is sent
+
+    Args:
+        chunks (Iterable[bytes]): The body
+        encoding (Optional[str]): The Content-Encoding to apply, None passes the chunks through
+
+    Returns:
+        Iterator[bytes]: The compressed chunks
+    """
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(6,zlib.DEFLATED,31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+#==========================================DECODERS================================================
+# Function to read a frames body, this is what a client runs on its side
+def decode_frames(data : Annotated[bytes,"The frames body"]
+                  ) -> Annotated[Tuple[List[Dict[str,Any]],Optional[Dict[str,Any]]],"The rows and the page end"]:
+    """
+    Reads the rows of a frames body back into records that decrypt_record takes
+
+    Args:
+        data (bytes): The uncompressed frames body
+
+    Returns:
+        Tuple[List[Dict[str,Any]],Optional[Dict[str,Any]]]: The records, and the next_cursor and has_more
+            of a page or None if the body is not a page
+    """
+    if not data.startswith(FRAMES_MAGIC):
+        raise ValueError("Not a frames body")
+    rows = []
+    page = None
+    position = len(FRAMES_MAGIC)
+    while position + FRAME_HEADER.size <= len(data):
+        length,kind = FRAME_HEADER.unpack_from(data,position)
+        position += FRAME_HEADER.size
+        payload = data[position:position + length]
+        position += length
+        if kind == KIND_PAGE:
+            next_cursor,has_more = PAGE_END.unpack(payload)
+            page = {'next_cursor':next_cursor,'has_more':has_more}
+            continue
+        seq,timestamp,version = ROW_HEADER.unpack_from(payload)
+        row = {'seq':seq,'timestamp':datetime.datetime.fromtimestamp(timestamp),'version':version}
+        offset = ROW_HEADER.size
+        for field in BINARY_FIELDS:
+            (size,) = FIELD_LENGTH.unpack_from(payload,offset)
+            offset += FIELD_LENGTH.size
+            if size == NO_FIELD:
+                row[field] = None
+            else:
+                row[field] = payload[offset:offset + size]
+                offset += size
+        rows.append(row)
+    return rows,page